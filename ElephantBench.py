@@ -0,0 +1,1118 @@
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import ElephantLog
+
+from ElephantBrain import ElephantBrain
+
+
+def timed(func, *args, **kwargs):
+    """
+    Time a single call of a function.
+
+    Args:
+        func (callable): The function to call.
+        *args: Positional arguments to pass to func.
+        **kwargs: Keyword arguments to pass to func.
+
+    Returns (tuple):
+    A tuple of the elapsed seconds and func's return value.
+    """
+    start = time.time()
+    result = func(*args, **kwargs)
+    return time.time() - start, result
+
+
+def report(name, elapsed, rows=None, unit='rows'):
+    """
+    Print a single benchmark result line.
+
+    Args:
+        name (str): Name of the thing that was measured.
+        elapsed (float): Elapsed time in seconds.
+        rows (int, None): Number of rows handled, used to work out a rate.
+        unit (str): What rows counts. Defaults to 'rows'.
+    """
+    line = '  {0:<40} {1:>9.4f}s'.format(name, elapsed)
+    if rows:
+        line += ' {0:>12,.0f} {1}/s'.format(
+            rows / elapsed if elapsed else 0, unit)
+    print(line)
+
+
+class TempBrain(object):
+    """
+    Context manager that makes a new ElephantBrain in a temporary directory,
+    and cleans the whole directory up afterwards.
+    """
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+        self.dir = None
+        self.brain = None
+
+    def __enter__(self):
+        self.dir = tempfile.mkdtemp(prefix='elephant_bench_')
+        self.brain = ElephantBrain(os.path.join(self.dir, 'bench.elephant'),
+                                   new=True, **self.kwargs)
+        return self.brain
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.brain.db.close()
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+
+def equipment_rows(count):
+    """
+    Generate rows for the Equipment table.
+
+    Args:
+        count (int): Number of rows to generate.
+
+    Returns (generator):
+    Tuples of (Name, ShortName, Description).
+    """
+    for i in range(count):
+        yield ('Item {0}'.format(i), 'I{0}'.format(i),
+               'This is item {0}'.format(i))
+
+
+def bench_add_many(count=5000):
+    """
+    Compare adding rows one at a time against add_many().
+
+    Args:
+        count (int): Number of rows to add with each method.
+    """
+    fields = ['Name', 'ShortName', 'Description']
+    print('add vs add_many ({0} rows):'.format(count))
+    with TempBrain() as eb:
+        # The old per-row path: an INSERT string built with repr() per row.
+        def legacy():
+            for row in equipment_rows(count):
+                eb.query('INSERT INTO Equipment({0}) VALUES ({1})'.format(
+                    ', '.join(fields), ', '.join([repr(v) for v in row])))
+            eb.save()
+        report('per-row, formatted SQL', timed(legacy)[0], count)
+
+    with TempBrain() as eb:
+        def per_row():
+            for row in equipment_rows(count):
+                eb.add('Equipment', fields, row)
+            eb.save()
+        report('add(), per row', timed(per_row)[0], count)
+
+    with TempBrain() as eb:
+        def many():
+            eb.add_many('Equipment', fields, equipment_rows(count))
+            eb.save()
+        report('add_many()', timed(many)[0], count)
+
+
+def write_equipment_csv(path, count):
+    """
+    Write a CSV file of Equipment rows.
+
+    Args:
+        path (str): Path of the CSV file to write.
+        count (int): Number of rows to write.
+    """
+    import csv
+    with open(path, 'w') as fh:
+        writer = csv.writer(fh)
+        writer.writerow(['Name', 'ShortName', 'Description'])
+        writer.writerows(equipment_rows(count))
+
+
+def write_xlsx(path, header, rows, date_columns=()):
+    """
+    Write a minimal single sheet XLSX workbook, the way spreadsheet programs
+    do: text in the shared strings table, numbers inline, and dates as
+    serial numbers with a date style.
+
+    Args:
+        path (str): Path of the XLSX file to write.
+        header (list): The column names.
+        rows (iterable): Row tuples.
+        date_columns (tuple): Positions of the columns holding
+            datetime.datetime values.
+    """
+    import datetime
+    import zipfile
+    from xml.sax.saxutils import escape
+    epoch = datetime.datetime(1899, 12, 30)
+    strings = {}
+    lines = []
+
+    def column(i):
+        name = ''
+        i += 1
+        while i:
+            i, rem = divmod(i - 1, 26)
+            name = chr(65 + rem) + name
+        return name
+
+    for r, row in enumerate([header] + list(rows)):
+        cells = []
+        for c, value in enumerate(row):
+            ref = '{0}{1}'.format(column(c), r + 1)
+            if r and c in date_columns:
+                delta = value - epoch
+                cells.append('<c r="{0}" s="1"><v>{1}</v></c>'.format(
+                    ref, delta.days + delta.seconds / 86400.0))
+            elif isinstance(value, basestring):
+                index = strings.setdefault(value, len(strings))
+                cells.append('<c r="{0}" t="s"><v>{1}</v></c>'.format(
+                    ref, index))
+            elif value is not None:
+                cells.append('<c r="{0}"><v>{1}</v></c>'.format(ref, value))
+        lines.append('<row r="{0}">{1}</row>'.format(r + 1, ''.join(cells)))
+    main = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+    rel = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+    ordered = sorted(strings, key=strings.get)
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr('xl/workbook.xml', (
+            '<workbook xmlns="{0}" xmlns:r="{1}"><sheets>'
+            '<sheet name="Sheet1" sheetId="1" r:id="rId1"/></sheets>'
+            '</workbook>').format(main, rel))
+        zf.writestr('xl/_rels/workbook.xml.rels', (
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/'
+            '2006/relationships"><Relationship Id="rId1" Type="{0}/worksheet" '
+            'Target="worksheets/sheet1.xml"/></Relationships>').format(rel))
+        zf.writestr('xl/styles.xml', (
+            '<styleSheet xmlns="{0}"><numFmts count="1"><numFmt '
+            'numFmtId="164" formatCode="yyyy\\-mm\\-dd hh:mm"/></numFmts>'
+            '<cellXfs count="2"><xf numFmtId="0"/><xf numFmtId="164"/>'
+            '</cellXfs></styleSheet>').format(main))
+        zf.writestr('xl/sharedStrings.xml', (
+            u'<sst xmlns="{0}" uniqueCount="{1}">{2}</sst>').format(
+                main, len(ordered), u''.join(
+                    [u'<si><t>{0}</t></si>'.format(escape(t))
+                     for t in ordered])).encode('utf-8'))
+        zf.writestr('xl/worksheets/sheet1.xml', (
+            '<worksheet xmlns="{0}"><sheetData>{1}</sheetData>'
+            '</worksheet>').format(main, ''.join(lines)))
+
+
+def bench_add_csv(count=100000):
+    """
+    Compare the old row-at-a-time CSV import against add_csv().
+
+    Args:
+        count (int): Number of rows in the CSV file.
+    """
+    from csv import DictReader
+    print('add_csv ({0} rows):'.format(count))
+    field_map = {'Name': '', 'ShortName': '', 'Description': ''}
+    with TempBrain() as eb:
+        csv_path = os.path.join(os.path.dirname(eb.file_path), 'eq.csv')
+        write_equipment_csv(csv_path, count)
+
+        # The old path: DictReader, field_map per row and add() per row.
+        def legacy():
+            with open(csv_path) as fh:
+                for row in DictReader(fh):
+                    row = dict([(k, row.get(v or k))
+                                for k, v in field_map.items()])
+                    eb.add('Equipment', row.keys(), row.values())
+            eb.save()
+        report('DictReader + add() per row', timed(legacy)[0], count)
+
+    with TempBrain() as eb:
+        csv_path = os.path.join(os.path.dirname(eb.file_path), 'eq.csv')
+        write_equipment_csv(csv_path, count)
+        elapsed = timed(eb.add_csv, 'Equipment', csv_path, field_map)[0]
+        report('add_csv()', elapsed, count)
+
+
+def bench_add_xlsx(count=100000):
+    """
+    Compare importing the same rows from an XLSX sheet with add_xlsx()
+    against a CSV file with add_csv(), and check that memory stays flat.
+
+    Args:
+        count (int): Number of rows in the sheet.
+    """
+    import multiprocessing
+    import resource
+    print('add_xlsx ({0} rows):'.format(count))
+    field_map = {'Name': '', 'ShortName': '', 'Description': ''}
+    with TempBrain() as eb:
+        work = os.path.dirname(eb.file_path)
+        xlsx_path = os.path.join(work, 'eq.xlsx')
+        csv_path = os.path.join(work, 'eq.csv')
+        # Write the sheet in another process, so building it doesn't count
+        # towards this one's peak memory.
+        writer = multiprocessing.Process(target=write_xlsx, args=(
+            xlsx_path, ['Name', 'ShortName', 'Description'],
+            equipment_rows(count)))
+        writer.start()
+        writer.join()
+        write_equipment_csv(csv_path, count)
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        elapsed = timed(eb.add_xlsx, 'Equipment', xlsx_path, field_map)[0]
+        report('add_xlsx() ({0:.1f}MB file)'.format(
+            os.path.getsize(xlsx_path) / 1048576.0), elapsed, count)
+        after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        elapsed = timed(eb.add_csv, 'Equipment', csv_path, field_map)[0]
+        report('add_csv() ({0:.1f}MB file)'.format(
+            os.path.getsize(csv_path) / 1048576.0), elapsed, count)
+        print('  peak memory: {0:.1f}MB before add_xlsx(), {1:.1f}MB '
+              'after'.format(before / 1024.0, after / 1024.0))
+
+
+def bench_open(count=200):
+    """
+    Compare opening a database with the cached schema fingerprint against
+    the full schema comparison.
+
+    Args:
+        count (int): Number of times to open the database.
+    """
+    print('open ({0} times):'.format(count))
+    with TempBrain() as eb:
+        path = eb.file_path
+
+        def full():
+            for _ in range(count):
+                ElephantBrain(path)._compare_schema()
+        report('full schema comparison', timed(full)[0])
+
+        def cached():
+            for _ in range(count):
+                ElephantBrain(path)
+        report('fingerprint check', timed(cached)[0])
+
+
+def bench_rows(count=100000):
+    """
+    Compare the memory and speed of dict_factory, ElephantRow and plain
+    tuple rows.
+
+    Args:
+        count (int): Number of rows to fetch.
+    """
+    from ElephantBrain import dict_factory, row_factory
+
+    def size(rows):
+        total = sys.getsizeof(rows)
+        for row in rows:
+            total += sys.getsizeof(row)
+            if not isinstance(row, (dict, tuple)):
+                total += sys.getsizeof(row.as_tuple())
+        return total
+
+    print('rows ({0} rows):'.format(count))
+    with TempBrain() as eb:
+        eb.add_many('Equipment', ['Name', 'ShortName', 'Description'],
+                    equipment_rows(count))
+        eb.save()
+        for name, factory in [('dict_factory', dict_factory),
+                              ('ElephantRow', row_factory)]:
+            eb.db.row_factory = factory
+            elapsed, rows = timed(eb.get, 'Equipment', fetchall=True)
+            report(name, elapsed, count)
+            print('  {0:<40} {1:>9,d} bytes'.format('', size(rows)))
+        elapsed, rows = timed(eb.get, 'Equipment', fetchall=True, tuples=True)
+        report('tuples', elapsed, count)
+        print('  {0:<40} {1:>9,d} bytes'.format('', size(rows)))
+
+
+def bench_get_iterate(count=200000):
+    """
+    Compare time to the first row and total time of get(fetchall=True),
+    get(iterate=True) and keyset pagination.
+
+    Args:
+        count (int): Number of rows to get.
+    """
+    print('get iteration ({0} rows):'.format(count))
+    with TempBrain() as eb:
+        eb.add_many('Equipment', ['Name', 'ShortName', 'Description'],
+                    equipment_rows(count))
+        eb.save()
+
+        start = time.time()
+        rows = eb.get('Equipment', fetchall=True)
+        report('fetchall, first row', time.time() - start)
+        for _ in rows:
+            pass
+        report('fetchall, all rows', time.time() - start, count)
+        del rows
+
+        start = time.time()
+        rows = eb.get('Equipment', iterate=True)
+        next(rows)
+        report('iterate, first row', time.time() - start)
+        for _ in rows:
+            pass
+        report('iterate, all rows', time.time() - start, count)
+
+        start = time.time()
+        last = None
+        while True:
+            page = eb.get('Equipment', ['id', 'Name'], after_id=last,
+                          limit=1000, fetchall=True)
+            if not page:
+                break
+            last = page[-1]['id']
+        report('keyset pages of 1000, all rows', time.time() - start, count)
+
+        # after_id's value has to be bound before dictionary criteria's.
+        found = eb.get('Equipment', ['id'], {'Name': 'Item 10'}, after_id=10,
+                       limit=10, fetchall=True)
+        if [r['id'] for r in found] != [11]:
+            raise AssertionError('after_id with dictionary criteria got '
+                                 '{0}'.format(found))
+
+
+def bench_query_builder(count=20000):
+    """
+    Compare lookups with inlined values (a new SQL string every call)
+    against bound values through the QueryBuilder cache.
+
+    Args:
+        count (int): Number of lookups.
+    """
+    print('query builder ({0} lookups):'.format(count))
+    with TempBrain(cache=False) as eb:
+        eb.add_many('Equipment', ['Name', 'ShortName', 'Description'],
+                    equipment_rows(1000))
+        eb.save()
+
+        def inlined():
+            for i in range(count):
+                eb.get('Equipment', where='id={0}'.format(i % 1000 + 1),
+                       fetchall=True)
+        report('inlined values', timed(inlined)[0], count, 'lookups')
+
+        eb.builder.clear()
+
+        def bound():
+            for i in range(count):
+                eb.get('Equipment', where={'id': i % 1000 + 1},
+                       fetchall=True)
+        report('bound values', timed(bound)[0], count, 'lookups')
+        print('  {0}'.format(eb.builder))
+
+
+def bench_result_cache(count=2000):
+    """
+    Compare repeated lookups with the result cache on and off.
+
+    Args:
+        count (int): Number of times to repeat each lookup.
+    """
+    print('result cache ({0} repeats):'.format(count))
+    with TempBrain() as eb:
+        eb.add_many('Equipment', ['Name', 'ShortName', 'Description'],
+                    equipment_rows(500))
+        eb.add_many('Site', ['Name'], [('Site {0}'.format(i),)
+                                       for i in range(20)])
+        eb.save()
+
+        def lookups():
+            for _ in range(count):
+                eb.metadata
+                eb.get('Equipment', fetchall=True)
+                eb.get('Site', ['id', 'Name'], fetchall=True)
+        for enabled in [False, True]:
+            eb.cache.enabled = enabled
+            eb.cache.clear()
+            report('cache {0}'.format('on' if enabled else 'off'),
+                   timed(lookups)[0], count * 3, 'lookups')
+        print('  {0}'.format(eb.cache))
+
+
+def fill_schedule(eb, events, rooms=200, people=500, sites=5, pieces=20):
+    """
+    Fill a database with a random (but repeatable) conference schedule:
+    sites, rooms, people, equipment, events, staff assignments (one per
+    event), equipment assignments (two per event) and equipment inventory.
+
+    Args:
+        eb (ElephantBrain): The database to fill.
+        events (int): Number of events.
+        rooms (int): Number of rooms.
+        people (int): Number of people.
+        sites (int): Number of sites.
+        pieces (int): Number of pieces of equipment.
+    """
+    import datetime
+    import random
+    rand = random.Random(42)
+    base = datetime.datetime(2016, 1, 1, 8, 0)
+    fmt = '%Y-%m-%d %H:%M'
+
+    def times():
+        for i in range(events):
+            start = base + datetime.timedelta(
+                days=rand.randint(0, 2), minutes=rand.randint(0, 40) * 15)
+            end = start + datetime.timedelta(minutes=rand.randint(2, 8) * 15)
+            yield ('Event {0}'.format(i), rand.randint(1, rooms),
+                   start.strftime(fmt), end.strftime(fmt),
+                   rand.randint(1, people))
+
+    eb.add_many('Site', ['Name'], [('Site {0}'.format(i),)
+                                   for i in range(sites)])
+    eb.add_many('Room', ['Name', 'RoomGroup', 'Site'],
+                [('Room {0}'.format(i), 'Hall', i % sites + 1)
+                 for i in range(rooms)])
+    eb.add_many('People', ['FirstName', 'LastName'],
+                [('Person', str(i)) for i in range(people)])
+    eb.add_many('Equipment', ['Name', 'ShortName'],
+                [('Piece {0}'.format(i), 'P{0}'.format(i))
+                 for i in range(pieces)])
+    eb.add_many('Event', ['Name', 'Room', 'Start', 'End', 'Speaker'], times())
+    eb.add_many('StaffAssign', ['Event', 'Person'],
+                [(i + 1, rand.randint(1, people)) for i in range(events)])
+    eb.add_many('EquipmentAssign', ['Event', 'Piece', 'Quantity'],
+                [(i // 2 + 1, rand.randint(1, pieces), rand.randint(1, 4))
+                 for i in range(events * 2)])
+    eb.add_many('EquipmentAdjust', ['Piece', 'Site', 'Quantity'],
+                [(p + 1, s + 1, rand.randint(10, 60))
+                 for p in range(pieces) for s in range(sites)])
+    eb.save()
+
+
+def bench_conflicts(count=20000):
+    """
+    Time room and staff conflict detection, and rechecking one event.
+
+    Args:
+        count (int): Number of events.
+    """
+    from ElephantTusk import ElephantTusk
+    print('conflicts ({0} events):'.format(count))
+    with TempBrain() as eb:
+        fill_schedule(eb, count)
+        tusk = ElephantTusk(eb)
+        elapsed, rooms = timed(tusk.room_conflicts)
+        report('room_conflicts(), {0} found'.format(len(rooms)), elapsed,
+               count)
+        elapsed, staff = timed(tusk.staff_conflicts)
+        report('staff_conflicts(), {0} found'.format(len(staff)), elapsed,
+               count)
+        elapsed = timed(tusk.recheck, rooms + staff, count // 2)[0]
+        report('recheck() one event', elapsed)
+
+        # The pairwise check, on a sample small enough to finish.
+        sample = eb.get('Event', ['Room', 'id', 'Start', 'End'],
+                        limit=count // 10, fetchall=True, tuples=True)
+
+        def pairwise():
+            return [(a[1], b[1]) for a in sample for b in sample
+                    if a[0] == b[0] and a[1] < b[1] and
+                    a[2] < b[3] and b[2] < a[3]]
+        report('pairwise rooms, {0} events'.format(len(sample)),
+               timed(pairwise)[0], len(sample))
+
+
+def bench_shortfall(count=20000):
+    """
+    Time the peak-concurrency equipment demand calculation.
+
+    Args:
+        count (int): Number of events. Each has two equipment assignments.
+    """
+    from ElephantTusk import ElephantTusk
+    print('shortfall ({0} equipment assignments):'.format(count * 2))
+    with TempBrain() as eb:
+        fill_schedule(eb, count)
+        elapsed, demand = timed(ElephantTusk(eb).equipment_demand)
+        report('equipment_demand(), {0} site/pieces'.format(len(demand)),
+               elapsed, count * 2)
+
+
+def bench_profiles(count=100000, queries=200):
+    """
+    Compare the connection profiles on a chunked CSV import and on repeated
+    join queries.
+
+    Args:
+        count (int): Number of rows to import.
+        queries (int): Number of join queries to run.
+    """
+    print('profiles ({0} rows imported in chunks of 1000, {1} '
+          'queries):'.format(count, queries))
+    field_map = {'Name': '', 'ShortName': '', 'Description': ''}
+    with TempBrain() as eb:
+        csv_path = os.path.join(os.path.dirname(eb.file_path), 'eq.csv')
+        write_equipment_csv(csv_path, count)
+        fill_schedule(eb, 20000)
+        path = eb.file_path
+        for profile in sorted(ElephantBrain.profiles):
+            brain = ElephantBrain(path, profile=profile, cache=False)
+            if not brain.read_only:
+                elapsed = timed(brain.add_csv, 'Equipment', csv_path,
+                                field_map, 1000)[0]
+                report('{0}: import'.format(profile), elapsed, count)
+
+            def join():
+                for i in range(queries):
+                    brain.get('EquipmentAssign',
+                              ['Room.Site', 'EquipmentAssign.Quantity'],
+                              {'EquipmentAssign.Piece': i % 20 + 1},
+                              joins=[('Event',
+                                      'EquipmentAssign.Event=Event.id'),
+                                     ('Room', 'Event.Room=Room.id')],
+                              fetchall=True, tuples=True)
+            report('{0}: queries'.format(profile), timed(join)[0], queries,
+                   'queries')
+            brain.db.close()
+
+
+def bench_reports(count=20000, workers=4):
+    """
+    Compare running every report one after another against running them in
+    a pool of worker processes.
+
+    Args:
+        count (int): Number of events in the schedule.
+        workers (int): Number of worker processes.
+    """
+    from ElephantTrunk import ElephantTrunk
+    print('reports ({0} events):'.format(count))
+    with TempBrain() as eb:
+        fill_schedule(eb, count)
+        trunk = ElephantTrunk()
+        for n in [1, workers]:
+            summary = trunk.run_reports(eb.file_path, workers=n, force=True)
+            report('{0} reports, {1} workers'.format(
+                len(summary['reports']), summary['workers']),
+                summary['seconds'])
+
+
+def bench_list_reports(count=100):
+    """
+    Compare importing every report module to find the reports against
+    reading them statically, with and without the saved index.
+
+    Args:
+        count (int): Number of times to list the reports from the index.
+    """
+    import glob
+    import importlib
+    import ElephantTrunk
+    print('list_reports:')
+    trunk = ElephantTrunk.ElephantTrunk()
+    index_path = os.path.join(trunk.reports_dir, trunk.index_file)
+    if os.path.isfile(index_path):
+        os.remove(index_path)
+    modules = [os.path.splitext(os.path.basename(f))[0]
+               for f in glob.glob(os.path.join(trunk.reports_dir, '*.py'))
+               if not os.path.basename(f).startswith('__')]
+
+    def imported():
+        for name in modules:
+            importlib.import_module('.' + name, package=trunk.reports_dir)
+    report('import every module (first time)', timed(imported)[0])
+    report('static scan, no index',
+           timed(ElephantTrunk.ElephantTrunk().list_reports)[0])
+
+    def indexed():
+        for _ in range(count):
+            ElephantTrunk.ElephantTrunk().list_reports()
+    report('saved index (per call)', timed(indexed)[0] / count)
+
+
+def bench_shared_queries(count=20000, reports=30):
+    """
+    Compare every report in a batch running its own queries against
+    running each unique query once for the whole batch. Every report reads
+    a few columns of the same three joins, like a typical package does.
+    Then time run_reports() on a batch of reports that all share a query,
+    in this process and in a pool of workers.
+
+    Args:
+        count (int): Number of events in the schedule.
+        reports (int): Number of reports in the batch.
+    """
+    from ElephantTrunk import ElephantTrunk, plan_queries
+    joins = [
+        {'tables': 'Event', 'fields': ['Event.id', 'Event.Name', 'Room.Name'],
+         'joins': [('Room', 'Event.Room=Room.id')]},
+        {'tables': 'StaffAssign', 'fields': ['People.LastName', 'Event.Start'],
+         'joins': [('Event', 'StaffAssign.Event=Event.id'),
+                   ('People', 'StaffAssign.Person=People.id')]},
+        {'tables': 'EquipmentAssign',
+         'fields': ['EquipmentAssign.Piece', 'EquipmentAssign.Quantity'],
+         'joins': [('Event', 'EquipmentAssign.Event=Event.id')]},
+    ]
+    declared = {}
+    for i in range(reports):
+        queries = {}
+        for n, spec in enumerate(joins):
+            spec = dict(spec)
+            spec['fields'] = spec['fields'][i % 2:] or spec['fields']
+            queries['q{0}'.format(n)] = spec
+        declared['Report{0}'.format(i)] = queries
+    print('shared_queries ({0} events, {1} reports):'.format(count, reports))
+    with TempBrain(cache=False) as eb:
+        fill_schedule(eb, count)
+
+        def separate():
+            for queries in declared.values():
+                for spec in queries.values():
+                    eb.get(fetchall=True, **spec)
+
+        def shared():
+            unique, _ = plan_queries(declared)
+            for spec in unique:
+                eb.get(fetchall=True, **spec)
+        report('per-report queries', timed(separate)[0],
+               reports * len(joins), 'queries')
+        report('shared queries', timed(shared)[0],
+               len(plan_queries(declared)[0]), 'queries')
+        # A real batch, where every report shares one query, so the cost of
+        # getting the rows to worker processes shows up too.
+        eb.save()
+        trunk = ElephantTrunk()
+        for workers in [1, 4]:
+            summary = trunk.run_reports(eb.file_path,
+                                        ['EventSchedule'] * reports,
+                                        workers=workers, force=True)
+            report('run_reports(), {0} workers'.format(workers),
+                   summary['seconds'], reports, 'reports')
+
+
+def bench_writers(count=1000000):
+    """
+    Stream a large staff assignment export in each output format, checking
+    how fast the rows go out and how soon the first ones are written.
+
+    Args:
+        count (int): Number of events (and staff assignments).
+    """
+    import resource
+    from ElephantTrunk import WRITERS, write_rows
+    from reports.StaffAssignments import StaffAssignments
+    print('writers ({0} staff assignments):'.format(count))
+    with TempBrain(cache=False) as eb:
+        fill_schedule(eb, count)
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        for fmt in WRITERS:
+            path = os.path.join(os.path.dirname(eb.file_path),
+                                'staff.{0}'.format(fmt))
+            start = time.time()
+            first = []
+
+            def rows():
+                for row in StaffAssignments(eb).rows():
+                    if not first:
+                        first.append(time.time() - start)
+                    yield row
+            elapsed, written = timed(write_rows, rows(), path, fmt)
+            report('{0} ({1:.1f}MB, first row {2:.3f}s)'.format(
+                fmt, os.path.getsize(path) / 1048576.0, first[0]),
+                elapsed, written)
+            os.remove(path)
+        after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        print('  peak memory: {0:.1f}MB before writing, {1:.1f}MB '
+              'after'.format(before / 1024.0, after / 1024.0))
+
+
+def bench_changes(count=20000):
+    """
+    Measure what recording changes costs on import, and what it saves when
+    a batch of reports is run again after a single change.
+
+    Args:
+        count (int): Number of events in the schedule.
+    """
+    from ElephantTrunk import ElephantTrunk
+    print('changes ({0} events):'.format(count))
+    for tracking in [False, True]:
+        with TempBrain() as eb:
+            eb.track_changes(tracking)
+            report('fill, tracking {0}'.format('on' if tracking else 'off'),
+                   timed(fill_schedule, eb, count)[0])
+    with TempBrain() as eb:
+        eb.track_changes()
+        fill_schedule(eb, count)
+        eb.save()
+        trunk = ElephantTrunk()
+        report('first batch', trunk.run_reports(eb.file_path,
+                                                workers=1)['seconds'])
+        eb.update('Room', ['Name'], ['Renamed'], {'id': 1})
+        eb.save()
+        report('after one change, every report',
+               trunk.run_reports(eb.file_path, workers=1,
+                                 force=True)['seconds'])
+        eb.update('Room', ['Name'], ['Renamed again'], {'id': 1})
+        eb.save()
+        summary = trunk.run_reports(eb.file_path, workers=1)
+        report('after one change, {0} skipped'.format(
+            len(summary['skipped'])), summary['seconds'])
+        print('  change log: {0} entries left after pruning'.format(
+            eb.query('SELECT COUNT(*) FROM ChangeLog',
+                     tuples=True).fetchone()[0]))
+
+
+def bench_autosave(count=2000):
+    """
+    Compare saving after every add() (what an interactive session has to do
+    so it doesn't lose work) against autosave group commits and a single
+    transaction.
+
+    Args:
+        count (int): Number of rows to add.
+    """
+    print('autosave ({0} rows):'.format(count))
+    rows = list(equipment_rows(count))
+
+    def add_all(eb, save=False):
+        for row in rows:
+            eb.add('Equipment', ['Name', 'ShortName', 'Description'], row)
+            if save:
+                eb.save()
+        eb.save()
+
+    with TempBrain() as eb:
+        report('save() after every row', timed(add_all, eb, True)[0], count)
+    for group in [10, 100, 1000]:
+        with TempBrain(autosave_rows=group) as eb:
+            report('autosave every {0} rows'.format(group),
+                   timed(add_all, eb)[0], count)
+    with TempBrain() as eb:
+        def atomic():
+            with eb.transaction():
+                add_all(eb)
+        report('one transaction()', timed(atomic)[0], count)
+
+
+def bench_update_many(count=5000):
+    """
+    Compare updating and deleting rows one call at a time against
+    update_many() and delete_many().
+
+    Args:
+        count (int): Number of rows to update, then delete.
+    """
+    print('update_many ({0} rows):'.format(count))
+    fields = ['Name', 'ShortName', 'Description']
+    for many in [False, True]:
+        with TempBrain() as eb:
+            eb.add_many('Equipment', fields, equipment_rows(count))
+            eb.save()
+            changes = [('It\'s item {0}'.format(i), i + 1)
+                       for i in range(count)]
+            if many:
+                elapsed = timed(eb.update_many, 'Equipment', ['Description'],
+                                changes)[0]
+                report('update_many()', elapsed, count)
+                elapsed = timed(eb.delete_many, 'Equipment',
+                                range(1, count + 1))[0]
+                report('delete_many()', elapsed, count)
+                continue
+
+            def update():
+                for value, key in changes:
+                    eb.update('Equipment', ['Description'], [value],
+                              {'id': key})
+                eb.save()
+
+            def delete():
+                for key in range(1, count + 1):
+                    eb.delete('Equipment', {'id': key})
+                eb.save()
+            report('update() per row', timed(update)[0], count)
+            report('delete() per row', timed(delete)[0], count)
+
+
+def bench_batch(count=500, processes=20):
+    """
+    Compare running CLI commands one process each (the way scripts had to
+    before batch mode) against running them all with the batch command.
+
+    Args:
+        count (int): Number of commands in the batch script.
+        processes (int): Number of one-command processes to time. The cost
+            of count of them is worked out from these.
+    """
+    import subprocess
+    print('batch ({0} commands):'.format(count))
+    commands = ['conflicts --rooms', 'shortfall', 'changes', 'cache']
+    elephant = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'elephant.py')
+    with TempBrain() as eb:
+        fill_schedule(eb, 200)
+        eb.save()
+        script = os.path.join(os.path.dirname(eb.file_path), 'script.txt')
+        with open(script, 'w') as fh:
+            for i in range(count):
+                fh.write(commands[i % len(commands)] + '\n')
+        with open(os.devnull, 'w') as null:
+            def separate():
+                for i in range(processes):
+                    subprocess.check_call(
+                        [sys.executable, elephant, eb.file_path] +
+                        commands[i % len(commands)].split(),
+                        stdout=null, stderr=null)
+
+            def batch():
+                subprocess.check_call(
+                    [sys.executable, elephant, eb.file_path, 'batch',
+                     script], stdout=null, stderr=null)
+            elapsed = timed(separate)[0]
+            report('one process per command (estimated)',
+                   elapsed * count / processes, count, 'commands')
+            report('batch', timed(batch)[0], count, 'commands')
+
+
+def bench_get_output(count=200000):
+    """
+    Compare the old get command (fetch every row, then str.format() each
+    one) against streaming the rows in each output format, writing to a
+    file as if piped.
+
+    Args:
+        count (int): Number of events (and staff assignments) to dump.
+    """
+    import resource
+    from elephant import ElephantTrumpet
+    print('get_output ({0} staff assignments):'.format(count))
+    with TempBrain(cache=False) as eb:
+        fill_schedule(eb, count)
+        eb.save()
+        path = os.path.join(os.path.dirname(eb.file_path), 'dump.txt')
+        trumpet = ElephantTrumpet()
+        trumpet.brain = eb
+
+        def legacy():
+            data = eb.get(tables='StaffAssign', fetchall=True)
+            line_template = ' | '.join([('{' + str(k) + '}')
+                                        for k in data[0].keys()])
+            print(line_template.replace('{', '').replace('}', ''))
+            for row in data:
+                print(line_template.format(**row))
+
+        def dump(func, *args):
+            stdout = sys.stdout
+            with open(path, 'wb') as sys.stdout:
+                try:
+                    return timed(func, *args)[0]
+                finally:
+                    sys.stdout = stdout
+
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        for fmt in trumpet.get_formats:
+            elapsed = dump(trumpet.parse_commands,
+                           'get --tables StaffAssign --format {0}'.format(fmt))
+            report('get --format {0}'.format(fmt), elapsed, count)
+        after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        report('fetchall + str.format() per row', dump(legacy), count)
+        print('  peak memory: {0:.1f}MB before, {1:.1f}MB after streaming, '
+              '{2:.1f}MB after fetchall'.format(
+                  before / 1024.0, after / 1024.0,
+                  resource.getrusage(resource.RUSAGE_SELF).ru_maxrss /
+                  1024.0))
+
+
+def bench_startup(runs=10):
+    """
+    Profile how long a fresh interpreter takes to import each module, and
+    time the whole of `elephant.py <file> info`, which is mostly startup.
+    Each figure is the best of several runs, in a new process every time.
+
+    Args:
+        runs (int): Number of times to run each process.
+    """
+    import subprocess
+    print('startup (best of {0} runs):'.format(runs))
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, PYTHONPATH=here)
+    # Time imports the way they normally run, from compiled .pyc files.
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    with TempBrain() as eb:
+        eb.save()
+        # Run in the temporary directory, so init_log() clears out its
+        # Elephant.log rather than ours.
+        cwd = os.path.dirname(eb.file_path)
+
+        def best(args):
+            times = []
+            with open(os.devnull, 'w') as null:
+                for i in range(runs):
+                    start = time.time()
+                    subprocess.check_call([sys.executable] + args, cwd=cwd,
+                                          env=env, stdout=null, stderr=null)
+                    times.append(time.time() - start)
+            return min(times)
+
+        def imported(statement):
+            # Time just the import, inside the process.
+            with open(os.devnull, 'w') as null:
+                return float(subprocess.check_output(
+                    [sys.executable, '-c', 'import time; '
+                     'start = time.time(); {0}; '
+                     'print(time.time() - start)'.format(statement)],
+                    cwd=cwd, env=env, stderr=null).split()[-1])
+
+        bare = best(['-c', 'pass'])
+        report('interpreter alone', bare)
+        for module in ['ElephantLog', 'ElephantBrain', 'ElephantTusk',
+                       'ElephantXlsx', 'ElephantTrunk', 'elephant']:
+            report('import {0}'.format(module), min(
+                [imported('import ' + module) for i in range(runs)]))
+        report('import everything, as before', min(
+            [imported('import ElephantLog; ElephantLog.init_log(); '
+                      'import ElephantBrain, ElephantTrunk, ElephantXlsx, '
+                      'xml.sax.saxutils') for i in range(runs)]))
+        info = best([os.path.join(here, 'elephant.py'), eb.file_path,
+                     'info'])
+        report('elephant.py <file> info', info)
+        report('  less the interpreter', info - bare)
+
+
+def bench_logging(count=20000):
+    """
+    Compare the cost of logging while importing rows: writing Elephant.log
+    from the calling thread at debug, with and without looking up the caller
+    of every record (as before init_log() turned that off), from ElephantLog's
+    background thread, and with ElephantBrain set to info so its per-call
+    messages are never formatted.
+
+    Args:
+        count (int): Number of rows to import, one add() call each, and
+            ten times as many with add_csv().
+    """
+    import logging
+    from logging.handlers import RotatingFileHandler
+    print('logging ({0} rows with add(), {1} with add_csv()):'.format(
+        count, count * 10))
+    log = logging.getLogger('Elephant')
+    handlers = log.handlers[:]
+    fields = ['Name', 'ShortName', 'Description']
+    directory = tempfile.mkdtemp(prefix='elephant_bench_')
+    csv_path = os.path.join(directory, 'eq.csv')
+    write_equipment_csv(csv_path, count * 10)
+    setups = [('file, caller lookups', False, None, True),
+              ('file, synchronous', False, None, False),
+              ('file, background thread', True, None, False),
+              ('ElephantBrain at info', True, {'ElephantBrain': 'info'},
+               False)]
+    srcfile = logging._srcfile
+    try:
+        for name, background, levels, lookups in setups:
+            if lookups:
+                logging._srcfile = os.path.normcase(
+                    logging.Logger.findCaller.__code__.co_filename)
+            handler = RotatingFileHandler(
+                os.path.join(directory, 'bench.log'), mode='w')
+            handler.setFormatter(logging.Formatter(
+                '%(asctime)s %(levelname)s %(message)s'))
+            listener = None
+            if background:
+                listener = ElephantLog.QueueListener(handler)
+                listener.start()
+                handler = ElephantLog.QueueHandler(listener)
+            log.handlers = [handler]
+            before = ElephantLog.set_levels(levels or {})
+            try:
+                with TempBrain() as eb:
+                    def per_row():
+                        for row in equipment_rows(count):
+                            eb.add('Equipment', fields, row)
+                        eb.save()
+                    report('add() per row, ' + name, timed(per_row)[0],
+                           count)
+                with TempBrain() as eb:
+                    report('add_csv(), ' + name, timed(
+                        eb.add_csv, 'Equipment', csv_path)[0], count * 10)
+                if listener is not None:
+                    report('  then writing out the queue',
+                           timed(listener.stop)[0])
+            finally:
+                logging._srcfile = srcfile
+                ElephantLog.set_levels(before)
+                if listener is not None:
+                    listener.stop()
+    finally:
+        log.handlers = handlers
+        shutil.rmtree(directory, ignore_errors=True)
+
+    # Building the message when it's going to be dropped.
+    quiet = logging.getLogger('Elephant.bench')
+    quiet.setLevel(logging.INFO)
+    row = ('Projector', 'P', 'A projector')
+
+    def eager():
+        for i in xrange(count * 10):
+            quiet.debug('add(): {0}'.format(locals()))
+
+    def lazy():
+        for i in xrange(count * 10):
+            quiet.debug('add(): %s', locals())
+    report('dropped debug, str.format()', timed(eager)[0], count * 10,
+           'calls')
+    report('dropped debug, %-style', timed(lazy)[0], count * 10, 'calls')
+
+
+def bench_profiler(count=20000, rows=200000):
+    """
+    Compare queries with the query profiler off and on: many small lookups,
+    where the cost per statement shows, and one big iterated get(), where
+    the cost per fetch shows.
+
+    Args:
+        count (int): Number of lookups by id.
+        rows (int): Number of rows to iterate over.
+    """
+    print('profiler ({0} lookups, {1} rows iterated):'.format(count, rows))
+    # Keep the debug log out of the timings.
+    levels = ElephantLog.set_levels({'ElephantBrain': 'info'})
+    with TempBrain(cache=False) as eb:
+        eb.add_many('Equipment', ['Name', 'ShortName', 'Description'],
+                    equipment_rows(rows))
+        eb.save()
+
+        def lookups():
+            for i in xrange(count):
+                eb.get('Equipment', where={'id': i % rows + 1},
+                       fetchall=True)
+
+        def iterate():
+            for _ in eb.get('Equipment', iterate=True, tuples=True):
+                pass
+
+        for on in (False, True):
+            eb.profile_queries(on)
+            label = 'on' if on else 'off'
+            report('lookups, profiler ' + label, timed(lookups)[0], count,
+                   'queries')
+            report('iterate, profiler ' + label, timed(iterate)[0], rows)
+        eb.profile_queries(False)
+        for stat in eb.profiler.stats:
+            print('  {0}: {1} calls, {2:.4f}s, p95 {3:.3f}ms, {4} rows, '
+                  '{5} steps'.format(stat['shape'], stat['calls'],
+                                     stat['seconds'], stat['p95'] * 1000,
+                                     stat['rows'], stat['steps']))
+
+        def plain():
+            for i in xrange(count * 10):
+                eb.db.cursor()
+
+        def checked():
+            for i in xrange(count * 10):
+                eb._cursor()
+        report('db.cursor()', timed(plain)[0], count * 10, 'calls')
+        report('_cursor(), profiler off', timed(checked)[0], count * 10,
+               'calls')
+    ElephantLog.set_levels(levels)
+
+
+if __name__ == '__main__':
+    ElephantLog.init_log()
+    benches = dict([(n[6:], f) for n, f in globals().items()
+                    if n.startswith('bench_') and callable(f)])
+    names = sys.argv[1:] or sorted(benches)
+    for name in names:
+        if name not in benches:
+            print('Unknown benchmark: {0}. Choices are: {1}'.format(
+                name, ', '.join(sorted(benches))))
+            continue
+        benches[name]()
+        print('')
@@ -1,17 +1,23 @@
+import hashlib
 import logging
 import os
 import re
 import sqlite3
+import time
 
-import ElephantLog
+from contextlib import contextmanager
 
 
-ElephantLog.init_log()
+# SchemaCheck names used to skip the full schema check on open. (Files
+# checked before SchemaCheck existed have them in Metadata.)
+FINGERPRINT_KEY = '_SchemaFingerprint'
+SCHEMA_VERSION_KEY = '_SchemaVersion'
 
 
 def dict_factory(cur, row):
     """
     Dictionary factor for sqlite3. Converts Row objects to dictionaries.
+    ElephantBrain uses row_factory() instead, which is lighter.
 
     Args:
         cur (sqlite3.Cursor): Cursor object
@@ -23,6 +29,909 @@ def dict_factory(cur, row):
     return dict([(c[0], row[i]) for i, c in enumerate(cur.description)])
 
 
+class ElephantRow(object):
+    """
+    A compact, read-only database row. Values can be read by field name like
+    a dictionary (row['Name'], row.keys(), **row) or by index like a tuple
+    (row[0]). The field names and their indexes are shared by every row of a
+    query, so each row only holds a tuple of its values.
+    """
+    __slots__ = ('_fields', '_index', '_values')
+
+    def __init__(self, fields, values, index=None):
+        """
+        Prepares an ElephantRow for use.
+
+        Args:
+            fields (tuple): The field names, in order.
+            values (tuple): The row's values, in the same order as fields.
+            index (dict, None): Dictionary of field names and their indexes.
+                Built from fields if None. Pass a shared one when making many
+                rows with the same fields.
+        """
+        self._fields = fields
+        self._index = index if index is not None else \
+            dict([(f, i) for i, f in enumerate(fields)])
+        self._values = values
+
+    def __getitem__(self, key):
+        try:
+            return self._values[self._index[key]]
+        except (KeyError, TypeError):
+            if isinstance(key, (int, long, slice)):
+                return self._values[key]
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __iter__(self):
+        return iter(self._fields)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __eq__(self, other):
+        if isinstance(other, ElephantRow):
+            return self._fields == other._fields and \
+                self._values == other._values
+        if isinstance(other, dict):
+            return dict(self.items()) == other
+        if isinstance(other, tuple):
+            return self._values == other
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '{{{0}}}'.format(', '.join(
+            ['{0!r}: {1!r}'.format(f, v)
+             for f, v in zip(self._fields, self._values)]))
+
+    def __reduce__(self):
+        return ElephantRow, (self._fields, self._values)
+
+    def keys(self):
+        """
+        Returns (list):
+        List of the field names, in order.
+        """
+        return list(self._fields)
+
+    def values(self):
+        """
+        Returns (list):
+        List of the values, in field order.
+        """
+        return list(self._values)
+
+    def items(self):
+        """
+        Returns (list):
+        List of (field name, value) tuples, in field order.
+        """
+        return zip(self._fields, self._values)
+
+    def get(self, key, default=None):
+        """
+        Args:
+            key (str): The field name.
+            default: Value to return if there is no such field.
+
+        Returns:
+        The field's value, or default.
+        """
+        return self._values[self._index[key]] if key in self._index \
+            else default
+
+    def as_dict(self):
+        """
+        Returns (dict):
+        A dictionary of the row's values with the field name as the key.
+        """
+        return dict(self.items())
+
+    def as_tuple(self):
+        """
+        Returns (tuple):
+        The row's values, in field order.
+        """
+        return self._values
+
+
+# The field names and indexes of the last query row_factory() saw, so they
+# are only worked out once per query instead of once per row.
+_row_shape = (None, None, None)
+
+
+def row_factory(cur, row):
+    """
+    Row factory for sqlite3. Converts rows to ElephantRow objects, working out
+    the field names once per query.
+
+    Args:
+        cur (sqlite3.Cursor): Cursor object
+        row (tuple): Current row's values.
+
+    Returns (ElephantRow):
+    The current row.
+    """
+    global _row_shape
+    description, fields, index = _row_shape
+    if cur.description is not description:
+        description = cur.description
+        fields = tuple([c[0] for c in description])
+        index = dict([(f, i) for i, f in enumerate(fields)])
+        _row_shape = (description, fields, index)
+    return ElephantRow(fields, row, index)
+
+
+def iter_rows(cur, batch_size=500):
+    """
+    Stream the rows of a query, fetching batch_size rows at a time.
+
+    Args:
+        cur (sqlite3.Cursor): Cursor of an executed query.
+        batch_size (int): Number of rows to fetch at a time.
+
+    Returns (generator):
+    The query's rows.
+    """
+    while True:
+        rows = cur.fetchmany(batch_size)
+        if not rows:
+            break
+        for row in rows:
+            yield row
+
+
+# Statements that write to a table, and the table they write to (without
+# any schema name, like main.).
+WRITE_RE = re.compile(
+    r'^\s*(?:INSERT(?:\s+OR\s+\w+)?\s+INTO|REPLACE\s+INTO|'
+    r'UPDATE(?:\s+OR\s+\w+)?|DELETE\s+FROM)\s+'
+    r'(?:["`\[]?\w+["`\]]?\s*\.\s*)?["`\[]?(\w+)', re.I)
+# Statements that don't change any table's data.
+READ_RE = re.compile(
+    r'^\s*(?:SELECT|EXPLAIN|PRAGMA|BEGIN|SAVEPOINT|RELEASE|COMMIT|END)\b',
+    re.I)
+# Common table expressions, which read unless their statement writes.
+WITH_RE = re.compile(r'^\s*WITH\b', re.I)
+CTE_WRITE_RE = re.compile(r'\b(?:INSERT|UPDATE|DELETE|REPLACE)\b', re.I)
+# Statements that start or end the transaction (but not ROLLBACK TO).
+TRANSACTION_RE = re.compile(
+    r'^\s*(BEGIN|COMMIT|END|ROLLBACK)\b(?!\s+(?:TRANSACTION\s+)?TO\b)', re.I)
+# Statements SQLite won't run inside a transaction.
+NO_TRANSACTION_RE = re.compile(r'^\s*(?:VACUUM|ATTACH|DETACH)\b', re.I)
+
+
+def writes(sql):
+    """
+    Does a statement change table data, so it has to run in a transaction?
+
+    Args:
+        sql (str): SQL string.
+
+    Returns (bool):
+    False for reads (including WITH ... SELECT), PRAGMAs, transaction
+    control and the statements that can't run in a transaction, like VACUUM.
+    True for everything else.
+    """
+    if READ_RE.match(sql) or NO_TRANSACTION_RE.match(sql):
+        return False
+    if WITH_RE.match(sql):
+        return bool(CTE_WRITE_RE.search(sql))
+    return True
+
+
+def table_names(tables, joins=None):
+    """
+    The lower-cased names of the tables a get() call reads.
+
+    Args:
+        tables (str, list, tuple): Table or collection of tables, which may
+            have aliases ('Event e').
+        joins (list, tuple, None): Joins, as (table, on) or (kind, table, on)
+            tuples.
+
+    Returns (tuple):
+    Sorted tuple of lower-cased table names.
+    """
+    if isinstance(tables, basestring):
+        tables = [tables]
+    names = list(tables) + [j[-2] for j in joins or ()]
+    return tuple(sorted(set([n.split()[0].lower() for n in names])))
+
+
+def normalize_sql(sql):
+    """
+    Collapse the whitespace in a SQL string and drop any trailing semicolon,
+    so strings can be compared with what SQLite stores in sqlite_master.
+
+    Args:
+        sql (str): SQL string.
+
+    Returns (str):
+    The normalized SQL string.
+    """
+    return re.sub(r'[\s]+', ' ', sql).strip().rstrip(';').rstrip()
+
+
+# Literal strings and numbers, which vary between calls of the same
+# statement, and lists of placeholders, which vary in length.
+LITERAL_RE = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+PLACEHOLDERS_RE = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+
+
+def statement_shape(sql):
+    """
+    The shape of a SQL statement: the statement with its whitespace
+    collapsed, its literals replaced by ? and its lists of placeholders
+    shortened, so calls that differ only in their values are counted
+    together.
+
+    Args:
+        sql (str): SQL string.
+
+    Returns (str):
+    The statement's shape, like 'SELECT * FROM Event WHERE id IN (?, ...)'.
+    """
+    return PLACEHOLDERS_RE.sub('(?, ...)', LITERAL_RE.sub(
+        '?', normalize_sql(sql)))
+
+
+class QueryBuilder(object):
+    """
+    QueryBuilder builds the SQL for ElephantBrain's add(), get(), update() and
+    delete() calls. Values are always bound as parameters, so calls that only
+    differ in their values build the same SQL string, and sqlite3 can reuse
+    its prepared statement. Built strings are kept in an LRU cache keyed on
+    the shape of the query.
+
+    WHERE criteria can be raw condition strings ('Event.Room=Room.id', which
+    may use ? placeholders) or dictionaries of field names and values
+    ({'Name': 'Foo'}), which become bound 'Name=?' conditions. Raw conditions
+    come first in the built SQL, followed by the dictionary ones.
+
+    Fields:
+        size (int): The most built statements to keep.
+        hits (int): Number of times a built statement was reused.
+        misses (int): Number of times a statement had to be built.
+    """
+    def __init__(self, size=256):
+        """
+        Prepare a QueryBuilder for use.
+
+        Args:
+            size (int): The most built statements to keep. Defaults to 256.
+        """
+        from collections import OrderedDict
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+
+    def __repr__(self):
+        return 'QueryBuilder ({0} hits, {1} misses, {2}/{3} cached)'.format(
+            self.hits, self.misses, len(self._cache), self.size)
+
+    @property
+    def stats(self):
+        """
+        Cache statistics.
+
+        Returns (dict):
+        Dictionary of hits, misses, entries (how many statements are cached)
+        and size.
+        """
+        return {'hits': self.hits, 'misses': self.misses,
+                'entries': len(self._cache), 'size': self.size}
+
+    def clear(self):
+        """
+        Empty the cache and reset the hit and miss counters.
+        """
+        self._cache.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def _cached(self, key, build, *args):
+        """
+        Get a built statement from the cache, or build and cache it.
+
+        Args:
+            key (tuple): The shape of the query.
+            build (callable): Builds the statement if it isn't cached.
+            *args: Arguments to pass to build.
+
+        Returns (str):
+        The SQL statement.
+        """
+        try:
+            qry = self._cache.pop(key)
+            self.hits += 1
+        except KeyError:
+            qry = build(*args)
+            self.misses += 1
+            if len(self._cache) >= self.size:
+                self._cache.popitem(last=False)
+        self._cache[key] = qry
+        return qry
+
+    @staticmethod
+    def _listify(value):
+        """
+        Turn a string (or dictionary) into a tuple of one item, any other
+        collection into a tuple, and None into an empty tuple.
+        """
+        if value is None:
+            return ()
+        if isinstance(value, (basestring, dict)):
+            return (value,)
+        return tuple(value)
+
+    @classmethod
+    def _where(cls, where):
+        """
+        Split WHERE criteria into their shape and their bound values.
+
+        Args:
+            where (str, dict, list, tuple, None): WHERE criteria.
+
+        Returns (tuple):
+        A tuple of the shape (raw condition strings and field names, both as
+        tuples) and the list of values for the field names.
+        """
+        raw = []
+        names = []
+        values = []
+        for item in cls._listify(where):
+            if isinstance(item, dict):
+                for name in sorted(item):
+                    names.append(name)
+                    values.append(item[name])
+            else:
+                raw.append(item)
+        return (tuple(raw), tuple(names)), values
+
+    @staticmethod
+    def _where_sql(shape):
+        """
+        Build a WHERE clause from its shape.
+
+        Args:
+            shape (tuple): The shape from _where().
+
+        Returns (str):
+        The WHERE clause, or a blank string if there are no criteria.
+        """
+        raw, names = shape
+        conditions = list(raw) + ['{0}=?'.format(n) for n in names]
+        return ' WHERE ' + ' AND '.join(conditions) if conditions else ''
+
+    def select(self, tables, fields=None, where=None, joins=None, order=None,
+               limit=False, offset=False):
+        """
+        Build a SELECT statement.
+
+        Args:
+            tables (str, list, tuple): Table or collection of tables.
+            fields (str, list, tuple, None): Field or collection of fields.
+                If None, uses *.
+            where (str, dict, list, tuple, None): WHERE criteria.
+            joins (list, tuple, None): Explicit joins, as (table, on) or
+                (kind, table, on) tuples, like ('Room', 'Event.Room=Room.id')
+                or ('LEFT', 'People', 'Event.Speaker=People.id').
+            order (str, None): Field to ORDER BY, if any.
+            limit (bool): Add a LIMIT ? placeholder?
+            offset (bool): Add an OFFSET ? placeholder? Requires limit.
+
+        Returns (tuple):
+        The SQL string and the list of values for its dictionary criteria.
+        """
+        tables = self._listify(tables)
+        fields = self._listify(fields)
+        joins = tuple([tuple(j) for j in joins or ()])
+        shape, values = self._where(where)
+        key = ('SELECT', tables, fields, joins, shape, order, limit, offset)
+        return self._cached(key, self._build_select, *key[1:]), values
+
+    def _build_select(self, tables, fields, joins, shape, order, limit,
+                      offset):
+        qry = 'SELECT {0} FROM {1}'.format(
+            ', '.join(fields) if fields else '*', ', '.join(tables))
+        for join in joins:
+            kind, table, on = join if len(join) == 3 else ('',) + join
+            qry += ' {0}JOIN {1} ON {2}'.format(
+                kind + ' ' if kind else '', table, on)
+        qry += self._where_sql(shape)
+        if order:
+            qry += ' ORDER BY ' + order
+        if limit:
+            qry += ' LIMIT ?'
+            if offset:
+                qry += ' OFFSET ?'
+        return qry
+
+    def insert(self, table, fields):
+        """
+        Build an INSERT statement.
+
+        Args:
+            table (str): The name of the table.
+            fields (str, list, tuple): Field or collection of fields.
+
+        Returns (str):
+        The SQL string, with a ? placeholder for each field.
+        """
+        fields = self._listify(fields)
+        return self._cached(('INSERT', table, fields), self._build_insert,
+                            table, fields)
+
+    @staticmethod
+    def _build_insert(table, fields):
+        return 'INSERT INTO {0}({1}) VALUES ({2})'.format(
+            table, ', '.join(fields), ', '.join(['?'] * len(fields)))
+
+    def update(self, table, fields, where):
+        """
+        Build an UPDATE statement.
+
+        Args:
+            table (str): The name of the table.
+            fields (str, list, tuple): Field or collection of fields to set.
+            where (str, dict, list, tuple): WHERE criteria.
+
+        Returns (tuple):
+        The SQL string, with a ? placeholder for each field, and the list of
+        values for its dictionary criteria.
+        """
+        fields = self._listify(fields)
+        shape, values = self._where(where)
+        key = ('UPDATE', table, fields, shape)
+        return self._cached(key, self._build_update, *key[1:]), values
+
+    def _build_update(self, table, fields, shape):
+        return 'UPDATE {0} SET {1}{2}'.format(
+            table, ', '.join(['{0}=?'.format(f) for f in fields]),
+            self._where_sql(shape))
+
+    def delete(self, table, where):
+        """
+        Build a DELETE statement.
+
+        Args:
+            table (str): The name of the table.
+            where (str, dict, list, tuple): WHERE criteria.
+
+        Returns (tuple):
+        The SQL string and the list of values for its dictionary criteria.
+        """
+        shape, values = self._where(where)
+        key = ('DELETE', table, shape)
+        return self._cached(key, self._build_delete, *key[1:]), values
+
+    def _build_delete(self, table, shape):
+        return 'DELETE FROM {0}{1}'.format(table, self._where_sql(shape))
+
+
+class ResultCache(object):
+    """
+    ResultCache is a size-bounded LRU cache of query results, keyed on the
+    query string and its parameters. Every table has a generation counter
+    that is bumped whenever the table is written to. A cached result
+    remembers the generations of the tables it read, and is only served while
+    they all still match, so stale results are never returned. The tables a
+    query reads are the ones SQLite reports as it prepares the query (see
+    TableReads), so tables in subqueries and behind views count too; they're
+    remembered for each query string.
+
+    Fields:
+        size (int): The most results to keep.
+        enabled (bool): Is the cache in use? Turning it off empties it.
+        hits (int): Number of lookups served from the cache.
+        misses (int): Number of lookups that had to query the database.
+    """
+    def __init__(self, size=128, enabled=True):
+        """
+        Prepare a ResultCache for use.
+
+        Args:
+            size (int): The most results to keep. Defaults to 128.
+            enabled (bool): Start with the cache in use? Defaults to True.
+        """
+        from collections import OrderedDict
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._enabled = enabled
+        self._epoch = 0
+        self._generations = {}
+        self._results = OrderedDict()
+        self._reads = OrderedDict()
+
+    def __repr__(self):
+        return 'ResultCache ({0}, {1} hits, {2} misses, {3}/{4} cached)'.format(
+            'on' if self.enabled else 'off', self.hits, self.misses,
+            len(self._results), self.size)
+
+    @property
+    def enabled(self):
+        return self._enabled
+
+    @enabled.setter
+    def enabled(self, value):
+        self._enabled = bool(value)
+        if not self._enabled:
+            self._results.clear()
+
+    @property
+    def stats(self):
+        """
+        Cache statistics.
+
+        Returns (dict):
+        Dictionary of enabled, hits, misses, hit_rate (0.0 to 1.0), entries
+        (how many results are cached) and size.
+        """
+        lookups = self.hits + self.misses
+        return {'enabled': self.enabled, 'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+                'entries': len(self._results), 'size': self.size}
+
+    def clear(self):
+        """
+        Empty the cache and reset the hit and miss counters.
+        """
+        self._results.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def _snapshot(self, tables):
+        """
+        The current generations of a collection of tables.
+
+        Args:
+            tables (tuple): Lower-cased table names.
+
+        Returns (tuple):
+        The cache's epoch, followed by the generation of each table.
+        """
+        return (self._epoch,) + tuple([self._generations.get(t, 0)
+                                       for t in tables])
+
+    def get(self, key):
+        """
+        Look up a cached result.
+
+        Args:
+            key (tuple): The query string and its parameters.
+
+        Returns (list, None):
+        The cached rows, or None if there is no current result cached.
+        """
+        entry = self._results.pop(key, None)
+        if entry is not None and entry[1] == self._snapshot(entry[0]):
+            self._results[key] = entry
+            self.hits += 1
+            return entry[2]
+        self.misses += 1
+        return None
+
+    def put(self, key, tables, rows):
+        """
+        Cache a result.
+
+        Args:
+            key (tuple): The query string and its parameters.
+            tables (tuple): Lower-cased names of the tables the query reads.
+            rows (list): The result's rows.
+        """
+        if len(self._results) >= self.size:
+            self._results.popitem(last=False)
+        self._results[key] = (tables, self._snapshot(tables), rows)
+
+    def reads(self, qry):
+        """
+        Look up the tables a query string was found to read.
+
+        Args:
+            qry (str): SQL Query string.
+
+        Returns (tuple, None):
+        Lower-cased table names, or None if they aren't known.
+        """
+        return self._reads.get(qry)
+
+    def remember_reads(self, qry, tables):
+        """
+        Remember the tables a query string reads.
+
+        Args:
+            qry (str): SQL Query string.
+            tables (tuple): Lower-cased table names.
+        """
+        if len(self._reads) >= self.size:
+            self._reads.popitem(last=False)
+        self._reads[qry] = tables
+
+    def invalidate(self, tables=None):
+        """
+        Bump the generation of tables that have been written to, so results
+        that read them are no longer served.
+
+        Args:
+            tables (str, list, tuple, None): Table or collection of tables.
+                If None, every cached result is invalidated.
+        """
+        if tables is None:
+            # The schema may have changed too (a view may read other tables
+            # now), so forget what each query reads.
+            self._epoch += 1
+            self._results.clear()
+            self._reads.clear()
+            return
+        if isinstance(tables, basestring):
+            tables = [tables]
+        for table in tables:
+            table = table.lower()
+            self._generations[table] = self._generations.get(table, 0) + 1
+
+
+class TableReads(object):
+    """
+    An authorizer callback (see sqlite3.Connection.set_authorizer()) that
+    records the tables statements read while SQLite prepares them. It allows
+    everything. It's a separate object, rather than an ElephantBrain method,
+    so the connection doesn't hold a reference to its ElephantBrain.
+
+    Fields:
+        tables (set, None): Lower-cased names of the tables read since it was
+            set to a set. While it's None, nothing is recorded.
+    """
+    def __init__(self):
+        self.tables = None
+
+    def __call__(self, action, table, column, database, source):
+        if action == sqlite3.SQLITE_READ and self.tables is not None:
+            self.tables.add(table.lower())
+        return sqlite3.SQLITE_OK
+
+
+class QueryProfiler(object):
+    """
+    QueryProfiler keeps statistics about the statements an ElephantBrain
+    runs, grouped by statement_shape(): how many times each ran, how long
+    they took (executing and fetching), how many rows they returned or
+    changed, and how much work SQLite did for them, counted by a progress
+    handler in virtual machine steps. Statements slower than the slow
+    threshold are logged with their query plan.
+
+    Turn it on with ElephantBrain.profile_queries(). While it's off, queries
+    run on plain cursors and nothing is recorded.
+
+    Fields:
+        enabled (bool): Is the profiler recording?
+        slow (float, None): Seconds after which a statement is logged with
+            its query plan, or None to not log any.
+        step_interval (int): Virtual machine steps between progress handler
+            calls. Step counts are rounded to multiples of this.
+        samples (int): The most recent latencies kept for each shape, to
+            work out its p95 from.
+        steps (int): Progress handler calls so far.
+    """
+    def __init__(self, slow=None, step_interval=1000, samples=1000):
+        """
+        Prepare a QueryProfiler for use.
+
+        Args:
+            slow (float, None): Slow statement threshold in seconds. Defaults
+                to None.
+            step_interval (int): Virtual machine steps between progress
+                handler calls. Defaults to 1000.
+            samples (int): The most recent latencies to keep for each shape.
+                Defaults to 1000.
+        """
+        self.log = logging.getLogger('Elephant.ElephantBrain')
+        self.enabled = False
+        self.slow = slow
+        self.step_interval = step_interval
+        self.samples = samples
+        self.steps = 0
+        self._shapes = {}
+        self._stats = {}
+
+    def __repr__(self):
+        return 'QueryProfiler ({0}, {1} shapes)'.format(
+            'on' if self.enabled else 'off', len(self._stats))
+
+    def step(self):
+        """
+        The progress handler. Counts steps, and lets the statement carry on.
+        """
+        self.steps += 1
+        return 0
+
+    def clear(self):
+        """
+        Forget the statistics collected so far.
+        """
+        self._shapes.clear()
+        self._stats.clear()
+
+    def entry(self, sql):
+        """
+        The statistics of a statement's shape.
+
+        Args:
+            sql (str): SQL string.
+
+        Returns (list):
+        The shape's [shape, calls, seconds, rows, steps, latencies], which
+        the caller updates in place.
+        """
+        shape = self._shapes.get(sql)
+        if shape is None:
+            if len(self._shapes) >= 1000:
+                self._shapes.clear()
+            shape = self._shapes[sql] = statement_shape(sql)
+        entry = self._stats.get(shape)
+        if entry is None:
+            from collections import deque
+            entry = self._stats[shape] = [shape, 0, 0.0, 0, 0,
+                                          deque(maxlen=self.samples)]
+        return entry
+
+    def finish(self, entry, seconds, connection, sql, params):
+        """
+        Record the latency of a statement that has finished, and log it if
+        it was slow.
+
+        Args:
+            entry (list): The statement's entry().
+            seconds (float): How long it took to execute and fetch.
+            connection (sqlite3.Connection): The connection it ran on.
+            sql (str): The statement.
+            params (list, tuple, dict, None): The statement's parameters.
+        """
+        entry[5].append(seconds)
+        if self.slow is None or seconds < self.slow:
+            return
+        bound = params
+        if bound is None and '?' in sql:
+            # An executemany() statement: any values will do for the plan.
+            bound = [None] * sql.count('?')
+        try:
+            qry = 'EXPLAIN QUERY PLAN ' + sql
+            plan = [r[-1] for r in (connection.execute(qry, bound)
+                                    if bound is not None
+                                    else connection.execute(qry))]
+        except sqlite3.Error as e:
+            plan = ['(no plan: {0})'.format(e)]
+        self.log.warn('Slow statement (%.3fs): %s\nParameters: %s\n'
+                      'Plan:\n  %s', seconds, normalize_sql(sql), params,
+                      '\n  '.join(plan) or '(none)')
+
+    @property
+    def stats(self):
+        """
+        Statistics for each statement shape, busiest first.
+
+        Returns (list):
+        List of dictionaries of shape, calls, seconds (in total), mean, p95
+        and max (seconds per call, over the recent calls that have
+        finished), rows (returned, or changed by writes) and steps (virtual
+        machine steps, roughly).
+        """
+        stats = []
+        for shape, calls, seconds, rows, steps, latencies in \
+                self._stats.values():
+            latencies = sorted(latencies)
+            # The nearest-rank 95th percentile.
+            rank = (95 * len(latencies) + 99) // 100
+            stats.append({
+                'shape': shape, 'calls': calls, 'seconds': seconds,
+                'mean': seconds / calls if calls else 0.0,
+                'p95': latencies[rank - 1] if latencies else None,
+                'max': latencies[-1] if latencies else None, 'rows': rows,
+                'steps': steps * self.step_interval})
+        stats.sort(key=lambda s: s['seconds'], reverse=True)
+        return stats
+
+
+class ProfiledCursor(sqlite3.Cursor):
+    """
+    A cursor that records what its statements cost in a QueryProfiler. The
+    time and steps spent executing and fetching are added to the statement
+    shape's entry as they happen, and the call's latency is recorded once
+    all of its rows have been fetched (or straight away, for statements that
+    don't return rows).
+
+    Fields:
+        profiler (QueryProfiler): Where to record statistics. Set this before
+            executing anything.
+    """
+    profiler = None
+    _entry = None
+
+    def _start(self, sql, params, calls):
+        self._entry = self.profiler.entry(sql)
+        self._entry[1] += calls
+        self._sql = sql
+        self._params = params
+        self._seconds = 0.0
+
+    def _add(self, start, steps, rows):
+        seconds = time.time() - start
+        entry = self._entry
+        entry[2] += seconds
+        entry[3] += rows
+        entry[4] += self.profiler.steps - steps
+        self._seconds += seconds
+
+    def _finish(self):
+        if self._entry is not None:
+            self.profiler.finish(self._entry, self._seconds, self.connection,
+                                 self._sql, self._params)
+            self._entry = None
+
+    def execute(self, sql, *params):
+        self._start(sql, params[0] if params else None, 1)
+        start, steps = time.time(), self.profiler.steps
+        sqlite3.Cursor.execute(self, sql, *params)
+        rows = 0 if self.description else max(self.rowcount, 0)
+        self._add(start, steps, rows)
+        if not self.description:
+            self._finish()
+        return self
+
+    def executemany(self, sql, rows):
+        # Counted as one call, since it's one statement run many times.
+        self._start(sql, None, 1)
+        start, steps = time.time(), self.profiler.steps
+        sqlite3.Cursor.executemany(self, sql, rows)
+        self._add(start, steps, max(self.rowcount, 0))
+        self._finish()
+        return self
+
+    def fetchone(self):
+        start, steps = time.time(), self.profiler.steps
+        row = sqlite3.Cursor.fetchone(self)
+        if self._entry is not None:
+            self._add(start, steps, 0 if row is None else 1)
+            if row is None:
+                self._finish()
+        return row
+
+    def fetchmany(self, *size):
+        start, steps = time.time(), self.profiler.steps
+        rows = sqlite3.Cursor.fetchmany(self, *size)
+        if self._entry is not None:
+            self._add(start, steps, len(rows))
+            if not rows:
+                self._finish()
+        return rows
+
+    def fetchall(self):
+        start, steps = time.time(), self.profiler.steps
+        rows = sqlite3.Cursor.fetchall(self)
+        if self._entry is not None:
+            self._add(start, steps, len(rows))
+            self._finish()
+        return rows
+
+    def next(self):
+        row = self.fetchone()
+        if row is None:
+            raise StopIteration
+        return row
+
+
 class AddledBrainError(Exception):
     pass
 
@@ -136,7 +1045,115 @@ class ElephantBrain(object):
             ''',
     }
 
-    def __init__(self, file_path, new=False):
+    # The tables that hold conference data, in the order they're reported.
+    data_tables = ('Site', 'Room', 'People', 'Equipment', 'Event',
+                   'StaffAssign', 'EquipmentAssign', 'EquipmentAdjust')
+
+    indexes = {
+        'idx_Room_Site':
+            'CREATE INDEX IF NOT EXISTS idx_Room_Site ON Room(Site);',
+        'idx_Event_Room':
+            'CREATE INDEX IF NOT EXISTS idx_Event_Room ON Event(Room);',
+        'idx_Event_Speaker':
+            'CREATE INDEX IF NOT EXISTS idx_Event_Speaker ON Event(Speaker);',
+        'idx_Event_Start_End':
+            'CREATE INDEX IF NOT EXISTS idx_Event_Start_End '
+            'ON Event(Start, End);',
+        'idx_StaffAssign_Event':
+            'CREATE INDEX IF NOT EXISTS idx_StaffAssign_Event '
+            'ON StaffAssign(Event);',
+        'idx_StaffAssign_Person':
+            'CREATE INDEX IF NOT EXISTS idx_StaffAssign_Person '
+            'ON StaffAssign(Person);',
+        'idx_EquipmentAssign_Event':
+            'CREATE INDEX IF NOT EXISTS idx_EquipmentAssign_Event '
+            'ON EquipmentAssign(Event);',
+        'idx_EquipmentAssign_Piece':
+            'CREATE INDEX IF NOT EXISTS idx_EquipmentAssign_Piece '
+            'ON EquipmentAssign(Piece);',
+        'idx_EquipmentAdjust_Piece':
+            'CREATE INDEX IF NOT EXISTS idx_EquipmentAdjust_Piece '
+            'ON EquipmentAdjust(Piece);',
+        'idx_EquipmentAdjust_Site':
+            'CREATE INDEX IF NOT EXISTS idx_EquipmentAdjust_Site '
+            'ON EquipmentAdjust(Site);',
+    }
+
+    # Change tracking: ChangeLog records every row added to, changed in or
+    # deleted from the data tables (by triggers), and ReportLog records the
+    # last change each report was run against. They're kept out of schema so
+    # files without them are still valid. Tracking is off until it's turned
+    # on with track_changes(), since the triggers slow down every write.
+    change_schema = {
+        'ChangeLog':
+            '''
+            CREATE TABLE IF NOT EXISTS ChangeLog(
+                id integer primary key autoincrement not null,
+                TableName text not null,
+                RowId integer not null,
+                Action text not null
+            );
+            ''',
+        'ReportLog':
+            '''
+            CREATE TABLE IF NOT EXISTS ReportLog(
+                Report text primary key not null,
+                ChangeId integer not null,
+                Output text,
+                Ran datetime not null
+            );
+            ''',
+    }
+    change_actions = (('insert', 'NEW'), ('update', 'NEW'), ('delete', 'OLD'))
+
+    # The schema fingerprint and SQLite's schema_version from the last full
+    # schema check (see _validate_db()). Like change_schema, it's kept out of
+    # schema, and it's kept out of Metadata so it isn't shown as metadata.
+    check_schema = '''
+            CREATE TABLE IF NOT EXISTS SchemaCheck(
+                Name text primary key not null,
+                Value text
+            );
+            '''
+
+    # Connection profiles: the PRAGMA settings applied every time a file is
+    # opened. See profile_order for the order they are applied in.
+    profiles = {
+        # Durable writes with foreign key checks. The default.
+        'safe': {
+            'journal_mode': 'WAL',
+            'synchronous': 'FULL',
+            'foreign_keys': 'ON',
+            'cache_size': -2000,
+            'mmap_size': 0,
+            'temp_store': 'DEFAULT',
+        },
+        # Bulk imports: no fsyncs, no foreign key checks and plenty of cache.
+        # A crash part way through can lose the import.
+        'fast-import': {
+            'journal_mode': 'WAL',
+            'synchronous': 'OFF',
+            'foreign_keys': 'OFF',
+            'cache_size': -65536,
+            'mmap_size': 268435456,
+            'temp_store': 'MEMORY',
+        },
+        # Reports: queries only, with memory-mapped reads and a big cache.
+        'read-only': {
+            'journal_mode': 'WAL',
+            'synchronous': 'NORMAL',
+            'foreign_keys': 'ON',
+            'cache_size': -65536,
+            'mmap_size': 268435456,
+            'temp_store': 'MEMORY',
+            'query_only': 'ON',
+        },
+    }
+    profile_order = ('journal_mode', 'synchronous', 'foreign_keys',
+                     'cache_size', 'mmap_size', 'temp_store', 'query_only')
+
+    def __init__(self, file_path, new=False, cache=True, cache_size=128,
+                 profile='safe', autosave_rows=None, autosave_seconds=None):
         """
         Prepares an ElephantBrain for use.
 
@@ -145,35 +1162,73 @@ class ElephantBrain(object):
             new (bool): True if you want to create a new file (this will
                 overwrite existing files) or False if you intend to open an
                 existing file.
+            cache (bool): Cache the results of get(fetchall=True) calls until
+                the tables they read are written to? Defaults to True.
+            cache_size (int): The most results to cache. Defaults to 128.
+            profile (str): Name of the connection profile (from self.profiles)
+                to open the file with. Defaults to 'safe'.
+            autosave_rows (int, None): Save automatically once this many rows
+                have been written since the last save. See autosave().
+            autosave_seconds (float, None): Save automatically on the first
+                write this many seconds after the last save. See autosave().
+
+        Raises:
+            ValueError: If profile is not in self.profiles.
         """
         self.log = logging.getLogger('Elephant.ElephantBrain')
+        if profile not in self.profiles:
+            raise ValueError('Unknown profile: {0}. Valid options are: '
+                             '{1}'.format(profile,
+                                          ', '.join(sorted(self.profiles))))
+        self.profile = profile
         self.file_path = os.path.abspath(file_path)
+        self.builder = QueryBuilder()
+        self.cache = ResultCache(cache_size, enabled=cache)
+        self._reads = TableReads()
+        # Lower-cased names of the tables the cache can invalidate one at a
+        # time. Writes to any other table invalidate everything.
+        self._tables = frozenset([t.lower() for t in list(self.schema) +
+                                  list(self.change_schema)])
+        self.profiler = QueryProfiler()
+        # Transactions are managed here rather than by the sqlite3 module:
+        # _open is True between BEGIN and COMMIT, and _depth counts the
+        # transaction() blocks we're in.
+        self._open = False
+        self._depth = 0
+        self._pending = 0
+        self._pending_since = None
+        self.autosave(autosave_rows, autosave_seconds)
         if new:
             # Handle new files
             if os.path.isfile(self.file_path):
-                self.log.warn('{0} exists and will be overwritten.'.format(
-                    self.file_path))
+                self.log.warn('%s exists and will be overwritten.',
+                              self.file_path)
                 try:
                     os.remove(self.file_path)
-                    self.log.debug('Deleted: {0}'.format(self.file_path))
+                    self.log.debug('Deleted: %s', self.file_path)
                 except (IOError, OSError) as err:
-                    self.log.error('Deleting {0}: {1}'.format(
-                        self.file_path, err))
+                    self.log.error('Deleting %s: %s', self.file_path, err)
             self.db = self._make_new_db()
         else:
             # Handle existing files
             if not os.path.isfile(self.file_path):
-                self.log.warn('{0} does not exist.'.format(self.file_path))
+                self.log.warn('%s does not exist.', self.file_path)
             try:
-                self.db = sqlite3.connect(self.file_path)
+                self.db = sqlite3.connect(
+                    self.file_path, cached_statements=self.builder.size,
+                    isolation_level=None)
             except sqlite3.Error as err:
-                self.log.error('Connecting to database {0}'.format(err))
-        self.db.row_factory = dict_factory
+                self.log.error('Connecting to database %s', err)
+        self._apply_profile()
+        self.db.row_factory = row_factory
         if not self._validate_db():
             raise AddledBrainError(
                 'The database isn\'t valid. Check logs for details.')
 
     def __del__(self):
+        if getattr(self, '_pending', 0) and \
+                (self.autosave_rows or self.autosave_seconds is not None):
+            self.save()
         self.db.close()
 
     def __repr__(self):
@@ -188,17 +1243,78 @@ class ElephantBrain(object):
         A string containing information on how many items are in each table,
         and the database's metadata.
         """
-        counts = {}
-        for table in ['Site', 'Room', 'People', 'Equipment', 'Event',
-                      'StaffAssign', 'EquipmentAssign', 'EquipmentAdjust']:
-            counts[table] = len(
-                self.get([table]).fetchall())
+        counts = self.counts()
+        metadata = self.metadata
         return '{0}:\n  Metadata:\n{1}\n  Table Counts:\n{2}'.format(
             repr(self),
-            '\n'.join(['    {0}: {1}'.format(k, self.metadata[k])
-                       for k in self.metadata]),
+            '\n'.join(['    {0}: {1}'.format(k, metadata[k])
+                       for k in metadata if not k.startswith('_')]),
             '\n'.join(['    {0}: {1}'.format(k, counts[k])
-                       for k in counts]))
+                       for k in self.data_tables]))
+
+    def counts(self, tables=None):
+        """
+        Count the rows in tables with a single query.
+
+        Args:
+            tables (list, tuple, None): Tables to count. Defaults to
+                self.data_tables.
+
+        Returns (dict):
+        Dictionary of table names and their row counts.
+        """
+        tables = tables or self.data_tables
+        qry = 'SELECT {0}'.format(', '.join(
+            ['(SELECT COUNT(*) FROM {0}) AS {0}'.format(t) for t in tables]))
+        row = self._read(qry, [], table_names(tables))[0]
+        return dict([(t, row[t]) for t in tables])
+
+    def stats(self):
+        """
+        Detailed statistics on the database: row counts, and the pages and
+        bytes used on disk by each table and index. Page usage comes from the
+        dbstat virtual table; if this SQLite was built without it, those
+        values are None.
+
+        Returns (dict):
+        Dictionary with 'page_size', 'page_count', 'freelist_count' and
+        'file_size' values, plus 'tables' and 'indexes' dictionaries that map
+        each name to a dictionary of its 'rows' (tables only), 'table'
+        (indexes only), 'pages' and 'bytes'.
+        """
+        self.log.debug('stats()')
+
+        def pragma(name):
+            return self.query('PRAGMA {0}'.format(name)).fetchone()[name]
+
+        stats = {
+            'page_size': pragma('page_size'),
+            'page_count': pragma('page_count'),
+            'freelist_count': pragma('freelist_count'),
+            'file_size': os.path.getsize(self.file_path),
+            'tables': {},
+            'indexes': {},
+        }
+        try:
+            usage = dict([
+                (r['name'], (r['pages'], r['bytes']))
+                for r in self.query(
+                    'SELECT name, COUNT(*) AS pages, SUM(pgsize) AS bytes '
+                    'FROM dbstat GROUP BY name', fetchall=True)])
+        except sqlite3.OperationalError as e:
+            self.log.debug('dbstat is unavailable: %s', e)
+            usage = {}
+        counts = self.counts(['Metadata'] + list(self.data_tables))
+        for table in counts:
+            pages, size = usage.get(table, (None, None))
+            stats['tables'][table] = {
+                'rows': counts[table], 'pages': pages, 'bytes': size}
+        for index in self.get('sqlite_master', ['name', 'tbl_name'],
+                              'type=\'index\'', fetchall=True):
+            pages, size = usage.get(index['name'], (None, None))
+            stats['indexes'][index['name']] = {
+                'table': index['tbl_name'], 'pages': pages, 'bytes': size}
+        return stats
 
     @property
     def metadata(self):
@@ -208,7 +1324,23 @@ class ElephantBrain(object):
         Returns (dict):
         A dictionary of the metadata from the Metadata table.
         """
-        return dict([(r['Name'], r['Value']) for r in self.get(['Metadata'])])
+        return dict([(r['Name'], r['Value'])
+                     for r in self.get(['Metadata'], fetchall=True)])
+
+    @property
+    def index_list(self):
+        """
+        List of the indexes in the current database (not counting the ones
+        SQLite makes on its own).
+
+        Returns (list):
+        List of index names in the current database.
+        """
+        return sorted([i['name']
+                       for i in self.get('sqlite_master', ['name'],
+                                         ['type=\'index\'',
+                                          'sql IS NOT NULL'],
+                                         fetchall=True)])
 
     @property
     def _table_dict(self):
@@ -225,40 +1357,165 @@ class ElephantBrain(object):
                         if not i['name'].startswith('sqlite')
                         ])
 
-    def _make_new_db(self):
+    def _make_new_db(self):
+        """
+        Create a new database and set the schema.
+
+        Returns (sqlite3.Connection):
+        The sqlite3 Connection object.
+        """
+        self.log.debug('_make_new_db()')
+        db = sqlite3.connect(self.file_path,
+                             cached_statements=self.builder.size,
+                             isolation_level=None)
+        cur = db.cursor()
+        cur.execute('BEGIN')
+        for table in self.schema:
+            self.log.debug('Creating %s table...', table)
+            cur.execute(self.schema[table])
+        for index in self.indexes:
+            self.log.debug('Creating %s index...', index)
+            cur.execute(self.indexes[index])
+        cur.execute('COMMIT')
+        return db
+
+    @property
+    def read_only(self):
+        """
+        Is the database open with a read-only profile?
+
+        Returns (bool):
+        True if the profile only allows queries, False if not.
+        """
+        return self.profiles[self.profile].get('query_only') == 'ON'
+
+    def _apply_profile(self):
+        """
+        Apply the connection profile's PRAGMA settings to the connection.
+        Settings that can't be applied are logged and skipped.
+        """
+        settings = self.profiles[self.profile]
+        self.log.debug('Applying profile %s: %s', self.profile, settings)
+        for pragma in self.profile_order:
+            if pragma not in settings:
+                continue
+            try:
+                self.db.execute('PRAGMA {0}={1}'.format(
+                    pragma, settings[pragma])).fetchall()
+            except sqlite3.Error as e:
+                self.log.warn('Setting PRAGMA %s=%s: %s', pragma,
+                              settings[pragma], e)
+
+    def _validate_db(self):
+        """
+        Check that the database has all of the tables in the schema, and that
+        their definitions match. Indexes are not checked, so databases with or
+        without the default indexes are both valid.
+
+        A full check stores the schema fingerprint and SQLite's schema_version
+        in the SchemaCheck table. If both still match on the next open, the
+        full check is skipped.
+
+        Returns (bool):
+        True if the database is valid, False if not.
+        """
+        fingerprint = self.schema_fingerprint()
+        version = self._schema_version()
+        try:
+            stored = dict([
+                (r['Name'], r['Value'])
+                for r in self.query(
+                    'SELECT Name, Value FROM SchemaCheck WHERE Name IN (?, ?)',
+                    params=[FINGERPRINT_KEY, SCHEMA_VERSION_KEY],
+                    fetchall=True)])
+        except sqlite3.Error as e:
+            self.log.debug('Reading schema fingerprint: %s', e)
+            stored = {}
+        if stored.get(FINGERPRINT_KEY) == fingerprint and \
+                stored.get(SCHEMA_VERSION_KEY) == version:
+            self.log.debug('Schema fingerprint matches, skipping full check.')
+            return True
+        if not self._compare_schema():
+            return False
+        if self.read_only:
+            return True
+        try:
+            self.query(self.check_schema)
+            self.query('DELETE FROM Metadata WHERE Name IN (?, ?)',
+                       params=[FINGERPRINT_KEY, SCHEMA_VERSION_KEY])
+            # Making SchemaCheck changes the schema_version.
+            self.query(
+                'INSERT OR REPLACE INTO SchemaCheck(Name, Value) '
+                'VALUES (?, ?), (?, ?)',
+                params=[FINGERPRINT_KEY, fingerprint,
+                        SCHEMA_VERSION_KEY, self._schema_version()])
+            self.save()
+        except sqlite3.Error as e:
+            self.log.warn('Storing schema fingerprint: %s', e)
+            self.rollback()
+        return True
+
+    def _schema_version(self):
+        """
+        SQLite's schema_version, which changes whenever the schema does.
+
+        Returns (str):
+        The schema_version, as a string.
         """
-        Create a new database and set the schema.
+        return str(self.query(
+            'PRAGMA schema_version').fetchone()['schema_version'])
 
-        Returns (sqlite3.Connection):
-        The sqlite3 Connection object.
+    def _compare_schema(self):
         """
-        self.log.debug('_make_new_db()')
-        db = sqlite3.connect(self.file_path)
-        cur = db.cursor()
-        self.log.debug('Setting Foreign Keys to on')
-        cur.execute('PRAGMA FOREIGN_KEYS=ON')
-        for table in self.schema:
-            self.log.debug('Creating {0} table...'.format(table))
-            cur.execute(self.schema[table])
-        db.commit()
-        return db
+        Compare every table in the schema against the database's definition.
 
-    def _validate_db(self):
+        Returns (bool):
+        True if they all match, False if not.
+        """
+        table_dict = self._table_dict
+        schema_sql = self.normalized_schema()
         for table in self.schema:
-            if table not in self._table_dict:
-                self.log.error('Table {0} not in database'.format(table))
+            if table not in table_dict:
+                self.log.error('Table %s not in database', table)
                 return False
-            db_sql = re.sub(r'[\s]+', ' ', self._table_dict[table]).strip()
-            schema_sql = re.sub(r'[\s]+', ' ', self.schema[table]).strip()[:-1]
-            if schema_sql != db_sql:
+            db_sql = normalize_sql(table_dict[table])
+            if schema_sql[table] != db_sql:
                 self.log.error(
-                    'Table {0} sql doesn\'t match schema\n'
-                    '\ndb sql:\n{1}\n'
-                    '\nschema sql:\n{2}\n'.format(
-                        table, db_sql, schema_sql))
+                    'Table %s sql doesn\'t match schema\n'
+                    '\ndb sql:\n%s\n'
+                    '\nschema sql:\n%s\n', table, db_sql, schema_sql[table])
                 return False
         return True
 
+    @classmethod
+    def normalized_schema(cls):
+        """
+        The schema with whitespace normalized the way SQLite stores it.
+        Worked out once, then cached on the class.
+
+        Returns (dict):
+        Dictionary of table names and their normalized CREATE TABLE strings.
+        """
+        if cls.__dict__.get('_normalized_schema') is None:
+            cls._normalized_schema = dict([
+                (t, normalize_sql(cls.schema[t])) for t in cls.schema])
+        return cls._normalized_schema
+
+    @classmethod
+    def schema_fingerprint(cls):
+        """
+        A fingerprint of the schema, used to skip the full schema check for
+        databases that have already passed it.
+
+        Returns (str):
+        SHA-1 hex digest of the normalized schema.
+        """
+        if cls.__dict__.get('_schema_fingerprint') is None:
+            schema_sql = cls.normalized_schema()
+            cls._schema_fingerprint = hashlib.sha1('\n'.join(
+                [schema_sql[t] for t in sorted(schema_sql)])).hexdigest()
+        return cls._schema_fingerprint
+
     def add(self, table, fields, values):
         """
         Add a row to a database table.
@@ -274,21 +1531,52 @@ class ElephantBrain(object):
         Returns (sqlite3.Cursor):
         The Cursor object resulting from the query.
         """
-        self.log.debug('add(): {0}'.format(locals()))
+        self.log.debug('add(): %s', locals())
         # Convert strings to lists.
         if isinstance(fields, basestring):
             fields = [fields]
         if isinstance(values, basestring):
             values = [values]
-        # Build Query string and query
-        qry = 'INSERT INTO {0}({1}) VALUES ({2})'.format(
-            table, ', '.join(fields), ', '.join([repr(v) for v in values]))
-        self.log.debug('{0}'.format(qry))
-        return self.query(qry)
+        # Reuse the same parameterized statement as add_many().
+        qry = self.builder.insert(table, fields)
+        self.log.debug(qry)
+        return self.query(qry, params=values)
+
+    def add_many(self, table, fields, rows):
+        """
+        Add many rows to a database table with a single parameterized
+        statement. This is much faster than calling add() for each row.
+
+        Args:
+            table (str): The name of the table to add data to.
+            fields (str, list, tuple): The list of fields present in the data.
+                The index of a field should match the index of its data in
+                each row.
+            rows (iterable): Any iterable (lists, generators, cursors...) of
+                row tuples. The index of a value in a row should match the
+                index of its field in fields.
+
+        Returns (sqlite3.Cursor):
+        The Cursor object resulting from the query. All of the rows are added
+        in the current transaction; use save() to commit them. If any row
+        fails, none of them are added, and the exception is raised again.
+        """
+        self.log.debug('add_many(): %s, %s', table, fields)
+        qry = self.builder.insert(table, fields)
+        self.log.debug(qry)
+        cur = self._cursor()
+        self._invalidate(table)
+        with self._savepoint():
+            cur.executemany(qry, rows)
+        self._wrote(cur.rowcount)
+        return cur
 
-    def add_csv(self, table, csv_file, field_map=None):
+    def add_csv(self, table, csv_file, field_map=None, chunk_size=5000,
+                progress=None):
         """
-        Add rows to the database from a CSV file of data.
+        Add rows to the database from a CSV file of data. The file is
+        streamed, and rows are added and committed chunk_size rows at a time,
+        so memory use stays flat no matter how big the file is.
 
         Args:
             table (str): The name of the table to add data to.
@@ -298,48 +1586,166 @@ class ElephantBrain(object):
                 ONLY the fields specified in the dictionary will be added. If
                 you want a database field to use its corresponding name in the
                 csv, make the value a blank string.
+            chunk_size (int): Number of rows to add and commit at a time.
+                Defaults to 5000.
+            progress (callable, None): Called after each chunk with the number
+                of rows imported so far and the elapsed seconds.
 
-        Returns (None):
-        None. Zip. Nada.
+        Returns (int):
+        The number of rows imported.
 
         Raises:
             TypeError: If field_map is not a dictionary or does not contain
                 all string values.
             ValueError: If csv_path does not exist or is not a file.
         """
-        self.log.debug('add_csv(): {0}'.format(locals()))
-        from csv import DictReader
-        csv_file = os.path.abspath(csv_file)
+        self.log.debug('add_csv(): %s', locals())
+        import csv
+        csv_file = self._check_import(csv_file, field_map)
+        with open(csv_file, mode='r') as csv_fh:
+            reader = csv.reader(csv_fh)
+            header = next(reader, None)
+            if header is None:
+                return 0
+            return self._import_rows(table, header, reader, field_map,
+                                     chunk_size, progress)
+
+    def _check_import(self, file_path, field_map):
+        """
+        Check the arguments of the add_* file importers.
+
+        Args:
+            file_path (str): The path to the file to import.
+            field_map (dict, None): Database field to source column mapping,
+                as described in add_csv().
+
+        Returns (str):
+        The absolute path to the file.
+
+        Raises:
+            TypeError: If field_map is not a dictionary or does not contain
+                all string values.
+            ValueError: If file_path does not exist or is not a file.
+        """
+        file_path = os.path.abspath(file_path)
         if field_map and (not isinstance(field_map, dict) or not all(
                 [isinstance(v, basestring) for v in field_map.values()])):
             raise TypeError('field_map must be a dictionary mapping strings '
                             'to strings.')
-        if not os.path.isfile(csv_file):
+        if not os.path.isfile(file_path):
             raise ValueError('{0} either does not exist or is not a '
-                             'file.'.format(csv_file))
-        self.log.debug('Reading: {0}'.format(csv_file))
-        with open(csv_file, mode='r') as csv:
-            dr = DictReader(csv)
-            for row in dr:
-                # Parse the field map if there is one.
-                if field_map:
-                    ins_row = {}
-                    for k, v in field_map.iteritems():
-                        if v:
-                            ins_row[k] = row.get(v)
-                        else:
-                            ins_row[k] = row.get(k)
-                    row = ins_row
-                # Add the row values to the database
-                self.log.debug('Adding: {0}'.format(row))
-                self.add(table, row.keys(), row.values())
-        return None
+                             'file.'.format(file_path))
+        self.log.debug('Reading: %s', file_path)
+        return file_path
+
+    def _import_rows(self, table, header, rows, field_map=None,
+                     chunk_size=5000, progress=None):
+        """
+        The import pipeline shared by the add_* file importers. Columns are
+        resolved against the header once, then rows are remapped, added with
+        add_many() and committed chunk_size rows at a time.
+
+        Args:
+            table (str): The name of the table to add data to.
+            header (list): The column names of the source data.
+            rows (iterable): Rows of source data, as sequences of values in
+                header order.
+            field_map (dict, None): Database field to source column mapping,
+                as described in add_csv().
+            chunk_size (int): Number of rows to add and commit at a time.
+            progress (callable, None): Called after each chunk with the number
+                of rows imported so far and the elapsed seconds.
+
+        Returns (int):
+        The number of rows imported.
+        """
+        from itertools import islice
+        # Resolve the field map to column indexes once for the whole file.
+        # Columns missing from the source are imported as None.
+        if field_map:
+            fields = list(field_map)
+            columns = [field_map[f] or f for f in fields]
+        else:
+            # Columns without a name can't be matched to a field.
+            fields = [h for h in header if h]
+            columns = fields
+        positions = dict((c, i) for i, c in enumerate(header))
+        indexes = [positions.get(c) for c in columns]
+        width = len(header)
+
+        def remap(source):
+            for row in source:
+                if not row:
+                    continue
+                if len(row) < width:
+                    row = list(row) + [None] * (width - len(row))
+                yield tuple([row[i] if i is not None else None
+                             for i in indexes])
+
+        mapped = remap(rows)
+        total = 0
+        start = time.time()
+        chunk = list(islice(mapped, chunk_size))
+        while chunk:
+            self.add_many(table, fields, chunk)
+            self.save()
+            total += len(chunk)
+            elapsed = time.time() - start
+            self.log.info('Imported %s rows into %s (%.0f rows/s)', total,
+                          table, total / elapsed if elapsed else 0)
+            if progress:
+                progress(total, elapsed)
+            chunk = list(islice(mapped, chunk_size))
+        return total
+
+    def add_xlsx(self, table, xlsx_file, field_map=None, sheet=None,
+                 chunk_size=5000, progress=None):
+        """
+        Add rows to the database from a sheet of an XLSX workbook. The first
+        row of the sheet is the header. The sheet is streamed (see
+        XlsxReader), and rows are added and committed chunk_size rows at a
+        time, so memory use stays flat no matter how big the sheet is.
+
+        Args:
+            table (str): The name of the table to add data to.
+            xlsx_file (str): The path to the XLSX file containing the data.
+            field_map (dict, None): A dictionary mapping database fields
+                (key) to sheet columns (value), as described in add_csv().
+            sheet (str, int, None): The name of the sheet to import, or its
+                position (starting at 0). Defaults to the first sheet.
+            chunk_size (int): Number of rows to add and commit at a time.
+                Defaults to 5000.
+            progress (callable, None): Called after each chunk with the number
+                of rows imported so far and the elapsed seconds.
+
+        Returns (int):
+        The number of rows imported.
 
-    def add_xlsx(self, xlsx_file, field_map=None):
-        # TODO: Implement this
-        pass
+        Raises:
+            TypeError: If field_map is not a dictionary or does not contain
+                all string values.
+            ValueError: If xlsx_file does not exist, is not an XLSX file, or
+                does not have the sheet.
+        """
+        self.log.debug('add_xlsx(): %s', locals())
+        from ElephantXlsx import XlsxReader
+        xlsx_file = self._check_import(xlsx_file, field_map)
+        with XlsxReader(xlsx_file, sheet) as reader:
+            rows = reader.rows()
+            header = next((r for r in rows if any([v is not None for v in r])),
+                          None)
+            if header is None:
+                return 0
+            header = [u'' if h is None else
+                      h if isinstance(h, basestring) else unicode(h)
+                      for h in header]
+            return self._import_rows(table, header, rows, field_map,
+                                     chunk_size, progress)
 
-    def get(self, tables, fields=None, where=None, fetchall=False):
+    def get(self, tables, fields=None, where=None, fetchall=False,
+            tuples=False, iterate=False, batch_size=500, after_id=None,
+            limit=None, key=None, joins=None, params=None, order=None,
+            offset=None):
         """
         Get data from the database (without having to worry about writing a
         SQL string).
@@ -353,35 +1759,422 @@ class ElephantBrain(object):
                 using mutliple fields with the same name from different tables,
                 use the AS keyword and assign a unique alias, or the values
                 will overwrite themselves in the output.
-            where (str, list, tuple, None): If you have criteria for
+            where (str, dict, list, tuple, None): If you have criteria for
                 the WHERE clause in the SQL, add it here. Useful for joining
                 tables. For example, if you want to join tables foo and bar by
                 their id and foo fields respectively, you'd add:
                  'bar.foo=foo.id'
+                Dictionaries of field names and values ({'foo.id': 3}) are
+                bound as parameters, so repeated calls reuse the same prepared
+                statement.
             fetchall (bool): Fetch and return all rows? Defaults to False.
+            tuples (bool): Return rows as plain tuples instead of ElephantRow
+                objects. Defaults to False.
+            iterate (bool): Return a generator that streams the rows in
+                batches of batch_size, so memory use stays bounded. Defaults
+                to False.
+            batch_size (int): Number of rows to fetch at a time when
+                iterate is True. Defaults to 500.
+            after_id (int, None): For keyset pagination: only get rows whose
+                key is greater than this. Pass the key of the last row of the
+                previous page to get the next one.
+            limit (int, None): Maximum number of rows to get. If limit,
+                offset or after_id is given, rows are ordered by key.
+            key (str, None): The field used to order and page through the
+                rows. Defaults to the id of the first table (by its alias, if
+                it has one), or its rowid if it has no id. Include it in
+                fields to know where the page ended.
+            joins (list, tuple, None): Explicit joins, as (table, on) or
+                (kind, table, on) tuples, like ('Room', 'Event.Room=Room.id').
+                See QueryBuilder.select().
+            params (list, tuple, None): Values for ? placeholders in raw where
+                strings.
+            order (str, list, tuple, None): Field or fields to ORDER BY.
+                Ignored when paging, which always orders by key.
+            offset (int, None): Number of rows to skip. Prefer after_id for
+                paging through big tables, as SQLite still has to read the
+                skipped rows.
 
-        Returns (sqlite3.Cursor, list):
-        If fetchall is True, will return a list of dictionaries for each row.
-        If fetchall is False, will return a Cursor object.
+        Returns (sqlite3.Cursor, list, generator):
+        If fetchall is True, will return a list of ElephantRow objects (or
+        tuples) for each row. If iterate is True, will return a generator of
+        the rows. Otherwise, will return a Cursor object.
         """
-        self.log.debug('get(): {0}'.format(locals()))
-        # Take string params and turn them into lists.
-        if isinstance(tables, basestring):
-            tables = [tables]
-        if isinstance(fields, basestring):
-            fields = [fields]
-        if isinstance(where, basestring):
-            where = [where]
-        # Build the Query string and query
-        qry = 'SELECT {0} FROM {1}'.format(
-            ', '.join(fields) if fields else '*',
-            ', '.join(tables))
-        if where:
-            qry += ' WHERE ' + ' AND '.join(where)
+        self.log.debug('get(): %s', locals())
+        if order is not None and not isinstance(order, basestring):
+            order = ', '.join(order)
+        # Raw conditions come before dictionary ones in the WHERE clause, so
+        # the after_id value goes between their values.
+        after = []
+        extra = []
+        if after_id is not None or limit is not None or offset is not None:
+            if isinstance(tables, basestring):
+                tables = [tables]
+            order = key or self._page_key(tables[0])
+            if after_id is not None:
+                where = list(QueryBuilder._listify(where)) + \
+                    ['{0} > ?'.format(order)]
+                after.append(after_id)
+            if limit is not None or offset is not None:
+                # SQLite only takes an OFFSET after a LIMIT; -1 is no limit.
+                extra.append(limit if limit is not None else -1)
+            if offset is not None:
+                extra.append(offset)
+        qry, values = self.builder.select(
+            tables, fields, where, joins, order,
+            limit is not None or offset is not None, offset is not None)
         self.log.debug(qry)
-        return self.query(qry, fetchall=fetchall)
+        params = list(params or []) + after + values + extra
+        if fetchall and not iterate:
+            return self._read(qry, params, table_names(tables, joins), tuples)
+        cur = self.query(qry, params=params, tuples=tuples)
+        return iter_rows(cur, batch_size) if iterate else cur
+
+    def _page_key(self, table):
+        """
+        The default key for paging through a table: its id, or its rowid if
+        it doesn't have an id column.
+
+        Args:
+            table (str): The table, which may have an alias ('Event e').
+
+        Returns (str):
+        The key, qualified with the table's alias, or its name if it has no
+        alias.
+        """
+        parts = table.split()
+        columns = [r[1].lower() for r in self.query(
+            'PRAGMA table_info({0})'.format(parts[0]), tuples=True)]
+        return '{0}.{1}'.format(parts[-1], 'id' if 'id' in columns
+                                else 'rowid')
+
+    def _read(self, qry, params, tables, tuples=False):
+        """
+        Fetch all of the rows of a query, through the result cache.
+
+        Args:
+            qry (str): SQL Query string.
+            params (list): Values for the query's placeholders.
+            tables (tuple): Lower-cased names of the tables the query reads.
+            tuples (bool): Return rows as plain tuples?
+
+        Returns (list):
+        List of the query's rows.
+        """
+        if not self.cache.enabled:
+            return self.query(qry, fetchall=True, params=params,
+                              tuples=tuples)
+        key = (qry, tuple(params), tuples)
+        rows = self.cache.get(key)
+        if rows is None:
+            reads = self.cache.reads(qry)
+            if reads is None:
+                # Setting the authorizer makes SQLite prepare statements
+                # again, so it sees every table the query reads, including
+                # ones in raw where conditions and behind views.
+                self._reads.tables = set()
+                self.db.set_authorizer(self._reads)
+                try:
+                    rows = self.query(qry, fetchall=True, params=params,
+                                      tuples=tuples)
+                    reads = tuple(sorted(self._reads.tables))
+                finally:
+                    self._reads.tables = None
+                self.cache.remember_reads(qry, reads)
+            else:
+                rows = self.query(qry, fetchall=True, params=params,
+                                  tuples=tuples)
+            self.cache.put(key, tuple(sorted(set(tables) | set(reads))),
+                           rows)
+        return list(rows)
+
+    def _invalidate(self, table=None):
+        """
+        Invalidate the cached results that read a table that's being written
+        to. A write can also add to the ChangeLog, through the change
+        tracking triggers, so that's invalidated too.
+
+        Args:
+            table (str, None): The table. If it's None or not in the schema,
+                every cached result is invalidated.
+        """
+        if table is None or table.lower() not in self._tables:
+            self.cache.invalidate()
+        else:
+            self.cache.invalidate([table, 'ChangeLog'])
+
+    def explain(self, tables, fields=None, where=None, joins=None,
+                params=None):
+        """
+        Show how SQLite would run a get() call, so you can see whether it
+        uses the indexes or scans whole tables.
+
+        Args:
+            tables (str, list, tuple): Table or collection of tables, as in
+                get().
+            fields (str, list, tuple, None): Field or collection of fields, as
+                in get().
+            where (str, dict, list, tuple, None): WHERE clause criteria, as in
+                get().
+            joins (list, tuple, None): Explicit joins, as in get().
+            params (list, tuple, None): Values for ? placeholders in raw where
+                strings, as in get().
+
+        Returns (list):
+        List of the query plan's steps as strings, like
+        'SEARCH Event USING INDEX idx_Event_Room (Room=?)' or 'SCAN Site'.
+        """
+        self.log.debug('explain(): %s', locals())
+        qry, values = self.builder.select(tables, fields, where, joins)
+        return [r['detail']
+                for r in self.query('EXPLAIN QUERY PLAN ' + qry,
+                                    params=list(params or []) + values,
+                                    fetchall=True)]
+
+    def add_indexes(self, names=None):
+        """
+        Add indexes from the default index set to the database. Useful for
+        bringing older files up to date.
+
+        Args:
+            names (str, list, tuple, None): Index or collection of indexes to
+                add. If None, adds all of the indexes in self.indexes.
+
+        Returns (list):
+        List of the index names that were added.
+
+        Raises:
+            ValueError: If an index name is not in self.indexes.
+        """
+        self.log.debug('add_indexes(): %s', locals())
+        names = self._index_names(names)
+        for name in names:
+            self.log.debug('Creating %s index...', name)
+            self.query(self.indexes[name])
+        self.save()
+        return names
+
+    def drop_indexes(self, names=None):
+        """
+        Drop indexes from the database.
+
+        Args:
+            names (str, list, tuple, None): Index or collection of indexes to
+                drop. If None, drops all of the indexes in self.indexes.
+
+        Returns (list):
+        List of the index names that were dropped.
+
+        Raises:
+            ValueError: If an index name is not in self.indexes.
+        """
+        self.log.debug('drop_indexes(): %s', locals())
+        names = self._index_names(names)
+        for name in names:
+            self.log.debug('Dropping %s index...', name)
+            self.query('DROP INDEX IF EXISTS {0}'.format(name))
+        self.save()
+        return names
+
+    @classmethod
+    def change_tracking_sql(cls):
+        """
+        The statements that turn on change tracking: the change_schema tables
+        and a trigger for each action on each data table.
+
+        Returns (list):
+        List of SQL strings.
+        """
+        statements = [cls.change_schema[t] for t in sorted(cls.change_schema)]
+        for table in cls.data_tables:
+            for action, row in cls.change_actions:
+                statements.append(
+                    'CREATE TRIGGER IF NOT EXISTS trg_{0}_{1} AFTER {2} ON {0} '
+                    'BEGIN INSERT INTO ChangeLog(TableName, RowId, Action) '
+                    'VALUES (\'{0}\', {3}.id, \'{1}\'); END;'.format(
+                        table, action, action.upper(), row))
+        return statements
+
+    @property
+    def tracking(self):
+        """
+        Are changes to the data tables being recorded in the ChangeLog?
 
-    def update(self, table, fields, values, where):
+        Returns (bool):
+        True if every change tracking trigger is in place, False if not.
+        """
+        triggers = set([r[0] for r in self.query(
+            'SELECT name FROM sqlite_master WHERE type=\'trigger\'',
+            tuples=True)])
+        return all(['trg_{0}_{1}'.format(t, a) in triggers
+                    for t in self.data_tables
+                    for a, _ in self.change_actions])
+
+    def track_changes(self, on=True):
+        """
+        Turn change tracking on or off. New files don't track changes, since
+        the triggers roughly double the cost of writing. Turning it on adds
+        the change_schema tables and triggers. Turning it off drops the
+        triggers, but keeps the ChangeLog. Either way, the ReportLog is
+        cleared, since changes made while tracking was off aren't in the
+        ChangeLog, so every report has to be rebuilt.
+
+        Args:
+            on (bool): True to track changes, False to stop. Defaults to True.
+
+        Returns (bool):
+        True if changes are now being tracked, False if not.
+        """
+        self.log.debug('track_changes(): %s', locals())
+        switched = bool(on) != self.tracking
+        if on:
+            for qry in self.change_tracking_sql():
+                self.query(qry)
+        else:
+            for table in self.data_tables:
+                for action, _ in self.change_actions:
+                    self.query('DROP TRIGGER IF EXISTS trg_{0}_{1}'.format(
+                        table, action))
+        if switched:
+            self.query(self.change_schema['ReportLog'])
+            self.query('DELETE FROM ReportLog')
+        self.save()
+        return self.tracking
+
+    def last_change(self):
+        """
+        The id of the latest change in the ChangeLog.
+
+        Returns (int, None):
+        The latest change id, 0 if nothing has changed yet, or None if the
+        file has no ChangeLog.
+        """
+        try:
+            return self.query('SELECT MAX(id) FROM ChangeLog',
+                              tuples=True).fetchone()[0] or 0
+        except sqlite3.OperationalError as e:
+            self.log.debug('Reading the ChangeLog: %s', e)
+            return None
+
+    def changes(self, since=0, tables=None):
+        """
+        The rows that have changed since a point in the ChangeLog. The
+        ChangeLog is written by triggers, so this always reads it directly
+        rather than through the result cache.
+
+        Args:
+            since (int): Only count changes after this change id. Defaults to
+                0 (every change).
+            tables (str, list, tuple, None): Only count changes to these
+                tables. Defaults to every table.
+
+        Returns (dict):
+        Dictionary of table names and sets of the ids of their rows that
+        were added, changed or deleted. Empty if the file has no ChangeLog.
+        """
+        self.log.debug('changes(): %s', locals())
+        where = ['id>?']
+        params = [since]
+        if tables is not None:
+            tables = QueryBuilder._listify(tables)
+            where.append('TableName IN ({0})'.format(
+                ', '.join(['?'] * len(tables))))
+            params.extend(tables)
+        found = {}
+        try:
+            rows = self.query(
+                'SELECT TableName, RowId FROM ChangeLog WHERE {0}'.format(
+                    ' AND '.join(where)), params=params, tuples=True)
+        except sqlite3.OperationalError as e:
+            self.log.debug('Reading the ChangeLog: %s', e)
+            return found
+        for table, row_id in rows:
+            found.setdefault(table, set()).add(row_id)
+        return found
+
+    def prune_changes(self):
+        """
+        Delete the ChangeLog entries that no report needs any more: the ones
+        older than the oldest change a report in the ReportLog last ran
+        against, or every entry but the latest if no report has run. The
+        latest change is always kept, so last_change() doesn't go
+        backwards. log_reports() calls this.
+
+        Returns (int):
+        The number of entries deleted (0 if the file has no ChangeLog).
+        """
+        self.log.debug('prune_changes()')
+        if self.last_change() is None:
+            return 0
+        self.query(self.change_schema['ReportLog'])
+        cur = self.query(
+            'DELETE FROM ChangeLog WHERE id<COALESCE('
+            '(SELECT MIN(ChangeId) FROM ReportLog), '
+            '(SELECT MAX(id) FROM ChangeLog))')
+        self.log.debug('Pruned %s changes.', cur.rowcount)
+        return max(cur.rowcount, 0)
+
+    def report_log(self):
+        """
+        When each report was last run, from the ReportLog.
+
+        Returns (dict):
+        Dictionary of report names and ElephantRows of their ChangeId (the
+        latest change when they ran), Output (the path they were written
+        to, or None) and Ran. Empty if the file has no ReportLog.
+        """
+        try:
+            return dict([(r['Report'], r) for r in self.query(
+                'SELECT Report, ChangeId, Output, Ran FROM ReportLog',
+                fetchall=True)])
+        except sqlite3.OperationalError as e:
+            self.log.debug('Reading the ReportLog: %s', e)
+            return {}
+
+    def log_reports(self, reports):
+        """
+        Record reports that have been run in the ReportLog, prune the
+        ChangeLog entries no report needs any more, and save.
+
+        Args:
+            reports (list): Tuples of (report name, the latest change id when
+                it ran, the path it was written to or None).
+        """
+        self.log.debug('log_reports(): %s', reports)
+        with self.transaction():
+            self.query(self.change_schema['ReportLog'])
+            self._cursor().executemany(
+                'INSERT OR REPLACE INTO ReportLog(Report, ChangeId, Output, '
+                'Ran) VALUES (?, ?, ?, datetime(\'now\'))', reports)
+            self._invalidate('ReportLog')
+            self.prune_changes()
+
+    def _index_names(self, names):
+        """
+        Check a collection of index names against the default index set.
+
+        Args:
+            names (str, list, tuple, None): Index or collection of indexes. If
+                None, all of the indexes in self.indexes.
+
+        Returns (list):
+        List of index names.
+
+        Raises:
+            ValueError: If an index name is not in self.indexes.
+        """
+        if names is None:
+            return sorted(self.indexes)
+        if isinstance(names, basestring):
+            names = [names]
+        unknown = [n for n in names if n not in self.indexes]
+        if unknown:
+            raise ValueError('Unknown index: {0}. Valid options are: '
+                             '{1}'.format(', '.join(unknown),
+                                          ', '.join(sorted(self.indexes))))
+        return list(names)
+
+    def update(self, table, fields, values, where, params=None):
         """
         Perform an update of a row in a table.
 
@@ -392,89 +2185,391 @@ class ElephantBrain(object):
                 in values.
             values (str, list, tuple): The list of values present int he
                 data. The index of a value should match the index of its field
-                in the fields.
-            where (str, list, tuple): The list of where conditions used to
-                identify the row to update.
+                in the fields. Values are bound as parameters.
+            where (str, dict, list, tuple): The list of where conditions used
+                to identify the row to update. Dictionaries of field names and
+                values are bound as parameters, as in get().
+            params (list, tuple, None): Values for ? placeholders in raw where
+                strings.
 
         Returns (sqlite3.Cursor):
         A Cursor object pointing to the query.
         """
-        self.log.debug('update(): {0}'.format(locals()))
+        self.log.debug('update(): %s', locals())
         # Convert strings to list.
-        if isinstance(fields, basestring):
-            fields = [fields]
         if isinstance(values, basestring):
             values = [values]
-        if isinstance(where, basestring):
-            where = [where]
         # Build the Query string and query
-        qry = 'UPDATE {0} SET {1} WHERE {2};'.format(
-            table,
-            ','.join(
-                ['{0}=\'{1}\''.format(f, v) for f, v in zip(fields, values)]
-            ),
-            ' AND '.join(where))
+        qry, where_values = self.builder.update(table, fields, where)
         self.log.debug(qry)
-        return self.query(qry)
+        return self.query(
+            qry, params=list(values) + list(params or []) + where_values)
 
-    def delete(self, table, where):
+    def delete(self, table, where, params=None):
         """
         Delete a row or rows from a table.
 
         Args:
             table (str): Name of the table to delete rows from.
-            where (str, list, tuple): List of the where conditions used to
-                identify the row or rows to be deleted.
+            where (str, dict, list, tuple): List of the where conditions used
+                to identify the row or rows to be deleted. Dictionaries of
+                field names and values are bound as parameters, as in get().
+            params (list, tuple, None): Values for ? placeholders in raw where
+                strings.
 
         Returns (sqlite3.Cursor):
         A Cursor object pointing to the query.
         """
-        self.log.debug('delete(): {0}'.format(locals()))
-        if isinstance(where, basestring):
-            where = [where]
+        self.log.debug('delete(): %s', locals())
         # Build the Query string and query
-        qry = 'DELETE FROM {0} WHERE {1};'.format(
-            table, ' AND '.join(where))
-        return self.query(qry)
+        qry, where_values = self.builder.delete(table, where)
+        self.log.debug(qry)
+        return self.query(qry, params=list(params or []) + where_values)
+
+    def update_many(self, table, fields, rows, keys='id'):
+        """
+        Update many rows of a table with a single parameterized statement,
+        run with executemany() in one transaction. If any row fails, none of
+        them are updated. The changes are saved when it's done, unless there
+        were already unsaved changes or it's inside a transaction() block.
+
+        Args:
+            table (str): Table to update.
+            fields (str, list, tuple): The fields to set.
+            rows (iterable): Row tuples of the new values for fields, followed
+                by the values of keys that identify the row to update.
+            keys (str, list, tuple): The field or fields that identify each
+                row. Defaults to 'id'.
+
+        Returns (int):
+        The number of rows updated.
+        """
+        self.log.debug('update_many(): %s, %s, %s', table, fields, keys)
+        qry, _ = self.builder.update(table, fields, [
+            '{0}=?'.format(k) for k in QueryBuilder._listify(keys)])
+        return self._execute_many(table, qry, rows)
+
+    def delete_many(self, table, rows, keys='id'):
+        """
+        Delete many rows from a table with a single parameterized statement,
+        run with executemany() in one transaction. If any row fails, none of
+        them are deleted. The changes are saved when it's done, unless there
+        were already unsaved changes or it's inside a transaction() block.
+
+        Args:
+            table (str): Name of the table to delete rows from.
+            rows (iterable): The values of keys that identify each row to
+                delete, as tuples. With a single key, plain values work too.
+            keys (str, list, tuple): The field or fields that identify each
+                row. Defaults to 'id'.
 
-    def query(self, qry, fetchall=False):
+        Returns (int):
+        The number of rows deleted.
+        """
+        self.log.debug('delete_many(): %s, %s', table, keys)
+        keys = QueryBuilder._listify(keys)
+        qry, _ = self.builder.delete(table, ['{0}=?'.format(k) for k in keys])
+        if len(keys) == 1:
+            rows = (r if isinstance(r, (list, tuple)) else (r,) for r in rows)
+        return self._execute_many(table, qry, rows)
+
+    def _execute_many(self, table, qry, rows):
+        """
+        Run a write statement once for each row of parameters, atomically.
+
+        Args:
+            table (str): The table the statement writes to.
+            qry (str): SQL Query string.
+            rows (iterable): Parameter tuples.
+
+        Returns (int):
+        The number of rows changed.
+        """
+        self.log.debug(qry)
+        self._invalidate(table)
+        cur = self._cursor()
+        with self.transaction():
+            cur.executemany(qry, rows)
+            self._wrote(cur.rowcount)
+        return cur.rowcount
+
+    def profile_queries(self, on=True, slow=None):
+        """
+        Turn the query profiler on or off. See QueryProfiler; the statistics
+        are in self.profiler.stats.
+
+        Args:
+            on (bool): Turn it on? Defaults to True. Turning it off keeps the
+                statistics collected so far.
+            slow (float, None): When turning it on, log statements that take
+                at least this many seconds, with their query plans. None
+                logs none of them.
+
+        Raises:
+            ValueError: If slow is negative.
+        """
+        self.log.debug('profile_queries(): %s', locals())
+        if on:
+            if slow is not None and slow < 0:
+                raise ValueError('slow must be at least 0, not {0}.'.format(
+                    slow))
+            self.profiler.slow = slow
+            self.db.set_progress_handler(self.profiler.step,
+                                         self.profiler.step_interval)
+        else:
+            self.db.set_progress_handler(None, 0)
+        self.profiler.enabled = on
+
+    def _cursor(self):
+        """
+        A new cursor, which records what it runs in the profiler if the
+        profiler is on.
+
+        Returns (sqlite3.Cursor):
+        The cursor.
+        """
+        if not self.profiler.enabled:
+            return self.db.cursor()
+        cur = self.db.cursor(ProfiledCursor)
+        cur.profiler = self.profiler
+        return cur
+
+    def query(self, qry, fetchall=False, params=None, tuples=False):
         """
         Send a raw query to the database. add(), get() and others use this.
+        Statements that write to a table invalidate its cached results, and
+        start a transaction if one isn't open. VACUUM, ATTACH and DETACH
+        can't run in a transaction, so unsaved changes are saved first.
+        BEGIN, COMMIT (or END) and ROLLBACK are run as _begin(), save() and
+        rollback(), so the ElephantBrain keeps track of the transaction.
 
         Args:
             qry (str): SQL Query string.
             fetchall (bool): Fetch and return all rows? Defaults to False.
+            params (list, tuple, dict, None): Values for any ? (or :name)
+                placeholders in the query. Defaults to None.
+            tuples (bool): Return rows as plain tuples instead of ElephantRow
+                objects. Fastest for bulk consumers, like reports and
+                exports. Defaults to False.
 
         Returns (sqlite3.Cursor, list):
-        If fetchall is True, will return a list of dictionaries for each row.
-        If fetchall is False, will return a Cursor object.
+        If fetchall is True, will return a list of ElephantRow objects (or
+        tuples) for each row. If fetchall is False, will return a Cursor
+        object.
+
+        Raises:
+            ValueError: For VACUUM, ATTACH, DETACH or ROLLBACK inside a
+                transaction() block.
         """
-        self.log.debug('query(): {0}'.format(locals()))
-        cur = self.db.cursor()
-        new_cur = cur.execute(qry)
+        self.log.debug('query(): %s', locals())
+        control = TRANSACTION_RE.match(qry)
+        if control:
+            action = control.group(1).upper()
+            if action == 'BEGIN':
+                self._begin()
+            elif action == 'ROLLBACK':
+                self.rollback()
+            else:
+                self.save()
+            return [] if fetchall else self._cursor()
+        if NO_TRANSACTION_RE.match(qry):
+            # SQLite won't run these in a transaction, so save first, like
+            # the sqlite3 module does on its own.
+            if self._depth:
+                raise ValueError('Can\'t run {0} inside a transaction() '
+                                 'block.'.format(qry.split()[0].upper()))
+            self.save()
+            self.cache.invalidate()
+        write = writes(qry)
+        if write:
+            # Writes make the cached results of their table stale. If we
+            # can't tell which table a statement changes, they all are.
+            written = WRITE_RE.match(qry)
+            self._invalidate(written.group(1) if written else None)
+            self._begin()
+        cur = self._cursor()
+        if tuples:
+            cur.row_factory = None
+        new_cur = cur.execute(qry, params) if params is not None \
+            else cur.execute(qry)
+        if write:
+            self._wrote(new_cur.rowcount)
         return new_cur if not fetchall else new_cur.fetchall()
 
+    def _begin(self):
+        """
+        Start a transaction for the next write, if one isn't already open.
+        Writes are grouped into one transaction until save(), so there's one
+        fsync per save rather than one per statement.
+        """
+        if not self._open:
+            self.db.execute('BEGIN')
+            self._open = True
+
+    def _commit(self):
+        """
+        Commit the open transaction, if there is one.
+        """
+        if self._open:
+            self.db.execute('COMMIT')
+            self._open = False
+        self._pending = 0
+        self._pending_since = None
+
+    def _wrote(self, rows):
+        """
+        Count rows written since the last save, and save if autosave says
+        it's time. Nothing is saved inside a transaction() block.
+
+        Args:
+            rows (int): Number of rows the statement wrote (-1 if unknown).
+        """
+        self._pending += max(rows, 0)
+        if self._pending_since is None:
+            self._pending_since = time.time()
+        if self._depth:
+            return
+        if (self.autosave_rows and self._pending >= self.autosave_rows) or \
+                (self.autosave_seconds is not None and time.time() -
+                 self._pending_since >= self.autosave_seconds):
+            self.log.debug('Autosaving %s rows.', self._pending)
+            self.save()
+
+    def autosave(self, rows=None, seconds=None):
+        """
+        Turn autosave on or off. With autosave on, changes are saved in
+        groups: after a write brings the number of rows written since the
+        last save up to rows, or on the first write seconds after it. There's
+        no timer, so an idle session holds its changes until the next write,
+        save() or close. With both None, autosave is off and changes are only
+        saved by save().
+
+        Args:
+            rows (int, None): Save after this many rows.
+            seconds (float, None): Save on the first write this many seconds
+                after the last save.
+
+        Raises:
+            ValueError: If rows or seconds isn't positive.
+        """
+        if (rows is not None and rows < 1) or \
+                (seconds is not None and seconds < 0):
+            raise ValueError('Autosave rows must be at least 1, and seconds '
+                             'at least 0.')
+        self.autosave_rows = rows
+        self.autosave_seconds = seconds
+
+    @contextmanager
+    def transaction(self):
+        """
+        Context manager that makes a block of changes atomic. If the block
+        raises an exception, every change made in it is rolled back and the
+        exception is raised again. Blocks can be nested (each one is a
+        SAVEPOINT): an inner block that fails only undoes its own changes.
+        When the outermost block finishes, it's saved if there were no
+        unsaved changes before it. Otherwise its changes join them, to be
+        saved (or rolled back) with them. save() and autosave do nothing
+        inside a block.
+
+            with eb.transaction():
+                eb.add_csv('Room', 'rooms.csv')
+                eb.add_csv('Event', 'events.csv')
+
+        Returns (ElephantBrain):
+        This ElephantBrain.
+        """
+        started = not self._open
+        try:
+            with self._savepoint():
+                yield self
+        except BaseException:
+            if started and not self._depth:
+                # Nothing else was in the transaction, so end it.
+                self.rollback()
+            raise
+        if not self._depth:
+            if started:
+                self.save()
+            else:
+                self._wrote(0)
+
+    @contextmanager
+    def _savepoint(self):
+        """
+        Context manager that makes a block of changes atomic inside the open
+        transaction (starting one if there isn't one), without saving
+        anything. If the block raises an exception, its changes are rolled
+        back and the exception is raised again.
+
+        Returns (ElephantBrain):
+        This ElephantBrain.
+        """
+        name = 'elephant_{0}'.format(self._depth)
+        pending = self._pending
+        self._begin()
+        self.db.execute('SAVEPOINT {0}'.format(name))
+        self._depth += 1
+        try:
+            yield self
+        except BaseException:
+            self._depth -= 1
+            self.log.debug('Rolling back %s.', name)
+            self.db.execute('ROLLBACK TO {0}'.format(name))
+            self.db.execute('RELEASE {0}'.format(name))
+            self._pending = pending
+            # Results cached inside the block may show rolled back rows.
+            self.cache.invalidate()
+            raise
+        self._depth -= 1
+        self.db.execute('RELEASE {0}'.format(name))
+
+    def rollback(self):
+        """
+        Throw away every change made since the last save.
+
+        Raises:
+            ValueError: Inside a transaction() block, which rolls itself back
+                if it fails.
+        """
+        self.log.debug('rollback()')
+        if self._depth:
+            raise ValueError('Can\'t roll back inside a transaction() block. '
+                             'Raise an exception to roll the block back.')
+        if self._open:
+            self.db.execute('ROLLBACK')
+            self._open = False
+        self._pending = 0
+        self._pending_since = None
+        self.cache.invalidate()
+
     def save(self):
         """
-        Commit all changes to the current database.
+        Commit all changes to the current database. Inside a transaction()
+        block this does nothing; the block saves when it finishes.
 
         Returns (bool):
         True if successful, False if not.
         """
         self.log.debug('save()')
+        if self._depth:
+            return True
         try:
-            self.db.commit()
+            self._commit()
             return True
         except (sqlite3.Error, sqlite3.DatabaseError) as e:
-            self.log.error('Error saving: {0}'.format(e))
+            self.log.error('Error saving: %s', e)
             return False
 
 
 if __name__ == '__main__':
     from pprint import pformat
 
+    import ElephantLog
+
+    ElephantLog.init_log()
     eb = ElephantBrain('test.elephant', new=True)
     print(eb._validate_db())
+    eb.track_changes()
     # Test adding some data to the Metadata
     eb.add('Metadata',
            ['Name', 'Value'],
@@ -499,7 +2594,7 @@ if __name__ == '__main__':
     eb.update('Equipment',
               ['Name', 'ShortName'],
               ['ThatIsATest', 'TIAT'],
-              'Name=\'ThisIsATest\'')
+              {'Name': 'ThisIsATest'})
     print(pformat(eb.get('Equipment', fetchall=True)))
     eb.delete('Equipment',
               ['Name=\'ThatIsATest\'',
@@ -526,8 +2621,12 @@ if __name__ == '__main__':
     eb.add('EquipmentAssign',
            ['Event', 'Piece', 'Quantity'],
            [1, 2, 5])
-    # Print out info.
+    # Move every assignment of piece 1 to piece 2, in one statement.
+    print('Reassigned {0} rows.'.format(eb.update_many(
+        'EquipmentAssign', ['Piece'], [(2, 1)], keys='Piece')))
+    # Print out info, and the rows changed so far.
     print(eb.info)
+    print('\nChanges:\n{0}'.format(pformat(eb.changes())))
     # Get and print the events with their associated details.
     events = eb.get(
         ['Event', 'Room', 'People', 'Site'],
@@ -543,6 +2642,11 @@ if __name__ == '__main__':
                'Event.Speaker=People.id']
     )
     print('\nEvents:\n{0}'.format(pformat(events.fetchall())))
+    print('\nEvents query plan:\n{0}'.format(pformat(eb.explain(
+        ['Event', 'Room', 'People', 'Site'],
+        where=['Room.Site=Site.id',
+               'Event.Room=Room.id',
+               'Event.Speaker=People.id']))))
     # Get and print the assignments with their associated details.
     assigns = eb.get(
         ['Event', 'Room', 'Site', 'Equipment', 'EquipmentAssign'],
@@ -560,6 +2664,19 @@ if __name__ == '__main__':
     )
     print('\nEquipment Assignments:\n{0}'.format(
         pformat(assigns.fetchall())))
+    # The same join with explicit JOINs and a bound value, profiled.
+    eb.profile_queries()
+    for site in ['Site A', 'Site B']:
+        print('\nEvents at {0}:\n{1}'.format(site, pformat(eb.get(
+            'Event',
+            fields=['Room.Name AS Room', 'Event.Name', 'Event.Start'],
+            joins=[('Room', 'Event.Room=Room.id'),
+                   ('Site', 'Room.Site=Site.id')],
+            where={'Site.Name': site},
+            fetchall=True))))
+    eb.profile_queries(False)
+    print('\nProfile:\n{0}'.format(pformat(eb.profiler.stats)))
+    print('\n{0}'.format(eb.builder))
     # Print the equipment table
     print('\nEquipment:\n{0}'.format(
         pformat(eb.get('Equipment', fetchall=True))))
@@ -1,16 +1,265 @@
+import atexit
 import glob
 import logging
 import os
+import sys
+import threading
+import time
 
+from collections import deque
 from logging.handlers import RotatingFileHandler
 
 
 LOG_FILENAME = 'Elephant.log'
+# The modules that log under the Elephant logger, each with its own child
+# logger whose level can be set separately.
+SUBSYSTEMS = ('ElephantBrain', 'ElephantTrunk', 'ElephantTusk', 'ElephantXlsx')
 
 
-def init_log(log_level='debug', file_level='debug', console_level='warn'):
+class QueueListener(object):
     """
-    Initialize the main logging instance and setup the handlers.
+    Passes log records from a queue to its handlers on a background thread,
+    so the code doing the logging doesn't wait on file writes. Python 2's
+    logging doesn't have one of these.
+
+    The thread wakes up every interval seconds and handles everything queued
+    since, rather than being woken for each record, which would have the two
+    threads trading the GIL on every log call.
+
+    Fields:
+        handlers (tuple): The handlers records are passed to.
+        queue (collections.deque): Records waiting to be handled.
+        interval (float): Seconds between handling what's queued.
+        pid (int): The id of the process the thread runs in.
+        thread (threading.Thread, None): The background thread, or None if
+            it isn't running.
+    """
+    def __init__(self, *handlers, **kwargs):
+        """
+        Prepare a listener for use. Call start() to start handling records.
+
+        Args:
+            *handlers (logging.Handler): The handlers to pass records to.
+            interval (float): Seconds between handling what's queued.
+                Defaults to 0.1.
+        """
+        self.handlers = handlers
+        self.queue = deque()
+        self.interval = kwargs.get('interval', 0.1)
+        self.pid = os.getpid()
+        self.thread = None
+        self._lock = threading.Lock()
+        self._forked = None
+
+    def __repr__(self):
+        return 'QueueListener ({0} waiting)'.format(len(self.queue))
+
+    def start(self):
+        """
+        Start handling records on a background thread.
+        """
+        self.thread = threading.Thread(target=self._monitor,
+                                       name='ElephantLog')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop the background thread, and handle whatever is still queued.
+        """
+        # Handle the rest here rather than waiting for the thread to wake.
+        self.thread = None
+        self.flush()
+
+    def enqueue(self, record):
+        """
+        Queue a record to be handled.
+
+        Args:
+            record (logging.LogRecord): The record.
+        """
+        if os.getpid() != self.pid:
+            # A forked process (like a report worker) doesn't have the
+            # background thread, so handle the record straight away. The
+            # thread might have held a handler's lock when the process was
+            # forked, so give the handlers new ones first.
+            if self._forked != os.getpid():
+                self._forked = os.getpid()
+                for handler in self.handlers:
+                    handler.createLock()
+            self.handle(record)
+        else:
+            self.queue.append(record)
+
+    def handle(self, record):
+        """
+        Pass a record to each handler whose level it meets.
+
+        Args:
+            record (logging.LogRecord): The record.
+        """
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def flush(self):
+        """
+        Handle everything queued so far.
+        """
+        with self._lock:
+            while self.queue:
+                self.handle(self.queue.popleft())
+
+    def _monitor(self):
+        thread = self.thread
+        while True:
+            time.sleep(self.interval)
+            if self.thread is not thread:
+                break
+            self.flush()
+
+
+class QueueHandler(logging.Handler):
+    """
+    Hands log records to a QueueListener. The message is merged with its
+    arguments before it's queued, since they might change once the caller
+    carries on, but the formatting and writing happen on the listener's
+    thread.
+    """
+    def __init__(self, listener):
+        """
+        Prepare a handler for use.
+
+        Args:
+            listener (QueueListener): The listener to hand records to.
+        """
+        logging.Handler.__init__(self)
+        self.listener = listener
+
+    def prepare(self, record):
+        """
+        Make a record safe to handle later, on another thread.
+
+        Args:
+            record (logging.LogRecord): The record.
+
+        Returns (logging.LogRecord):
+        The record, with its message merged and any exception formatted.
+        """
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            self.listener.enqueue(self.prepare(record))
+        except Exception:
+            self.handleError(record)
+
+
+def level_number(level):
+    """
+    Look up a logging level by name.
+
+    Args:
+        level (str): The level name, like 'debug' or 'WARN'.
+
+    Returns (int):
+    The logging level.
+
+    Raises:
+        ValueError: If there's no level with that name.
+    """
+    number = getattr(logging, str(level).upper(), None)
+    if not isinstance(number, int):
+        raise ValueError('Unknown log level {0}. Valid options are: debug, '
+                         'info, warn, error, critical'.format(level))
+    return number
+
+
+def set_levels(levels):
+    """
+    Set the levels of the subsystem loggers, so that one can be made quieter
+    (or louder) than the rest. Messages below a logger's level are dropped
+    before they're formatted, so setting ElephantBrain to info skips the
+    logging of every add() and query() call.
+
+    Args:
+        levels (dict): Level names by subsystem, like
+            {'ElephantBrain': 'info'}. A level of None makes the subsystem
+            follow the Elephant logger again.
+
+    Returns (dict):
+    The levels the subsystems had before, as names or None, to pass back to
+    set_levels() to undo the change.
+
+    Raises:
+        ValueError: If a subsystem or level isn't known.
+    """
+    unknown = [s for s in levels if s not in SUBSYSTEMS]
+    if unknown:
+        raise ValueError('Unknown subsystems: {0}. Valid options are: '
+                         '{1}'.format(', '.join(unknown),
+                                      ', '.join(SUBSYSTEMS)))
+    numbers = dict([(s, logging.NOTSET if l is None else level_number(l))
+                    for s, l in levels.items()])
+    before = {}
+    for subsystem, number in numbers.items():
+        log = logging.getLogger('Elephant.' + subsystem)
+        before[subsystem] = logging.getLevelName(log.level).lower() \
+            if log.level else None
+        log.setLevel(number)
+    return before
+
+
+def get_levels():
+    """
+    The effective level of each subsystem logger.
+
+    Returns (dict):
+    Level names by subsystem.
+    """
+    return dict([(s, logging.getLevelName(logging.getLogger(
+        'Elephant.' + s).getEffectiveLevel()).lower()) for s in SUBSYSTEMS])
+
+
+def _all_handlers(log):
+    """
+    The handlers of a logger, including the ones behind QueueHandlers.
+    """
+    for handler in log.handlers:
+        if isinstance(handler, QueueHandler):
+            for queued in handler.listener.handlers:
+                yield queued
+        else:
+            yield handler
+
+
+def init_log(log_level='debug', file_level='debug', console_level='warn',
+             levels=None, background=True):
+    """
+    Initialize the main logging instance and setup the handlers. Call this
+    once from an entry point (a script's __main__ block), not when a module
+    is imported: it clears out the old log files and opens a new one. Calling
+    it again only sets the levels.
+
+    Notes about setting up the handlers go to stderr, so they don't mix with
+    output on stdout.
+
+    Args:
+        log_level (str): The level of the Elephant logger. Defaults to debug.
+        file_level (str): The level of the Elephant.log handler. Defaults to
+            debug.
+        console_level (str): The level of the console handler. Defaults to
+            warn.
+        levels (dict, None): Levels for subsystems, as for set_levels().
+        background (bool): Write Elephant.log from a background thread, so
+            logging doesn't wait on the disk. Defaults to True. The console
+            handler always writes straight away.
 
     Returns (logging.Logger):
     The Logger instance for the main logger named 'Elephant'.
@@ -21,44 +270,64 @@ def init_log(log_level='debug', file_level='debug', console_level='warn'):
                  if hasattr(logging, log_level.upper())
                  else logging.DEBUG)
     fmt = logging.Formatter('%(asctime)s %(levelname)s %(message)s')
+    # The format doesn't use the caller's file and line, or the thread and
+    # process, so don't look them up for every record. (This is what the
+    # comment on _srcfile in the logging module suggests.)
+    logging._srcfile = None
+    logging.logThreads = 0
+    logging.logProcesses = 0
+    logging.logMultiprocessing = 0
+    if levels:
+        set_levels(levels)
 
     # Console handler
     # Add it if and only if it does not already appear to exist.
     if 'StreamHandler' not in [h.__class__.__name__ for h in log.handlers]:
-        print('Adding Console Handler')
+        sys.stderr.write('Adding Console Handler\n')
         cns = logging.StreamHandler()
         cns.setLevel(getattr(logging, console_level.upper())
                      if hasattr(logging, console_level.upper())
                      else logging.WARN)
         cns.setFormatter(fmt)
         log.addHandler(cns)
-        log.debug('Added console handler at level {0}'.format(
-            log.getEffectiveLevel()))
+        log.debug('Added console handler at level %s',
+                  log.getEffectiveLevel())
 
         # Rotating File handler
         # Add it if and only if it does nto appear to exist.
         if os.path.abspath(LOG_FILENAME) not in \
                 [h.baseFilename
-                 for h in log.handlers
+                 for h in _all_handlers(log)
                  if h.__class__.__name__ == 'RotatingFileHandler']:
-            print('Adding Rotating Log File Handler')
+            sys.stderr.write('Adding Rotating Log File Handler\n')
             # Delete existing files
             for log_file in glob.glob(
                     os.path.abspath(LOG_FILENAME).replace('.log', '*.log')):
                 try:
                     os.remove(log_file)
-                    print('Deleted: {0}'.format(log_file))
+                    sys.stderr.write('Deleted: {0}\n'.format(log_file))
                 except Exception as e:
-                    print('ERROR deleting {0}: {1}'.format(log_file, e))
+                    sys.stderr.write('ERROR deleting {0}: {1}\n'.format(
+                        log_file, e))
             fle = RotatingFileHandler(LOG_FILENAME, mode='w',
                                       maxBytes='1000000', backupCount=5)
             fle.setLevel(getattr(logging, file_level.upper())
                          if hasattr(logging, file_level.upper())
                          else logging.DEBUG)
             fle.setFormatter(fmt)
-            log.addHandler(fle)
-            log.debug(
-                'Added RotatingFileHandler for Elephant.log at level {0}'.format(
-                    log.getEffectiveLevel()))
+            if background:
+                listener = QueueListener(fle)
+                listener.start()
+                # Write out whatever is still queued when Python exits.
+                atexit.register(listener.stop)
+                queued = QueueHandler(listener)
+                # Drop what the file won't take before it's queued.
+                queued.setLevel(fle.level)
+                log.addHandler(queued)
+            else:
+                log.addHandler(fle)
+            log.debug('Added RotatingFileHandler for Elephant.log at level '
+                      '%s%s', log.getEffectiveLevel(),
+                      ', in the background' if background else '')
 
     return log
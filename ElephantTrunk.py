@@ -1,63 +1,1037 @@
+import ast
+import csv
 import glob
 import importlib
-import inspect
+import json
 import logging
+import multiprocessing
 import os
+import re
+import sys
+import time
+import traceback
 
-import ElephantLog
+from collections import OrderedDict
+from itertools import chain, islice
 
 
-ElephantLog.init_log()
+# The get() arguments a report query can use.
+QUERY_ARGS = ('tables', 'fields', 'where', 'joins', 'order', 'params')
+AS_RE = re.compile(r'\s+AS\s+(\w+)\s*$', re.I)
+
+
+def column_name(field):
+    """
+    The name SQLite gives the column for a field expression.
+
+    Args:
+        field (str): A field expression, like 'Name', 'Event.Name' or
+            'Site.Name AS Site'.
+
+    Returns (str):
+    The column name, like 'Name', 'Name' or 'Site'.
+    """
+    alias = AS_RE.search(field)
+    if alias:
+        return alias.group(1)
+    if re.match(r'^\w+\.\w+$', field.strip()):
+        return field.strip().split('.')[1]
+    return field.strip()
+
+
+def query_shape(spec):
+    """
+    Everything about a report query except its fields, in a hashable form.
+    Queries with the same shape read the same rows.
+
+    Args:
+        spec (dict): The query's get() arguments.
+
+    Returns (tuple):
+    The query's shape.
+
+    Raises:
+        ValueError: If the query uses arguments get() can't share.
+    """
+    from ElephantBrain import QueryBuilder
+    unknown = [k for k in spec if k not in QUERY_ARGS]
+    if unknown:
+        raise ValueError('Report queries can\'t use: {0}'.format(
+            ', '.join(unknown)))
+    listify = QueryBuilder._listify
+    where_shape, where_values = QueryBuilder._where(spec.get('where'))
+    order = spec.get('order')
+    return (tuple([t.lower() for t in listify(spec.get('tables'))]),
+            tuple([tuple(j) for j in spec.get('joins') or ()]),
+            where_shape, tuple(where_values),
+            tuple(spec.get('params') or ()),
+            order if order is None or isinstance(order, basestring)
+            else tuple(order))
+
+
+def plan_queries(declared):
+    """
+    Merge the queries declared by a batch of reports, so each unique query
+    only runs once. Queries with the same shape (see query_shape()) are
+    merged into one query of all of their fields, as long as their column
+    names don't clash. Queries of every field (fields=None) only merge with
+    each other.
+
+    Args:
+        declared (dict): Dictionary of report names and their queries
+            dictionaries.
+
+    Returns (tuple):
+    A tuple of the list of unique queries to run (as get() argument
+    dictionaries), and a dictionary of (report name, query name) tuples and
+    where to get their rows: a tuple of the unique query's index and the
+    column names to keep (None to keep every column).
+    """
+    # Each bucket is [shape, spec, fields, {column name: field}].
+    buckets = []
+    members = []
+    for report in sorted(declared):
+        for name in sorted(declared[report]):
+            spec = declared[report][name]
+            shape = query_shape(spec)
+            fields = spec.get('fields')
+            if isinstance(fields, basestring):
+                fields = [fields]
+            columns = None if fields is None else \
+                dict([(column_name(f), f) for f in fields])
+            for i, bucket in enumerate(buckets):
+                if bucket[0] != shape or (bucket[3] is None) != \
+                        (columns is None):
+                    continue
+                if columns is not None and any([
+                        bucket[3].get(c, f) != f
+                        for c, f in columns.items()]):
+                    continue
+                if columns is not None:
+                    for f in fields:
+                        if f not in bucket[2]:
+                            bucket[2].append(f)
+                    bucket[3].update(columns)
+                break
+            else:
+                i = len(buckets)
+                buckets.append([shape, spec, None if fields is None
+                                else list(fields), columns])
+            members.append((report, name, i, fields))
+    queries = []
+    for shape, spec, fields, _ in buckets:
+        spec = dict(spec)
+        spec['fields'] = fields
+        queries.append(spec)
+    plan = {}
+    for report, name, i, fields in members:
+        keep = None
+        if fields is not None and list(fields) != buckets[i][2]:
+            keep = [column_name(f) for f in fields]
+        plan[(report, name)] = (i, keep)
+    return queries, plan
+
+
+def project(rows, columns):
+    """
+    Keep only some of the columns of a query's rows.
+
+    Args:
+        rows (list): List of ElephantRow objects.
+        columns (list, None): The column names to keep, in order. If None,
+            the rows are returned as they are.
+
+    Returns (list):
+    List of ElephantRow objects with just those columns.
+    """
+    if columns is None or not rows:
+        return rows
+    from ElephantBrain import ElephantRow
+    fields = tuple(columns)
+    index = dict([(f, i) for i, f in enumerate(fields)])
+    positions = [rows[0].keys().index(c) for c in columns]
+    return [ElephantRow(fields, tuple([r[p] for p in positions]), index)
+            for r in rows]
+
+
+# The read-only ElephantBrain of a report worker process, and the rows of
+# the shared queries it has run, by their index in the batch's plan.
+_worker_brain = None
+_worker_results = {}
+
+
+def _init_worker(db_path):
+    """
+    Open a report worker process's own read-only connection to the database.
+
+    Args:
+        db_path (str): Path to the database file.
+    """
+    global _worker_brain
+    from ElephantBrain import ElephantBrain
+    _worker_brain = ElephantBrain(db_path, profile='read-only')
+    _worker_results.clear()
+
+
+def _worker_shared(plan):
+    """
+    Get the shared query results a report needs in a worker process. Each
+    unique query runs at most once in a worker, and its rows are kept for
+    the other reports the worker runs. Workers are sent the plan rather than
+    the rows, since pickling every row to every task costs far more than
+    running the query again.
+
+    Args:
+        plan (dict, None): Dictionary of query names and tuples of the
+            unique query's index, its get() arguments and the column names
+            to keep (see plan_queries()).
+
+    Returns (dict, None):
+    Dictionary of query names and rows, or None if there's no plan.
+    """
+    if plan is None:
+        return None
+    shared = {}
+    for query, (i, spec, columns) in plan.items():
+        if i not in _worker_results:
+            _worker_results[i] = _worker_brain.get(fetchall=True, **spec)
+        shared[query] = project(_worker_results[i], columns)
+    return shared
+
+
+def _run_report(task):
+    """
+    Run one report in a worker process, using the worker's connection.
+
+    Args:
+        task (tuple): The report's module name, its shared query plan (see
+            _worker_shared()), the output directory and format, and its
+            changes (see run_report()).
+
+    Returns (tuple):
+    A tuple of the report's module name and its summary dictionary.
+    """
+    name = task[0]
+    return name, ElephantTrunk().run_report(
+        name, _worker_brain, _worker_shared(task[1]), *task[2:])
+
+
+def scan_report(py_file):
+    """
+    Find the report class in a report module and its title by reading the
+    module's source, without importing it.
+
+    Args:
+        py_file (str): Path to the report module.
+
+    Returns (dict, None):
+    Dictionary with the report's 'class' name and 'title', or None if the
+    module doesn't define an ElephantReport subclass.
+    """
+    with open(py_file) as fh:
+        tree = ast.parse(fh.read(), py_file)
+    for node in tree.body:
+        if not isinstance(node, ast.ClassDef):
+            continue
+        bases = [getattr(b, 'id', getattr(b, 'attr', None))
+                 for b in node.bases]
+        if 'ElephantReport' not in bases:
+            continue
+        title = ElephantReport.title
+        for item in node.body:
+            if isinstance(item, ast.Assign) and \
+                    isinstance(item.value, ast.Str) and \
+                    'title' in [getattr(t, 'id', None) for t in item.targets]:
+                title = item.value.s
+        return {'class': node.name, 'title': title}
+    return None
+
+
+def _encode(value):
+    """
+    Make a value safe to write to a byte stream: unicode becomes UTF-8 and
+    None becomes an empty string.
+    """
+    if value is None:
+        return ''
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def _escape(text):
+    """
+    Escape &, < and > for HTML. Does the same as xml.sax.saxutils.escape(),
+    which takes longer to import than the rest of this module.
+    """
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+
+def row_columns(row):
+    """
+    The column names of a row, if it has them.
+
+    Args:
+        row (ElephantRow, dict, tuple): A row.
+
+    Returns (list, None):
+    The row's column names, or None for a plain tuple. Dictionary keys are
+    sorted, as they have no order of their own.
+    """
+    if hasattr(row, 'as_tuple'):
+        return list(row.keys())
+    if isinstance(row, dict):
+        return sorted(row)
+    return None
+
+
+def row_values(row, columns):
+    """
+    The values of a row, in column order.
+
+    Args:
+        row (ElephantRow, dict, tuple): A row.
+        columns (list, None): The column names, used to order dictionaries.
+
+    Returns (tuple):
+    The row's values.
+    """
+    if hasattr(row, 'as_tuple'):
+        return row.as_tuple()
+    if isinstance(row, dict):
+        return tuple([row.get(c) for c in columns])
+    return tuple(row)
+
+
+class RowWriter(object):
+    """
+    Base class for writers that stream rows to a file one at a time, so
+    memory use doesn't grow with the number of rows. Subclasses write the
+    header, each row and the footer.
+
+    Fields:
+        extension (str): The file extension for the format.
+        out (file): The file being written to.
+        columns (list, None): The column names, or None if the rows don't
+            have any.
+        title (str, None): The title of what's being written.
+        count (int): How many rows have been written.
+    """
+    extension = None
+
+    def __init__(self, out, columns=None, title=None):
+        """
+        Prepare a writer for use.
+
+        Args:
+            out (file): The file to write to, opened in binary mode.
+            columns (list, None): The column names. Defaults to the column
+                names of the first row.
+            title (str, None): The title of what's being written, for
+                formats that have somewhere to put it.
+        """
+        self.log = logging.getLogger('Elephant.ElephantTrunk')
+        self.out = out
+        self.columns = columns
+        self.title = title
+        self.count = 0
+
+    def __repr__(self):
+        return '{0} ({1} rows)'.format(type(self).__name__, self.count)
+
+    def write(self, rows):
+        """
+        Write every row, with the header and footer.
+
+        Args:
+            rows (iterable): ElephantRows, dictionaries or tuples. Pass an
+                iterator (like get(iterate=True)) and the first rows are
+                written before the last ones have been read.
+
+        Returns (int):
+        The number of rows written.
+        """
+        started = False
+        for row in rows:
+            if not started:
+                if self.columns is None:
+                    self.columns = row_columns(row)
+                self.header()
+                started = True
+            self.row(row_values(row, self.columns))
+            self.count += 1
+        if not started:
+            self.header()
+        self.footer()
+        self.out.flush()
+        self.log.debug('Wrote %s rows.', self.count)
+        return self.count
+
+    def header(self):
+        pass
+
+    def row(self, values):
+        raise NotImplementedError(
+            'This class needs to be subclassed to be used.')
+
+    def footer(self):
+        pass
+
+
+class CsvWriter(RowWriter):
+    extension = 'csv'
+    dialect = 'excel'
+
+    def header(self):
+        self.writer = csv.writer(self.out, dialect=self.dialect)
+        if self.columns:
+            self.writer.writerow([_encode(c) for c in self.columns])
+
+    def row(self, values):
+        self.writer.writerow([_encode(v) for v in values])
+
+
+class TsvWriter(CsvWriter):
+    extension = 'tsv'
+    dialect = 'excel-tab'
+
+
+class JsonLinesWriter(RowWriter):
+    """
+    Writes each row as a JSON object on its own line, or as a JSON array if
+    the rows don't have column names.
+    """
+    extension = 'jsonl'
+
+    def header(self):
+        # Encode the keys once, rather than building a dictionary per row.
+        self.encode = json.JSONEncoder(default=str).encode
+        self.keys = None
+        if self.columns:
+            self.keys = [self.encode(c) + ': ' for c in self.columns]
+
+    def row(self, values):
+        encode = self.encode
+        if self.keys is None:
+            self.out.write(encode(values))
+        else:
+            self.out.write('{' + ', '.join([
+                k + encode(v) for k, v in zip(self.keys, values)]) + '}')
+        self.out.write('\n')
+
+
+class HtmlWriter(RowWriter):
+    """
+    Writes the rows as a simple HTML page with a single table.
+    """
+    extension = 'html'
+
+    @staticmethod
+    def _cell(tag, value):
+        return '<{0}>{1}</{0}>'.format(tag, _escape(str(_encode(value))))
+
+    def header(self):
+        title = _escape(_encode(self.title or ''))
+        self.out.write('<!DOCTYPE html>\n<html>\n<head><meta charset="utf-8">'
+                       '<title>{0}</title></head>\n<body>\n'.format(title))
+        if self.title:
+            self.out.write('<h1>{0}</h1>\n'.format(title))
+        self.out.write('<table>\n')
+        if self.columns:
+            self.out.write('<thead><tr>{0}</tr></thead>\n'.format(
+                ''.join([self._cell('th', c) for c in self.columns])))
+        self.out.write('<tbody>\n')
+
+    def row(self, values):
+        self.out.write('<tr>{0}</tr>\n'.format(
+            ''.join([self._cell('td', v) for v in values])))
+
+    def footer(self):
+        self.out.write('</tbody>\n</table>\n</body>\n</html>\n')
+
+
+class TableWriter(RowWriter):
+    """
+    Writes the rows as a plain text table, for reading in a terminal. Column
+    widths are worked out from the first sample_size rows, so the whole
+    result never has to be held; longer values later on just push their row
+    out of line.
+    """
+    extension = 'txt'
+    sample_size = 200
+
+    @staticmethod
+    def _text(value):
+        if value is None:
+            return u''
+        if isinstance(value, unicode):
+            return value
+        if isinstance(value, str):
+            return value.decode('utf-8', 'replace')
+        return unicode(value)
+
+    def write(self, rows):
+        rows = iter(rows)
+        sample = list(islice(rows, self.sample_size))
+        if self.columns is None and sample:
+            self.columns = row_columns(sample[0])
+        widths = [len(self._text(c)) for c in self.columns or ()]
+        for row in sample:
+            values = row_values(row, self.columns)
+            if len(values) > len(widths):
+                widths.extend([0] * (len(values) - len(widths)))
+            for i, value in enumerate(values):
+                widths[i] = max(widths[i], len(self._text(value)))
+        self.widths = widths
+        return RowWriter.write(self, chain(sample, rows))
+
+    def _line(self, values):
+        cells = [self._text(v).ljust(w) for v, w in zip(values, self.widths)]
+        self.out.write(u' | '.join(cells).rstrip().encode('utf-8'))
+        self.out.write('\n')
+
+    def header(self):
+        if self.columns:
+            self._line(self.columns)
+            self.out.write('-+-'.join(['-' * w for w in self.widths]))
+            self.out.write('\n')
+
+    def row(self, values):
+        self._line(values)
+
+
+# The output formats and their writers.
+WRITERS = OrderedDict([('csv', CsvWriter), ('tsv', TsvWriter),
+                       ('jsonl', JsonLinesWriter), ('html', HtmlWriter),
+                       ('table', TableWriter)])
+
+
+def write_rows(rows, out=None, fmt='csv', columns=None, title=None):
+    """
+    Stream rows to a file or stdout in one of the WRITERS formats.
+
+    Args:
+        rows (iterable): ElephantRows, dictionaries or tuples.
+        out (str, file, None): Path of the file to write, an open file, or
+            None (or '-') for stdout.
+        fmt (str): The output format. Defaults to 'csv'.
+        columns (list, None): The column names. Defaults to the column
+            names of the first row.
+        title (str, None): The title of what's being written.
+
+    Returns (int):
+    The number of rows written.
+
+    Raises:
+        ValueError: If the format isn't one of the WRITERS.
+    """
+    if fmt not in WRITERS:
+        raise ValueError('Unknown format {0}. Valid options are: {1}'.format(
+            fmt, ', '.join(WRITERS)))
+    if out is None or out == '-':
+        return WRITERS[fmt](sys.stdout, columns, title).write(rows)
+    if isinstance(out, basestring):
+        with open(out, 'wb') as fh:
+            return WRITERS[fmt](fh, columns, title).write(rows)
+    return WRITERS[fmt](out, columns, title).write(rows)
 
 
 class ElephantTrunk(object):
+    reports_dir = 'reports'
+    # Cached results of scan_report() for each report module, keyed on the
+    # module's mtime and size.
+    index_file = '.report_index.json'
+
     def __init__(self):
         self.log = logging.getLogger('Elephant.ElephantTrunk')
+        self._index = None
 
     def list_reports(self):
-        self.log.debug('list_reports(): {0}'.format(locals()))
-        reports_dir = 'reports'
-        reports = {}
-        path = os.path.abspath(reports_dir)
+        """
+        List the available reports, without importing them.
+
+        Returns (dict):
+        Dictionary of report module names and their titles.
+        """
+        self.log.debug('list_reports(): %s', locals())
+        index = self.report_index()
+        return dict([(n, index[n]['title']) for n in index])
+
+    def report_index(self):
+        """
+        The index of the report modules in the reports directory. Modules
+        are only read again when their mtime or size changes, and the index
+        is kept in the reports directory between runs.
+
+        Returns (dict):
+        Dictionary of report module names and dictionaries of their 'class'
+        name, 'title', 'mtime' and 'size'.
+        """
+        if self._index is not None:
+            return self._index
+        path = os.path.abspath(self.reports_dir)
         if not os.path.isdir(path):
-            return reports
+            return {}
+        index_path = os.path.join(path, self.index_file)
+        try:
+            with open(index_path) as fh:
+                cached = json.load(fh)
+        except (IOError, OSError, ValueError):
+            cached = {}
+        index = {}
+        entries = {}
+        changed = False
         for py_file in glob.glob(os.path.join(path, '*.py')):
-            file_name = os.path.basename(py_file)
-            mod_name = os.path.splitext(file_name)[0]
+            mod_name = os.path.splitext(os.path.basename(py_file))[0]
             if mod_name.startswith('__'):
                 continue
-            temp_mod = importlib.import_module('.{0}'.format(mod_name),
-                                               package=reports_dir)
-            for item in dir(temp_mod):
-                obj = getattr(temp_mod, item)
-                if not inspect.isclass(obj):
-                    continue
-                if 'ElephantReport' in [o.__name__ for o in obj.__bases__]:
-                    reports[mod_name] = getattr(obj, 'title')
-        return reports
+            stat = os.stat(py_file)
+            entry = cached.get(mod_name)
+            if not entry or entry['mtime'] != stat.st_mtime or \
+                    entry['size'] != stat.st_size:
+                self.log.debug('Scanning %s', py_file)
+                try:
+                    found = scan_report(py_file)
+                except SyntaxError as e:
+                    self.log.error('Reading %s: %s', py_file, e)
+                    found = None
+                entry = dict(found or {}, mtime=stat.st_mtime,
+                             size=stat.st_size)
+                changed = True
+            if entry.get('class'):
+                index[mod_name] = entry
+            entries[mod_name] = entry
+        if changed or set(entries) != set(cached):
+            try:
+                with open(index_path, 'w') as fh:
+                    json.dump(entries, fh, indent=1, sort_keys=True)
+            except (IOError, OSError) as e:
+                self.log.warn('Saving %s: %s', index_path, e)
+        self._index = index
+        return index
+
+    def load_report(self, name):
+        """
+        Import a report module and get its report class. Only this module is
+        imported.
+
+        Args:
+            name (str): The report's module name.
+
+        Returns (class, None):
+        The module's ElephantReport subclass, or None if it doesn't have one.
+        """
+        self.log.debug('load_report(): %s', locals())
+        entry = self.report_index().get(name)
+        if entry is None:
+            return None
+        temp_mod = importlib.import_module('.{0}'.format(name),
+                                           package=self.reports_dir)
+        return getattr(temp_mod, entry['class'], None)
+
+    def run_report(self, name, brain, shared=None, out_dir=None, fmt='csv',
+                   changes=None):
+        """
+        Run one report, timing it and catching any error.
+
+        Args:
+            name (str): The report's module name.
+            brain (ElephantBrain): The database the report reads from.
+            shared (dict, None): Results of the report's queries that have
+                already been run, keyed on query name.
+            out_dir (str, None): Directory to write the report's rows to, in
+                a file named after the report. If None, the report is only
+                built.
+            fmt (str): The output format (see WRITERS). Defaults to 'csv'.
+            changes (dict, None): The rows changed in the tables the report
+                depends on since it last ran (see ElephantBrain.changes()),
+                or None if it should rebuild everything.
+
+        Returns (dict):
+        Summary of the run: title, seconds, error (None, or the traceback if
+        the report failed), rows (the number of rows written, or that
+        build() returned if it returned a collection) and output (the path
+        written to, if any).
+        """
+        self.log.debug('run_report(): %s', name)
+        summary = {'title': None, 'seconds': 0.0, 'error': None,
+                   'rows': None, 'output': None}
+        start = time.time()
+        try:
+            report = self.load_report(name)
+            if report is None:
+                raise ValueError('{0} has no ElephantReport.'.format(name))
+            summary['title'] = report.title
+            if out_dir is not None:
+                summary['output'] = self.output_path(name, out_dir, fmt)
+                summary['rows'] = report(brain, shared, changes).write(
+                    summary['output'], fmt)
+            else:
+                result = report(brain, shared, changes).build()
+                if hasattr(result, '__len__'):
+                    summary['rows'] = len(result)
+        except Exception:
+            summary['error'] = traceback.format_exc()
+            self.log.error('Report %s failed:\n%s', name, summary['error'])
+        summary['seconds'] = time.time() - start
+        return summary
+
+    @staticmethod
+    def output_path(name, out_dir, fmt):
+        """
+        Where a report is written to.
+
+        Args:
+            name (str): The report's module name.
+            out_dir (str): The output directory.
+            fmt (str): The output format (see WRITERS).
+
+        Returns (str):
+        Path of the report's output file.
+        """
+        return os.path.join(out_dir, '{0}.{1}'.format(
+            name, WRITERS[fmt].extension))
+
+    def check_reports(self, brain, names, out_dir=None, fmt='csv'):
+        """
+        Work out which reports need to run, from the ChangeLog and the
+        ReportLog. A report needs to run if the file doesn't track changes,
+        the report doesn't declare what it depends on, it hasn't been run
+        before, its output file is missing, or any of the tables it depends
+        on have changed since it last ran.
+
+        Args:
+            brain (ElephantBrain): The database the reports read from.
+            names (list): The module names of the reports.
+            out_dir (str, None): The directory the reports will be written
+                to, if any.
+            fmt (str): The output format (see WRITERS). Defaults to 'csv'.
+
+        Returns (tuple):
+        A tuple of the latest change id (None if the file doesn't track
+        changes), and a dictionary of report names and tuples of (run,
+        reason, changes): whether the report needs to run, why, and the rows
+        changed in the tables it depends on (None if it should rebuild
+        everything).
+        """
+        self.log.debug('check_reports(): %s', names)
+        last = brain.last_change() if brain.tracking else None
+        ran = brain.report_log() if last is not None else {}
+        checks = {}
+        for name in names:
+            try:
+                depends = getattr(self.load_report(name), 'depends', None)
+            except Exception as e:
+                # run_report() will report the error.
+                self.log.debug('Loading %s: %s', name, e)
+                depends = None
+            entry = ran.get(name)
+            output = self.output_path(name, out_dir, fmt) \
+                if out_dir is not None else None
+            if last is None:
+                checks[name] = (True, 'change tracking is off', None)
+            elif depends is None:
+                checks[name] = (True, 'no depends declared', None)
+            elif entry is None:
+                checks[name] = (True, 'never run', None)
+            elif entry['ChangeId'] > last:
+                checks[name] = (True, 'change log was reset', None)
+            elif output is not None and (entry['Output'] != output or
+                                         not os.path.isfile(output)):
+                checks[name] = (True, 'no output at {0}'.format(output), None)
+            else:
+                changes = brain.changes(entry['ChangeId'], depends) \
+                    if depends else {}
+                if changes:
+                    checks[name] = (True, 'changed: {0}'.format(', '.join([
+                        '{0} ({1} rows)'.format(t, len(changes[t]))
+                        for t in sorted(changes)])), changes)
+                else:
+                    checks[name] = (False, 'no changes to {0} since change '
+                                    '{1}'.format(', '.join(depends) or
+                                                 'anything',
+                                                 entry['ChangeId']), None)
+        return last, checks
+
+    def plan_shared(self, names):
+        """
+        Plan the queries declared by a batch of reports, so each unique query
+        only runs once (see plan_queries()).
+
+        Args:
+            names (list): The module names of the reports.
+
+        Returns (tuple):
+        A tuple of the list of unique queries (as get() argument
+        dictionaries), and a dictionary of report names and their plans:
+        dictionaries of query names and tuples of the unique query's index,
+        its get() arguments and the column names to keep.
+        """
+        self.log.debug('plan_shared(): %s', names)
+        declared = {}
+        for name in names:
+            try:
+                report = self.load_report(name)
+            except Exception as e:
+                # run_report() will report the error.
+                self.log.debug('Loading %s: %s', name, e)
+                continue
+            if report is not None and report.queries:
+                declared[name] = report.queries
+        queries, plan = plan_queries(declared)
+        plans = dict([(n, {}) for n in declared])
+        for (name, query), (i, columns) in plan.items():
+            plans[name][query] = (i, queries[i], columns)
+        return queries, plans
+
+    def share_queries(self, brain, names):
+        """
+        Run the queries declared by a batch of reports, running each unique
+        query only once (see plan_shared()).
+
+        Args:
+            brain (ElephantBrain): The database to query.
+            names (list): The module names of the reports.
+
+        Returns (tuple):
+        A tuple of a dictionary of report names and their shared results
+        (dictionaries of query names and rows), and a summary dictionary of
+        declared (the number of queries the reports declared), run (the
+        number of queries run) and seconds.
+        """
+        self.log.debug('share_queries(): %s', names)
+        start = time.time()
+        queries, plans = self.plan_shared(names)
+        results = [brain.get(fetchall=True, **q) for q in queries]
+        shared = dict([(n, {}) for n in plans])
+        for name in plans:
+            for query, (i, _, columns) in plans[name].items():
+                shared[name][query] = project(results[i], columns)
+        return shared, {'declared': sum([len(p) for p in plans.values()]),
+                        'run': len(queries), 'seconds': time.time() - start}
+
+    def run_reports(self, db_path, names=None, workers=None, out_dir=None,
+                    fmt='csv', force=False):
+        """
+        Run a batch of reports in a pool of worker processes. Reports whose
+        inputs haven't changed since they last ran are skipped (see
+        check_reports()), and the ones that run are recorded in the
+        ReportLog. The queries the reports declare are shared between them:
+        with one worker they're run once up front, and with more, each
+        worker runs each unique query it needs once and keeps the rows for
+        the other reports it runs. Each worker opens its own read-only
+        connection to the database, so only changes that have been saved are
+        seen by the reports.
+
+        Args:
+            db_path (str): Path to the database file.
+            names (list, None): The module names of the reports to run. If
+                None, runs every report in list_reports().
+            workers (int, None): The most worker processes to use. Defaults
+                to the number of CPUs. With 1, reports run in this process.
+            out_dir (str, None): Directory to write each report's rows to.
+                It's made if it doesn't exist. If None, reports are only
+                built.
+            fmt (str): The output format (see WRITERS). Defaults to 'csv'.
+            force (bool): Run every report, changed or not. Defaults to
+                False.
+
+        Returns (dict):
+        Summary of the batch: seconds (wall time), workers, queries (the
+        share_queries() summary; with more than one worker, run counts the
+        unique queries and seconds only covers planning them), failed (names of the reports that failed),
+        skipped (a dictionary of the names of the reports that didn't need to
+        run and why) and reports (a dictionary of each report's module name
+        and run_report() summary, with the reason it ran).
+
+        Raises:
+            ValueError: If the format isn't one of the WRITERS.
+        """
+        self.log.debug('run_reports(): %s', locals())
+        if fmt not in WRITERS:
+            raise ValueError('Unknown format {0}. Valid options are: '
+                             '{1}'.format(fmt, ', '.join(WRITERS)))
+        if out_dir is not None and not os.path.isdir(out_dir):
+            os.makedirs(out_dir)
+        from ElephantBrain import ElephantBrain
+        names = list(names) if names is not None \
+            else sorted(self.list_reports())
+        start = time.time()
+        brain = ElephantBrain(db_path, profile='read-only')
+        last, checks = self.check_reports(brain, names, out_dir, fmt)
+        if force:
+            checks = dict([(n, (True, 'forced', None)) for n in checks])
+        skipped = dict([(n, checks[n][1]) for n in names
+                        if not checks[n][0]])
+        for name in sorted(skipped):
+            self.log.info('Skipping %s: %s', name, skipped[name])
+        names = [n for n in names if n not in skipped]
+        workers = max(1, min(workers or multiprocessing.cpu_count(),
+                             len(names) or 1))
+        if workers == 1:
+            shared, queries = self.share_queries(brain, names)
+            results = [(n, self.run_report(n, brain, shared.get(n), out_dir,
+                                           fmt, checks[n][2]))
+                       for n in names]
+        else:
+            planned = time.time()
+            unique, plans = self.plan_shared(names)
+            queries = {'declared': sum([len(p) for p in plans.values()]),
+                       'run': len(unique), 'seconds': time.time() - planned}
+            tasks = [(n, plans.get(n), out_dir, fmt, checks[n][2])
+                     for n in names]
+            pool = multiprocessing.Pool(workers, _init_worker, (db_path,))
+            try:
+                results = list(pool.imap_unordered(_run_report, tasks))
+            finally:
+                pool.close()
+                pool.join()
+        reports = dict(results)
+        for name in reports:
+            reports[name]['reason'] = checks[name][1]
+        if last is not None:
+            self.log_reports(db_path, last, reports)
+        return {'seconds': time.time() - start, 'workers': workers,
+                'queries': queries,
+                'failed': sorted([n for n in reports
+                                  if reports[n]['error']]),
+                'skipped': skipped,
+                'reports': reports}
+
+    def log_reports(self, db_path, last, reports):
+        """
+        Record the reports that ran without errors in the ReportLog, so the
+        next batch can skip them if nothing they depend on changes. Errors
+        (like the file being locked by someone else's unsaved changes) are
+        logged, and just mean the reports run again next time.
+
+        Args:
+            db_path (str): Path to the database file.
+            last (int): The latest change id when the reports ran.
+            reports (dict): Dictionary of report names and run_report()
+                summaries.
+        """
+        from ElephantBrain import ElephantBrain
+        entries = [(n, last, reports[n]['output']) for n in sorted(reports)
+                   if not reports[n]['error']]
+        if not entries:
+            return
+        try:
+            ElephantBrain(db_path, cache=False).log_reports(entries)
+        except Exception as e:
+            self.log.warn('Recording the reports that ran: %s', e)
 
 
 class ElephantReport(object):
+    """
+    Base class for reports. Subclass it in a module in the reports directory,
+    set its title, declare the data it needs in queries, and override data()
+    and build(). Reports are written out by streaming the rows from rows(),
+    so a report with a lot of rows should override rows() to return an
+    iterator (like get(iterate=True)) rather than building a list.
+
+    Fields:
+        title (str): The report's title.
+        depends (tuple, None): The tables the report reads. If none of
+            them change, the report doesn't need to run again. None means
+            the report always runs.
+        queries (dict): The report's data needs: names for the queries,
+            mapped to dictionaries of get() arguments (tables, fields, where,
+            joins, order and params). When reports run as a batch, queries
+            that are the same across reports (or are covered by another
+            report's query) are only run once.
+        brain (ElephantBrain, None): The database the report reads from.
+        shared (dict): Results of the report's queries that have already
+            been run, keyed on query name.
+        changes (dict, None): The rows changed in the depends tables since
+            the report last ran, as dictionaries of table names and sets of
+            row ids, for reports that can rebuild just what changed. None
+            means rebuild everything.
+    """
     title = 'Example Report'
+    depends = None
+    queries = {}
 
-    def __init__(self):
-        if type(self) is not ElephantReport:
+    def __init__(self, brain=None, shared=None, changes=None):
+        """
+        Prepare a report for use.
+
+        Args:
+            brain (ElephantBrain, None): The database the report reads from.
+            shared (dict, None): Results of the report's queries that have
+                already been run, keyed on query name.
+            changes (dict, None): The rows changed in the depends tables
+                since the report last ran, or None to rebuild everything.
+        """
+        if type(self) is ElephantReport:
             raise NotImplementedError(
                 'This class needs to be subclassed to be used.')
+        self.brain = brain
+        self.shared = shared or {}
+        self.changes = changes
 
     def __repr__(self):
         return 'ElephantReport ({0})'.format(self.title)
 
+    def query(self, name):
+        """
+        Get the rows of one of the report's declared queries, from the
+        shared results if it has already been run.
+
+        Args:
+            name (str): The name of the query in self.queries.
+
+        Returns (list):
+        List of the query's rows.
+        """
+        if name not in self.shared:
+            self.shared[name] = self.brain.get(fetchall=True,
+                                               **self.queries[name])
+        return self.shared[name]
+
     def data(self):
-        return ''
+        """
+        The report's data. By default, the rows of every declared query.
+
+        Returns (dict):
+        Dictionary of query names and their rows.
+        """
+        return dict([(n, self.query(n)) for n in self.queries])
 
     def build(self):
         raise NotImplementedError(
             'This class needs to be subclassed to be used.')
 
+    def rows(self):
+        """
+        The report's rows, for writing out. By default, what build()
+        returns.
+
+        Returns (iterable):
+        ElephantRows, dictionaries or tuples.
+        """
+        return self.build()
+
+    def write(self, out=None, fmt='csv'):
+        """
+        Stream the report's rows to a file or stdout.
+
+        Args:
+            out (str, file, None): Path of the file to write, an open file,
+                or None for stdout.
+            fmt (str): The output format (see WRITERS). Defaults to 'csv'.
+
+        Returns (int):
+        The number of rows written.
+        """
+        return write_rows(self.rows(), out, fmt, title=self.title)
+
 
 if __name__ == '__main__':
     from pprint import pformat
 
+    import ElephantLog
+
+    ElephantLog.init_log()
     et = ElephantTrunk()
     print(pformat(et.list_reports()))
\ No newline at end of file
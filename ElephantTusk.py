@@ -0,0 +1,292 @@
+import heapq
+import logging
+
+from itertools import groupby
+from operator import itemgetter
+
+
+def sweep(intervals):
+    """
+    Find the overlapping intervals in each group of intervals with a sort and
+    sweep. Each interval is compared only against the intervals still active
+    when it starts, kept in a heap ordered by end, so this is O(n log n) plus
+    the number of overlaps found.
+
+    Args:
+        intervals (iterable): Tuples of (group, item, start, end), sorted by
+            group and then start. Intervals that only touch (one ends when
+            the next starts) don't overlap.
+
+    Returns (generator):
+    Tuples of (group, earlier item, later item, overlap start, overlap end).
+    """
+    group = None
+    active = []
+    for key, item, start, end in intervals:
+        if key != group:
+            group = key
+            active = []
+        while active and active[0][0] <= start:
+            heapq.heappop(active)
+        for other_end, other, _ in active:
+            if other != item:
+                yield key, other, item, start, min(other_end, end)
+        heapq.heappush(active, (end, item, start))
+
+
+def peak(intervals):
+    """
+    Find the peak of the total quantity in use at once across a collection
+    of intervals, with a sweep over their start and end times.
+
+    Args:
+        intervals (iterable): Tuples of (start, end, quantity). Intervals
+            that only touch (one ends when the next starts) don't overlap.
+
+    Returns (tuple):
+    A tuple of the peak quantity, and the start and end of the first window
+    in which it's reached. All three are None if there are no intervals.
+    """
+    changes = []
+    for start, end, quantity in intervals:
+        changes.append((start, quantity))
+        changes.append((end, -quantity))
+    changes.sort(key=itemgetter(0))
+    level = 0
+    top = window_start = window_end = None
+    for time, deltas in groupby(changes, key=itemgetter(0)):
+        level += sum([d for _, d in deltas])
+        if top is None or level > top:
+            top, window_start, window_end = level, time, None
+        elif window_end is None and level < top:
+            window_end = time
+    return top, window_start, window_end
+
+
+class ElephantTusk(object):
+    """
+    ElephantTusk digs through the schedule in an ElephantBrain looking for
+    problems, like rooms and staff that have been double-booked.
+
+    Conflicts are dictionaries with these keys:
+        Type (str): 'Room' or 'Person'.
+        Id (int): The id of the double-booked room or person.
+        Event (int): The id of the event that starts first.
+        Conflict (int): The id of the event that overlaps it.
+        Start (str): When the overlap starts.
+        End (str): When the overlap ends.
+
+    Equipment demand is dictionaries with these keys:
+        Site (int): The id of the site.
+        Piece (int): The id of the piece of equipment.
+        Peak (int): The most of the piece in use at the site at once.
+        Start (str): When the peak starts.
+        End (str): When the peak ends.
+        Available (int): How many of the piece the site has (the total of
+            its EquipmentAdjust quantities).
+        Shortfall (int): How many more the site needs to cover the peak.
+    """
+    def __init__(self, brain):
+        """
+        Prepare an ElephantTusk for use.
+
+        Args:
+            brain (ElephantBrain): The database to check.
+        """
+        self.log = logging.getLogger('Elephant.ElephantTusk')
+        self.brain = brain
+
+    def __repr__(self):
+        return 'ElephantTusk ({0})'.format(self.brain.file_path)
+
+    @staticmethod
+    def _conflict(kind, key, event, other, start, end):
+        return {'Type': kind, 'Id': key, 'Event': event, 'Conflict': other,
+                'Start': start, 'End': end}
+
+    def room_conflicts(self):
+        """
+        Find every pair of events booked into the same room at overlapping
+        times.
+
+        Returns (list):
+        List of conflict dictionaries.
+        """
+        self.log.debug('room_conflicts()')
+        rows = self.brain.get('Event', ['Room', 'id', 'Start', 'End'],
+                              order=['Room', 'Start'], iterate=True,
+                              tuples=True)
+        return [self._conflict('Room', *c) for c in sweep(rows)]
+
+    def staff_conflicts(self):
+        """
+        Find every pair of overlapping events that the same person is
+        assigned to.
+
+        Returns (list):
+        List of conflict dictionaries.
+        """
+        self.log.debug('staff_conflicts()')
+        rows = self.brain.get(
+            'StaffAssign',
+            ['StaffAssign.Person', 'Event.id', 'Event.Start', 'Event.End'],
+            joins=[('Event', 'StaffAssign.Event=Event.id')],
+            order=['StaffAssign.Person', 'Event.Start'], iterate=True,
+            tuples=True)
+        return [self._conflict('Person', *c) for c in sweep(rows)]
+
+    def conflicts(self):
+        """
+        Find every room and staff double-booking.
+
+        Returns (list):
+        List of conflict dictionaries, rooms first.
+        """
+        return self.room_conflicts() + self.staff_conflicts()
+
+    def event_conflicts(self, event_id):
+        """
+        Find the conflicts involving one event, without checking the whole
+        schedule. Use this after adding or changing an event.
+
+        Args:
+            event_id (int): The id of the event to check.
+
+        Returns (list):
+        List of conflict dictionaries involving the event.
+        """
+        self.log.debug('event_conflicts(): %s', locals())
+        event = self.brain.get('Event', ['Room', 'Start', 'End'],
+                               {'id': event_id}, fetchall=True)
+        if not event:
+            return []
+        room, start, end = event[0].as_tuple()
+        overlapping = ['Event.id<>?', 'Event.Start<?', 'Event.End>?']
+        found = []
+        for other in self.brain.get(
+                'Event', ['id', 'Start', 'End'], overlapping + [{'Room': room}],
+                params=[event_id, end, start], tuples=True, iterate=True):
+            found.append(self._pair('Room', room, (event_id, start, end),
+                                    other))
+        for row in self.brain.get(
+                'StaffAssign AS Mine',
+                ['Other.Person', 'Event.id', 'Event.Start', 'Event.End'],
+                overlapping + [{'Mine.Event': event_id}],
+                joins=[('StaffAssign AS Other', 'Other.Person=Mine.Person'),
+                       ('Event', 'Other.Event=Event.id')],
+                params=[event_id, end, start], tuples=True, iterate=True):
+            found.append(self._pair('Person', row[0], (event_id, start, end),
+                                    row[1:]))
+        return found
+
+    def _pair(self, kind, key, event, other):
+        """
+        Make a conflict from two overlapping events, earliest first.
+
+        Args:
+            kind (str): 'Room' or 'Person'.
+            key (int): The id of the room or person.
+            event (tuple): The (id, start, end) of one event.
+            other (tuple): The (id, start, end) of the other event.
+
+        Returns (dict):
+        A conflict dictionary.
+        """
+        first, second = sorted([tuple(event), tuple(other)],
+                               key=lambda e: (e[1], e[0]))
+        return self._conflict(kind, key, first[0], second[0], second[1],
+                              min(first[2], second[2]))
+
+    def recheck(self, conflicts, event_id):
+        """
+        Update a list of conflicts after one event has changed.
+
+        Args:
+            conflicts (list): List of conflict dictionaries, like the one from
+                conflicts().
+            event_id (int): The id of the event that changed.
+
+        Returns (list):
+        A new list of conflict dictionaries: the ones that didn't involve the
+        event, followed by the event's current conflicts.
+        """
+        kept = [c for c in conflicts
+                if event_id not in (c['Event'], c['Conflict'])]
+        return kept + self.event_conflicts(event_id)
+
+    def equipment_demand(self):
+        """
+        Work out the peak simultaneous demand for each piece of equipment at
+        each site, and how it compares with the site's inventory.
+
+        Returns (list):
+        List of equipment demand dictionaries, ordered by site and piece.
+        """
+        self.log.debug('equipment_demand()')
+        available = dict([
+            ((r[0], r[1]), r[2]) for r in self.brain.query(
+                'SELECT Site, Piece, SUM(Quantity) FROM EquipmentAdjust '
+                'GROUP BY Site, Piece', tuples=True)])
+        rows = self.brain.get(
+            'EquipmentAssign',
+            ['Room.Site', 'EquipmentAssign.Piece', 'Event.Start', 'Event.End',
+             'EquipmentAssign.Quantity'],
+            joins=[('Event', 'EquipmentAssign.Event=Event.id'),
+                   ('Room', 'Event.Room=Room.id')],
+            order=['Room.Site', 'EquipmentAssign.Piece'], iterate=True,
+            tuples=True)
+        demand = []
+        for (site, piece), group in groupby(rows, key=itemgetter(0, 1)):
+            top, start, end = peak([r[2:] for r in group])
+            have = available.get((site, piece), 0)
+            demand.append({'Site': site, 'Piece': piece, 'Peak': top,
+                           'Start': start, 'End': end, 'Available': have,
+                           'Shortfall': max(top - have, 0)})
+        return demand
+
+    def shortfalls(self):
+        """
+        Find the equipment each site doesn't have enough of to cover its
+        peak demand.
+
+        Returns (list):
+        List of equipment demand dictionaries with a Shortfall.
+        """
+        return [d for d in self.equipment_demand() if d['Shortfall']]
+
+
+if __name__ == '__main__':
+    from pprint import pformat
+
+    import ElephantLog
+
+    from ElephantBrain import ElephantBrain
+
+    ElephantLog.init_log()
+    eb = ElephantBrain('test.elephant', new=True)
+    eb.add_many('Site', ['Name'], [('Site A',)])
+    eb.add_many('Room', ['Name', 'RoomGroup', 'Site'],
+                [('Room 1', 'Hall A', 1), ('Room 2', 'Hall A', 1)])
+    eb.add_many('People', ['FirstName', 'LastName'],
+                [('John', 'Doe'), ('Jane', 'Doe')])
+    eb.add_many('Event', ['Name', 'Room', 'Start', 'End', 'Speaker'],
+                [('Session 1', 1, '2016-01-01 10:00', '2016-01-01 11:00', 1),
+                 ('Session 2', 1, '2016-01-01 10:30', '2016-01-01 11:30', 2),
+                 ('Session 3', 1, '2016-01-01 11:30', '2016-01-01 12:30', 1),
+                 ('Session 4', 2, '2016-01-01 11:00', '2016-01-01 12:00', 2)])
+    eb.add_many('StaffAssign', ['Event', 'Person'],
+                [(3, 1), (4, 1), (1, 2)])
+    eb.add_many('Equipment', ['Name', 'ShortName'], [('Projector', 'P')])
+    eb.add_many('EquipmentAssign', ['Event', 'Piece', 'Quantity'],
+                [(1, 1, 1), (2, 1, 2), (4, 1, 1)])
+    eb.add_many('EquipmentAdjust', ['Piece', 'Site', 'Quantity'], [(1, 1, 2)])
+    eb.save()
+    tusk = ElephantTusk(eb)
+    conflicts = tusk.conflicts()
+    print('Conflicts:\n{0}'.format(pformat(conflicts)))
+    print('Equipment demand:\n{0}'.format(pformat(tusk.equipment_demand())))
+    # Move Session 2 out of the way and recheck just that event.
+    eb.update('Event', ['Start', 'End'],
+              ['2016-01-01 09:00', '2016-01-01 10:00'], {'id': 2})
+    print('After moving Session 2:\n{0}'.format(
+        pformat(tusk.recheck(conflicts, 2))))
@@ -0,0 +1,296 @@
+import datetime
+import logging
+import os
+import posixpath
+import re
+import zipfile
+
+try:
+    import xml.etree.cElementTree as ElementTree
+except ImportError:
+    import xml.etree.ElementTree as ElementTree
+
+
+# The built in XLSX number formats that are dates or times.
+XLSX_DATE_FORMATS = set(range(14, 23) + [45, 46, 47])
+# Quoted text, [colors/conditions] and escaped characters in a number format,
+# which don't make it a date format.
+XLSX_LITERAL_RE = re.compile(r'"[^"]*"|\[[^\]]*\]|\\.')
+XLSX_DATE_RE = re.compile(r'[dmyhs]', re.I)
+
+
+def _namespace(tag):
+    """
+    The {namespace} prefix of an ElementTree tag, or '' if it has none.
+    """
+    return tag[:tag.index('}') + 1] if tag.startswith('{') else ''
+
+
+class XlsxReader(object):
+    """
+    Streams the rows of one sheet of an XLSX workbook, using only zipfile and
+    incremental XML parsing. Each row is parsed, handed over and thrown away
+    before the next is read, so memory use doesn't grow with the sheet. The
+    shared strings table and the date styles are read once up front.
+
+    Values come back as unicode strings, ints, floats, or (for cells with a
+    date or time format) strings like '2016-01-01 10:30'.
+    """
+    def __init__(self, xlsx_file, sheet=None):
+        """
+        Open a workbook for reading.
+
+        Args:
+            xlsx_file (str): Path to the XLSX file.
+            sheet (str, int, None): The name of the sheet to read, or its
+                position (starting at 0). Defaults to the first sheet.
+
+        Raises:
+            ValueError: If the file isn't an XLSX workbook, or doesn't have
+                the sheet.
+        """
+        self.log = logging.getLogger('Elephant.ElephantXlsx')
+        self.file_path = os.path.abspath(xlsx_file)
+        try:
+            self.zip = zipfile.ZipFile(self.file_path)
+        except zipfile.BadZipfile as e:
+            raise ValueError('{0} is not an XLSX file: {1}'.format(
+                self.file_path, e))
+        self.names = set(self.zip.namelist())
+        self.epoch = datetime.datetime(1899, 12, 30)
+        self.sheet_path = self._sheet_path(sheet)
+        self.strings = self._shared_strings()
+        self.date_styles = self._date_styles()
+
+    def __repr__(self):
+        return 'XlsxReader ({0}: {1})'.format(self.file_path,
+                                              self.sheet_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self.zip.close()
+
+    def _parse(self, name):
+        """
+        Parse a whole (small) part of the workbook.
+
+        Returns (Element, None):
+        The part's root element, or None if the workbook doesn't have it.
+        """
+        if name not in self.names:
+            return None
+        with self.zip.open(name) as fh:
+            return ElementTree.parse(fh).getroot()
+
+    def _sheet_path(self, sheet):
+        """
+        Find where a sheet is stored in the workbook, and which date system
+        the workbook uses.
+
+        Args:
+            sheet (str, int, None): The sheet's name or position, or None for
+                the first sheet.
+
+        Returns (str):
+        The path of the sheet's XML in the zip file.
+
+        Raises:
+            ValueError: If the workbook doesn't have the sheet.
+        """
+        workbook = self._parse('xl/workbook.xml')
+        if workbook is None:
+            raise ValueError('{0} has no workbook.'.format(self.file_path))
+        ns = _namespace(workbook.tag)
+        props = workbook.find(ns + 'workbookPr')
+        if props is not None and props.get('date1904') in ('1', 'true'):
+            self.epoch = datetime.datetime(1904, 1, 1)
+        sheets = []
+        for element in workbook.iter(ns + 'sheet'):
+            rel = [v for k, v in element.items() if k.endswith('}id')]
+            sheets.append((element.get('name'), rel[0] if rel else None))
+        if sheet is None:
+            found = sheets[:1]
+        elif isinstance(sheet, (int, long)):
+            found = sheets[sheet:sheet + 1]
+        else:
+            found = [s for s in sheets if s[0] == sheet]
+        if not found:
+            raise ValueError('{0} has no sheet {1}. Valid options are: '
+                             '{2}'.format(self.file_path, sheet,
+                                          ', '.join([s[0] for s in sheets])))
+        rels = self._parse('xl/_rels/workbook.xml.rels')
+        targets = dict([(r.get('Id'), r.get('Target'))
+                        for r in (rels if rels is not None else [])])
+        target = targets.get(found[0][1])
+        if target is None:
+            raise ValueError('{0} has no data for sheet {1}.'.format(
+                self.file_path, found[0][0]))
+        if target.startswith('/'):
+            return target.lstrip('/')
+        return posixpath.normpath(posixpath.join('xl', target))
+
+    def _shared_strings(self):
+        """
+        Read the workbook's shared strings table, which text cells refer to
+        by position. Rich text runs are joined, and phonetic hints skipped.
+
+        Returns (list):
+        List of the shared strings.
+        """
+        name = 'xl/sharedStrings.xml'
+        if name not in self.names:
+            return []
+        strings = []
+        with self.zip.open(name) as fh:
+            ns = None
+            for _, element in ElementTree.iterparse(fh):
+                if ns is None:
+                    ns = _namespace(element.tag)
+                if element.tag == ns + 'si':
+                    strings.append(self._text(element, ns))
+                    element.clear()
+        return strings
+
+    @staticmethod
+    def _text(element, ns):
+        """
+        The text of a shared string or inline string element.
+        """
+        text = element.find(ns + 't')
+        if text is not None:
+            return text.text or u''
+        return u''.join([t.text or u''
+                         for r in element.findall(ns + 'r')
+                         for t in r.findall(ns + 't')])
+
+    def _date_styles(self):
+        """
+        Find the cell styles that format numbers as dates or times.
+
+        Returns (set):
+        Set of the positions of the date styles in the cellXfs table.
+        """
+        styles = self._parse('xl/styles.xml')
+        if styles is None:
+            return set()
+        ns = _namespace(styles.tag)
+        date_formats = set(XLSX_DATE_FORMATS)
+        for fmt in styles.iter(ns + 'numFmt'):
+            code = XLSX_LITERAL_RE.sub('', fmt.get('formatCode', ''))
+            if XLSX_DATE_RE.search(code):
+                date_formats.add(int(fmt.get('numFmtId')))
+        xfs = styles.find(ns + 'cellXfs')
+        return set([i for i, xf in enumerate(xfs if xfs is not None else [])
+                    if int(xf.get('numFmtId', 0)) in date_formats])
+
+    def _date(self, serial):
+        """
+        Convert an Excel date serial number to a string, like the dates
+        stored by the rest of Elephant.
+
+        Args:
+            serial (float): Days since the workbook's epoch.
+
+        Returns (str):
+        '2016-01-01' for whole days, '10:30' for times, and
+        '2016-01-01 10:30' for both (with seconds, if it has any).
+        """
+        stamp = self.epoch + datetime.timedelta(
+            seconds=int(round(serial * 86400)))
+        clock = '%H:%M:%S' if stamp.second else '%H:%M'
+        if serial == int(serial):
+            return stamp.strftime('%Y-%m-%d')
+        if serial < 1:
+            return stamp.strftime(clock)
+        return stamp.strftime('%Y-%m-%d ' + clock)
+
+    def _value(self, cell, ns):
+        """
+        The value of a cell, converted by its type and style.
+        """
+        kind = cell.get('t', 'n')
+        if kind == 'inlineStr':
+            inline = cell.find(ns + 'is')
+            return self._text(inline, ns) if inline is not None else None
+        value = cell.findtext(ns + 'v')
+        if value is None:
+            return None
+        if kind == 's':
+            return self.strings[int(value)]
+        if kind == 'b':
+            return int(value)
+        if kind != 'n':
+            # str (formula results), e (errors) and d (ISO dates).
+            return value
+        if int(cell.get('s', 0)) in self.date_styles:
+            return self._date(float(value))
+        try:
+            return int(value)
+        except ValueError:
+            return float(value)
+
+    def rows(self):
+        """
+        Stream the sheet's rows. Missing cells come back as None, so each
+        value stays in its column. Missing rows are skipped.
+
+        Returns (generator):
+        Lists of cell values, one per row.
+        """
+        self.log.debug('Reading %s from %s', self.sheet_path, self.file_path)
+        with self.zip.open(self.sheet_path) as fh:
+            ns = ''
+            sheet_data = row_tag = cell_tag = None
+            # Column letters and their positions, worked out once each.
+            columns = {}
+            for event, element in ElementTree.iterparse(
+                    fh, events=('start', 'end')):
+                if event == 'start':
+                    if sheet_data is None and \
+                            element.tag.endswith('sheetData'):
+                        sheet_data = element
+                        ns = _namespace(element.tag)
+                        row_tag, cell_tag = ns + 'row', ns + 'c'
+                    continue
+                if element.tag != row_tag:
+                    continue
+                row = []
+                for cell in element:
+                    if cell.tag != cell_tag:
+                        continue
+                    ref = cell.get('r')
+                    if ref:
+                        letters = ref.rstrip('0123456789')
+                        column = columns.get(letters)
+                        if column is None:
+                            column = 0
+                            for char in letters:
+                                column = column * 26 + ord(char) - 64
+                            column = columns[letters] = column - 1
+                        if column > len(row):
+                            row.extend([None] * (column - len(row)))
+                    row.append(self._value(cell, ns))
+                yield row
+                # Throw the parsed row away, so memory stays flat.
+                sheet_data.clear()
+
+
+if __name__ == '__main__':
+    import sys
+
+    import ElephantLog
+
+    ElephantLog.init_log()
+    if len(sys.argv) < 2:
+        print('Usage: ElephantXlsx.py <workbook.xlsx> [sheet]')
+        sys.exit(1)
+    with XlsxReader(sys.argv[1], sys.argv[2] if len(sys.argv) > 2
+                    else None) as reader:
+        print(reader)
+        for row in reader.rows():
+            print(row)
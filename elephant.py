@@ -1,15 +1,15 @@
 import logging
 import os
 import shlex
+import sqlite3
 import sys
+import time
+
+from collections import OrderedDict
 
 import ElephantLog
 
 from ElephantBrain import ElephantBrain, AddledBrainError
-from ElephantTrunk import ElephantTrunk
-
-
-ElephantLog.init_log()
 
 
 class TrumpetError(Exception):
@@ -28,6 +28,11 @@ class ElephantTrumpet(object):
         brain (None, ElephantBrain): Our open datafile. Defaults to None. Set
             by command_open, and unset by command_close.
     """
+    # The output formats of the get command, and their WRITERS.
+    get_formats = OrderedDict([('table', 'table'), ('csv', 'csv'),
+                               ('tsv', 'tsv'), ('json', 'jsonl'),
+                               ('html', 'html')])
+
     def __init__(self):
         """
         Prepare an ElephantTrumpet object for use.
@@ -151,14 +156,23 @@ class ElephantTrumpet(object):
         if cmds.get('help', False):
             print('Open a database for usage.\n'
                   '\n'
-                  'Usage: open <path to database> [new]\n'
+                  'Usage: open <path to database> [--new] '
+                  '[--profile <profile>]\n'
                   '\n'
                   'path to database: the path to the database file to open.\n'
                   'new: If new is specified, a new file will be created, '
-                  'overwriting any existing file.')
+                  'overwriting any existing file.\n'
+                  'profile: The connection profile to use: {0}. Defaults to '
+                  'safe.'.format(', '.join(sorted(ElephantBrain.profiles))))
             return None
         db_path = os.path.abspath(cmds['args'][0])
         new = cmds.get('new', False)
+        profile = cmds.get('profile', 'safe')
+        if profile not in ElephantBrain.profiles:
+            print('Profile \'{0}\' is not a valid profile. Valid options '
+                  'are: {1}'.format(profile,
+                                    ', '.join(sorted(ElephantBrain.profiles))))
+            return None
         if self.brain:
             print('The following file is open: {0}'.format(
                 self.brain.file_path))
@@ -170,8 +184,9 @@ class ElephantTrumpet(object):
                 print('Leaving file alone then.')
                 return None
         try:
-            print('Opening: {0}, New: {1}'.format(db_path, new))
-            self.brain = ElephantBrain(db_path, new=new)
+            print('Opening: {0}, New: {1}, Profile: {2}'.format(
+                db_path, new, profile))
+            self.brain = ElephantBrain(db_path, new=new, profile=profile)
             print('Opened: {0}\n'.format(db_path))
             print(self.brain.info)
         except AddledBrainError as e:
@@ -188,6 +203,25 @@ class ElephantTrumpet(object):
         else:
             print('No file currently opened.')
 
+    def command_rollback(self, parm_list):
+        """
+        Throw away the changes made since the last save.
+
+        Args:
+            parm_list (list): The params to pass.
+        """
+        cmds = self.__param_dict(parm_list)
+        if cmds.get('help', False):
+            print('Throw away every change made since the last save.\n'
+                  '\n'
+                  'Usage: rollback')
+            return None
+        if not self.brain:
+            print('No file currently opened.')
+            return None
+        self.brain.rollback()
+        print('Rolled back {0} to the last save.'.format(self.brain))
+
     def command_close(self, parm_list):
         """
         Close the active database.
@@ -203,29 +237,153 @@ class ElephantTrumpet(object):
         self.brain = None
         print('Closed: {0}'.format(old_brain))
 
+    def command_batch(self, parm_list):
+        """
+        Run a script of commands, one per line, in this process against the
+        open file.
+
+        Args:
+            parm_list (list): The params to pass.
+        """
+        cmds = self.__param_dict(parm_list,
+                                 true_parms=['transaction', 'timings', 'stop'])
+        if cmds.get('help', False):
+            print('Run a script of commands, one per line. Blank lines and '
+                  'lines starting with # are skipped, and quit ends the '
+                  'script.\n'
+                  '\n'
+                  'Usage: batch [<script> | -] [--transaction] [--timings] '
+                  '[--stop]\n'
+                  '\n'
+                  'script: The file of commands to run. Reads stdin if it\'s '
+                  '- or not given.\n'
+                  'transaction: Run the whole script as one transaction, '
+                  'saved at the end. A command that raises an error rolls '
+                  'all of it back.\n'
+                  'timings: Print how long each command took.\n'
+                  'stop: Stop at the first command that raises an error.')
+            return None
+        transaction = cmds.get('transaction', False)
+        if transaction and not self.brain:
+            print('No file currently opened.')
+            return None
+        script = cmds['args'][0] if cmds['args'] else '-'
+        if script == '-':
+            lines = sys.stdin
+        else:
+            try:
+                lines = open(script)
+            except IOError as e:
+                print('Reading {0}: {1}'.format(script, e))
+                return None
+        timings = []
+        failed = []
+        start = time.time()
+        try:
+            if transaction:
+                with self.brain.transaction():
+                    self.__run_batch(lines, timings, failed, True,
+                                     cmds.get('timings', False))
+            else:
+                self.__run_batch(lines, timings, failed,
+                                 cmds.get('stop', False),
+                                 cmds.get('timings', False))
+        except Exception as e:
+            print('{0}: {1}'.format('Rolled back the whole script'
+                                    if transaction else 'Stopped', e))
+        finally:
+            if lines is not sys.stdin:
+                lines.close()
+        print('Ran {0} commands in {1:.3f}s, {2} failed.'.format(
+            len(timings), time.time() - start, len(failed)))
+        if timings:
+            slowest = max(timings)
+            print('Slowest: {0:.4f}s {1}'.format(*slowest))
+
+    def __run_batch(self, lines, timings, failed, stop, show):
+        """
+        Run each command in a batch script.
+
+        Args:
+            lines (iterable): The script's lines.
+            timings (list): Gets a tuple of (seconds, command) added for each
+                command run.
+            failed (list): Gets each command that raised an error added.
+            stop (bool): Raise the first error, rather than carrying on.
+            show (bool): Print each command's time as it finishes.
+        """
+        for line in lines:
+            command = line.strip()
+            if not command or command.startswith('#'):
+                continue
+            if command == 'quit':
+                break
+            start = time.time()
+            try:
+                self.parse_commands(command)
+            except Exception as e:
+                failed.append(command)
+                print('ERROR: {0}: {1}'.format(command, e))
+                if stop:
+                    raise
+            finally:
+                timings.append((time.time() - start, command))
+                if show:
+                    print('[{0:.4f}s] {1}'.format(timings[-1][0], command))
+
     def command_get(self, parm_list):
+        """
+        Print rows from the database, streamed a batch at a time.
+
+        Args:
+            parm_list (list): The params to pass.
+        """
         cmds = self.__param_dict(parm_list, true_parms=['new'])
         if cmds.get('help', False):
-            # TODO: Add help string.
-            print('')
+            print('Print rows from the opened file.\n'
+                  '\n'
+                  'Usage: get --tables <table> [--fields <field>] '
+                  '[--where <condition>] [--format <{0}>] [--limit <n>] '
+                  '[--offset <n>]\n'
+                  '\n'
+                  'tables: The table to get rows from. Repeat for more.\n'
+                  'fields: A field to get. Repeat for more. Defaults to all '
+                  'of them.\n'
+                  'where: A condition rows must meet, like "Room=3". Repeat '
+                  'for more.\n'
+                  'format: How to print the rows. Defaults to table. json '
+                  'prints one JSON object per line.\n'
+                  'limit: The most rows to print.\n'
+                  'offset: The number of rows to skip first.'.format(
+                      '|'.join(self.get_formats)))
             return None
         if not self.brain:
             print('No file currently opened.')
             return None
-        data = self.brain.get(tables=cmds.get('tables'),
-                              fields=cmds.get('fields'),
-                              where=cmds.get('where'),
-                              fetchall=True)
-        if not data:
-            print('No data fits query.')
+        fmt = cmds.get('format', 'table')
+        if fmt not in self.get_formats:
+            print('Unknown format {0}. Valid options are: {1}'.format(
+                fmt, ', '.join(self.get_formats)))
+            return None
+        try:
+            limit = int(cmds['limit']) if 'limit' in cmds else None
+            offset = int(cmds['offset']) if 'offset' in cmds else None
+        except ValueError:
+            print('limit and offset must be whole numbers.')
             return None
-        line_template = ' | '.join([('{' + str(k) + '}')
-                                    for k in data[0].keys()])
-        # Print the header row
-        print(line_template.replace('{', '').replace('}', ''))
-        # Print the data rows
-        for row in data:
-            print(line_template.format(**row))
+        from ElephantTrunk import write_rows
+        try:
+            rows = self.brain.get(tables=cmds.get('tables'),
+                                  fields=cmds.get('fields'),
+                                  where=cmds.get('where'), iterate=True,
+                                  batch_size=1000, limit=limit,
+                                  offset=offset)
+            count = write_rows(rows, sys.stdout, self.get_formats[fmt])
+        except sqlite3.Error as e:
+            print(e)
+            return None
+        if not count and fmt == 'table':
+            print('No data fits query.')
 
     def command_add(self, parm_list):
         cmds = self.__param_dict(parm_list, true_parms=['new'])
@@ -258,20 +416,249 @@ class ElephantTrumpet(object):
             return None
 
     def command_info(self, parm_list):
-        cmds = self.__param_dict(parm_list)
+        cmds = self.__param_dict(parm_list, true_parms=['stats'])
         if cmds.get('help', False):
-            print('Gets information on the currently opened file.')
+            print('Gets information on the currently opened file.\n'
+                  '\n'
+                  'Usage: info [--stats]\n'
+                  '\n'
+                  'stats: Also show row counts and disk usage for every '
+                  'table and index.')
             return None
         if not self.brain:
             print('No file currently opened.')
             return None
         print(self.brain.info)
+        if cmds.get('stats', False):
+            stats = self.brain.stats()
+            print('  Storage:\n'
+                  '    File size: {file_size} bytes\n'
+                  '    Pages: {page_count} x {page_size} bytes '
+                  '({freelist_count} free)'.format(**stats))
+            line = '    {0}: {1} rows, {2} pages, {3} bytes'
+            print('  Tables:')
+            for name in sorted(stats['tables']):
+                t = stats['tables'][name]
+                print(line.format(name, t['rows'], t['pages'], t['bytes']))
+            print('  Indexes:')
+            for name in sorted(stats['indexes']):
+                i = stats['indexes'][name]
+                print('    {0} ({1}): {2} pages, {3} bytes'.format(
+                    name, i['table'], i['pages'], i['bytes']))
+
+    def command_cache(self, parm_list):
+        """
+        Show the result cache's statistics, or turn it on, off or clear it.
+
+        Args:
+            parm_list (list): The params to pass.
+        """
+        cmds = self.__param_dict(parm_list,
+                                 true_parms=['on', 'off', 'clear'])
+        if cmds.get('help', False):
+            print('Show or control the result cache of the opened file.\n'
+                  '\n'
+                  'Usage: cache [--on | --off] [--clear]\n'
+                  '\n'
+                  'on: Turn the result cache on.\n'
+                  'off: Turn the result cache off.\n'
+                  'clear: Empty the cache and reset its statistics.')
+            return None
+        if not self.brain:
+            print('No file currently opened.')
+            return None
+        if cmds.get('on', False):
+            self.brain.cache.enabled = True
+        elif cmds.get('off', False):
+            self.brain.cache.enabled = False
+        if cmds.get('clear', False):
+            self.brain.cache.clear()
+        stats = self.brain.cache.stats
+        print('Result cache: {0}\n'
+              '  Hits: {1}, Misses: {2}, Hit rate: {3:.1%}\n'
+              '  Entries: {4}/{5}'.format(
+                  'on' if stats['enabled'] else 'off', stats['hits'],
+                  stats['misses'], stats['hit_rate'], stats['entries'],
+                  stats['size']))
+
+    def command_autosave(self, parm_list):
+        """
+        Show or change the autosave settings of the opened file.
+
+        Args:
+            parm_list (list): The params to pass.
+        """
+        cmds = self.__param_dict(parm_list, true_parms=['off'])
+        if cmds.get('help', False):
+            print('Save changes automatically, in groups.\n'
+                  '\n'
+                  'Usage: autosave [--rows <n>] [--seconds <n>] [--off]\n'
+                  '\n'
+                  'rows: Save once this many rows have been changed.\n'
+                  'seconds: Save on the first change this many seconds after '
+                  'the last save.\n'
+                  'off: Only save when told to.')
+            return None
+        if not self.brain:
+            print('No file currently opened.')
+            return None
+        try:
+            if cmds.get('off', False):
+                self.brain.autosave()
+            elif 'rows' in cmds or 'seconds' in cmds:
+                self.brain.autosave(
+                    int(cmds['rows']) if 'rows' in cmds else None,
+                    float(cmds['seconds']) if 'seconds' in cmds else None)
+        except ValueError as e:
+            print(e)
+            return None
+        rows, seconds = self.brain.autosave_rows, self.brain.autosave_seconds
+        if rows is None and seconds is None:
+            print('Autosave: off')
+        else:
+            print('Autosave: every {0}'.format(' or '.join(
+                ([] if rows is None else ['{0} rows'.format(rows)]) +
+                ([] if seconds is None else
+                 ['{0:g} seconds'.format(seconds)]))))
+
+    def command_changes(self, parm_list):
+        """
+        Show the rows changed since a point in the change log, turn change
+        tracking on or off, or prune the change log.
+
+        Args:
+            parm_list (list): The params to pass.
+        """
+        cmds = self.__param_dict(parm_list, true_parms=['on', 'off', 'prune'])
+        if cmds.get('help', False):
+            print('Show or control change tracking in the opened file.\n'
+                  '\n'
+                  'Usage: changes [--on | --off] [--prune] '
+                  '[--since <change id>]\n'
+                  '\n'
+                  'on: Start recording changes (off by default, since it '
+                  'slows down writes).\n'
+                  'off: Stop recording changes.\n'
+                  'prune: Delete the changes older than the oldest one a '
+                  'report last ran against.\n'
+                  'since: Count the rows changed after this change. Defaults '
+                  'to 0.')
+            return None
+        if not self.brain:
+            print('No file currently opened.')
+            return None
+        if cmds.get('on', False):
+            self.brain.track_changes(True)
+        elif cmds.get('off', False):
+            self.brain.track_changes(False)
+        if cmds.get('prune', False):
+            print('Pruned {0} changes.'.format(self.brain.prune_changes()))
+            self.brain.save()
+        last = self.brain.last_change()
+        print('Change tracking: {0}, latest change: {1}'.format(
+            'on' if self.brain.tracking else 'off',
+            'none' if last is None else last))
+        if last:
+            changes = self.brain.changes(int(cmds.get('since', 0)))
+            for table in sorted(changes):
+                print('  {0}: {1} rows'.format(table, len(changes[table])))
+        ran = self.brain.report_log()
+        for name in sorted(ran):
+            print('  Report {0}: ran at {1}, change {2}'.format(
+                name, ran[name]['Ran'], ran[name]['ChangeId']))
+
+    def command_conflicts(self, parm_list):
+        """
+        List double-booked rooms and staff.
+
+        Args:
+            parm_list (list): The params to pass.
+        """
+        cmds = self.__param_dict(parm_list, true_parms=['rooms', 'staff'])
+        if cmds.get('help', False):
+            print('List rooms and staff booked into overlapping events.\n'
+                  '\n'
+                  'Usage: conflicts [--rooms | --staff] [--event <id>]\n'
+                  '\n'
+                  'rooms: Only check rooms.\n'
+                  'staff: Only check staff.\n'
+                  'event: Only check the conflicts of this event.')
+            return None
+        if not self.brain:
+            print('No file currently opened.')
+            return None
+        from ElephantTusk import ElephantTusk
+        tusk = ElephantTusk(self.brain)
+        if 'event' in cmds:
+            conflicts = tusk.event_conflicts(int(cmds['event']))
+        elif cmds.get('rooms', False):
+            conflicts = tusk.room_conflicts()
+        elif cmds.get('staff', False):
+            conflicts = tusk.staff_conflicts()
+        else:
+            conflicts = tusk.conflicts()
+        if not conflicts:
+            print('No conflicts found.')
+            return None
+        for c in conflicts:
+            print('{Type} {Id}: events {Event} and {Conflict} overlap from '
+                  '{Start} to {End}'.format(**c))
+        print('{0} conflicts found.'.format(len(conflicts)))
+
+    def command_index(self, parm_list):
+        """
+        List, add or drop the database indexes.
+
+        Args:
+            parm_list (list): The params to pass.
+        """
+        cmds = self.__param_dict(parm_list, true_parms=['add', 'drop'])
+        if cmds.get('help', False):
+            print('List, add or drop indexes on the currently opened file.\n'
+                  '\n'
+                  'Usage: index [--add | --drop] [index names]\n'
+                  '\n'
+                  'add: Add the named indexes, or all default indexes.\n'
+                  'drop: Drop the named indexes, or all default indexes.\n'
+                  'Default indexes: {0}'.format(
+                      ', '.join(sorted(ElephantBrain.indexes))))
+            return None
+        if not self.brain:
+            print('No file currently opened.')
+            return None
+        names = cmds['args'] or None
+        try:
+            if cmds.get('add', False):
+                print('Added: {0}'.format(
+                    ', '.join(self.brain.add_indexes(names))))
+            elif cmds.get('drop', False):
+                print('Dropped: {0}'.format(
+                    ', '.join(self.brain.drop_indexes(names))))
+        except ValueError as e:
+            print('ERROR: {0}'.format(e))
+            return None
+        print('Indexes: {0}'.format(', '.join(self.brain.index_list)))
 
     def command_import(self, parm_list):
+        """
+        Import rows into a table from a CSV or XLSX file.
+
+        Args:
+            parm_list (list): The params to pass.
+        """
         cmds = self.__param_dict(parm_list)
         if cmds.get('help', False):
-            # TODO: Add help string.
-            print('')
+            print('Import rows into a table from a CSV or XLSX file. The '
+                  'first row is the header, and columns are matched to the '
+                  'table\'s fields by name.\n'
+                  '\n'
+                  'Usage: import --table <table> --file <file> '
+                  '[--sheet <sheet>]\n'
+                  '\n'
+                  'table: The table to add the rows to.\n'
+                  'file: The .csv or .xlsx file to import.\n'
+                  'sheet: The name of the XLSX sheet to import. Defaults to '
+                  'the first sheet.')
             return None
         if not self.brain:
             print('No file currently opened.')
@@ -293,13 +680,52 @@ class ElephantTrumpet(object):
             return None
         print('table: {0}\nfile: {1}\ntype: {2}'.format(
             table, file_path, file_type))
-        if file_type == '.csv':
-            self.brain.add_csv(table, file_path)
-        elif file_type == '.xlsx':
-            self.brain.add_xlsx(table, file_path)
-        else:
-            print('No idea what to do with file type {0}. '
-                  'File should be xlsx or csv.'.format(file_type))
+        try:
+            if file_type == '.csv':
+                count = self.brain.add_csv(table, file_path)
+            elif file_type == '.xlsx':
+                count = self.brain.add_xlsx(table, file_path,
+                                            sheet=cmds.get('sheet'))
+            else:
+                print('No idea what to do with file type {0}. '
+                      'File should be xlsx or csv.'.format(file_type))
+                return None
+        except ValueError as e:
+            print(e)
+            return None
+        print('Imported {0} rows.'.format(count))
+
+    def command_shortfall(self, parm_list):
+        """
+        List the equipment each site doesn't have enough of at its peak.
+
+        Args:
+            parm_list (list): The params to pass.
+        """
+        cmds = self.__param_dict(parm_list, true_parms=['all'])
+        if cmds.get('help', False):
+            print('List the peak simultaneous demand for each piece of '
+                  'equipment at each site, and the shortfall against what '
+                  'the site has.\n'
+                  '\n'
+                  'Usage: shortfall [--all]\n'
+                  '\n'
+                  'all: Show every site and piece, not just shortfalls.')
+            return None
+        if not self.brain:
+            print('No file currently opened.')
+            return None
+        from ElephantTusk import ElephantTusk
+        tusk = ElephantTusk(self.brain)
+        demand = tusk.equipment_demand() if cmds.get('all', False) \
+            else tusk.shortfalls()
+        if not demand:
+            print('No shortfalls found.')
+            return None
+        for d in demand:
+            print('Site {Site}, piece {Piece}: peak of {Peak} from {Start} '
+                  'to {End}, {Available} available, {Shortfall} '
+                  'short'.format(**d))
 
     def command_report(self, parm_list):
         """
@@ -308,19 +734,185 @@ class ElephantTrumpet(object):
         Args:
             parm_list (list): The params to pass.
         """
-        print('Report: {0}'.format(parm_list))
-        # TODO: Implement me!.
+        cmds = self.__param_dict(parm_list, true_parms=['list', 'force'])
+        from ElephantTrunk import ElephantTrunk, WRITERS
+        if cmds.get('help', False):
+            print('List or run reports.\n'
+                  '\n'
+                  'Usage: report [--list] [report names] [--workers <n>] '
+                  '[--out <dir>] [--format <{0}>] [--force]\n'
+                  '\n'
+                  'list: List the available reports.\n'
+                  'report names: The reports to run. Runs all of them if '
+                  'none are given.\n'
+                  'workers: The most reports to run at once. Defaults to '
+                  'the number of CPUs.\n'
+                  'out: Directory to write each report to.\n'
+                  'format: The format to write reports in. Defaults to '
+                  'csv.\n'
+                  'force: Run reports even if nothing they depend on has '
+                  'changed.\n'
+                  '\n'
+                  'Reports read the saved copy of the file, so save '
+                  'first.'.format('|'.join(WRITERS)))
+            return None
+        trunk = ElephantTrunk()
+        reports = trunk.list_reports()
+        if cmds.get('list', False):
+            for name in sorted(reports):
+                print('{0}: {1}'.format(name, reports[name]))
+            return None
+        if not self.brain:
+            print('No file currently opened.')
+            return None
+        unknown = [n for n in cmds['args'] if n not in reports]
+        if unknown:
+            print('Unknown reports: {0}. Valid options are: {1}'.format(
+                ', '.join(unknown), ', '.join(sorted(reports))))
+            return None
+        fmt = cmds.get('format', 'csv')
+        if fmt not in WRITERS:
+            print('Unknown format {0}. Valid options are: {1}'.format(
+                fmt, ', '.join(WRITERS)))
+            return None
+        workers = int(cmds['workers']) if 'workers' in cmds else None
+        summary = trunk.run_reports(self.brain.file_path,
+                                    cmds['args'] or None, workers,
+                                    cmds.get('out'), fmt,
+                                    cmds.get('force', False))
+        for name in sorted(summary['reports']):
+            result = summary['reports'][name]
+            print('{0} ({1}): {2:.3f}s, {3}'.format(
+                name, result['title'], result['seconds'],
+                'FAILED' if result['error'] else
+                '{0} rows'.format(result['rows'])) +
+                (' -> {0}'.format(result['output'])
+                 if result['output'] and not result['error'] else '') +
+                ' ({0})'.format(result['reason']))
+        for name in sorted(summary['skipped']):
+            print('{0}: skipped, {1}'.format(name, summary['skipped'][name]))
+        print('Ran {0} shared queries for {1} declared in {2:.3f}s.'.format(
+            summary['queries']['run'], summary['queries']['declared'],
+            summary['queries']['seconds']))
+        print('Ran {0} reports with {1} workers in {2:.3f}s, {3} '
+              'failed.'.format(len(summary['reports']), summary['workers'],
+                               summary['seconds'], len(summary['failed'])))
+
+    def command_profile(self, parm_list):
+        """
+        Show the query profiler's statistics, or turn it on, off or clear it.
+
+        Args:
+            parm_list (list): The params to pass.
+        """
+        cmds = self.__param_dict(parm_list,
+                                 true_parms=['on', 'off', 'clear'])
+        if cmds.get('help', False):
+            print('Profile the statements run on the opened file.\n'
+                  '\n'
+                  'Usage: profile [--on | --off] [--slow <seconds>] '
+                  '[--clear] [--top <n>]\n'
+                  '\n'
+                  'on: Start profiling.\n'
+                  'off: Stop profiling, keeping the statistics.\n'
+                  'slow: Log statements that take at least this many '
+                  'seconds, with their query plans. Turns profiling on.\n'
+                  'clear: Forget the statistics so far.\n'
+                  'top: Only show the n statements that took longest in '
+                  'total.\n'
+                  '\n'
+                  'Times are in milliseconds. p95 and max cover the recent '
+                  'calls whose rows have all been fetched.')
+            return None
+        if not self.brain:
+            print('No file currently opened.')
+            return None
+        try:
+            top = int(cmds['top']) if 'top' in cmds else None
+            if cmds.get('off', False):
+                self.brain.profile_queries(False)
+            elif cmds.get('on', False) or 'slow' in cmds:
+                self.brain.profile_queries(
+                    True, float(cmds['slow']) if 'slow' in cmds else None)
+        except ValueError as e:
+            print(e)
+            return None
+        if cmds.get('clear', False):
+            self.brain.profiler.clear()
+        profiler = self.brain.profiler
+        print('Query profiler: {0}{1}'.format(
+            'on' if profiler.enabled else 'off',
+            '' if profiler.slow is None else
+            ', logging statements slower than {0:g}s'.format(profiler.slow)))
+        stats = profiler.stats[:top]
+        if not stats:
+            return None
+        from ElephantTrunk import write_rows
+
+        def ms(seconds):
+            return '' if seconds is None else '{0:.3f}'.format(
+                seconds * 1000)
+        write_rows([(s['calls'], ms(s['seconds']), ms(s['mean']),
+                     ms(s['p95']), ms(s['max']), s['rows'], s['steps'],
+                     s['shape']) for s in stats], sys.stdout, 'table',
+                   ['Calls', 'Total', 'Mean', 'p95', 'Max', 'Rows', 'Steps',
+                    'Statement'])
+
+    def command_log(self, parm_list):
+        """
+        Show or set the log level of each subsystem.
+
+        Args:
+            parm_list (list): The params to pass.
+        """
+        cmds = self.__param_dict(parm_list)
+        if cmds.get('help', False):
+            print('Show or set how much each part of elephant logs.\n'
+                  '\n'
+                  'Usage: log [<subsystem>=<level> ...]\n'
+                  '\n'
+                  'subsystem: One of {0}.\n'
+                  'level: debug, info, warn, error or critical. Use info '
+                  'for ElephantBrain to stop logging every row added one '
+                  'at a time.'.format(', '.join(ElephantLog.SUBSYSTEMS)))
+            return None
+        bad = [a for a in cmds['args'] if '=' not in a]
+        if bad:
+            print('Expected <subsystem>=<level>, got: {0}'.format(
+                ', '.join(bad)))
+            return None
+        try:
+            ElephantLog.set_levels(dict([a.split('=', 1)
+                                         for a in cmds['args']]))
+        except ValueError as e:
+            print(e)
+            return None
+        levels = ElephantLog.get_levels()
+        for subsystem in ElephantLog.SUBSYSTEMS:
+            print('{0}: {1}'.format(subsystem, levels[subsystem]))
 
 
 if __name__ == '__main__':
+    ElephantLog.init_log()
     trumpet = ElephantTrumpet()
     if len(sys.argv) > 1:
         # Command line mode
-        # Open file
-        trumpet.parse_commands('open {0}'.format(sys.argv[1]))
-        print('\nExecuting: {0}\n'.format(' '.join(sys.argv[2:])))
+        # Open file, with the profile if one comes before the command.
+        args = sys.argv[2:]
+        open_command = 'open {0}'.format(sys.argv[1])
+        if args[:1] == ['--profile'] and len(args) > 1:
+            open_command += ' --profile {0}'.format(args[1])
+            args = args[2:]
+        # Keep the open messages out of stdout, so the command's output can
+        # be piped.
+        stdout, sys.stdout = sys.stdout, sys.stderr
+        try:
+            trumpet.parse_commands(open_command)
+            print('\nExecuting: {0}\n'.format(' '.join(args)))
+        finally:
+            sys.stdout = stdout
         # Commands
-        trumpet.parse_commands(' '.join(sys.argv[2:]))
+        trumpet.parse_commands(' '.join(args))
     else:
         # Interactive mode
         trumpet.interactive = True
@@ -0,0 +1,42 @@
+from ElephantTrunk import ElephantReport
+from ElephantTusk import ElephantTusk
+
+
+class Conflicts(ElephantReport):
+    title = 'Schedule Conflicts'
+    depends = ('Event', 'StaffAssign', 'Room', 'People')
+    queries = {
+        'events': {'tables': 'Event', 'fields': ['id', 'Name']},
+        'rooms': {'tables': 'Room', 'fields': ['id', 'Name']},
+        'people': {'tables': 'People',
+                   'fields': ['id', 'FirstName', 'LastName']},
+    }
+
+    def data(self):
+        """
+        Every room and staff double-booking, with the names of the events,
+        rooms and people involved.
+
+        Returns (list):
+        List of conflict dictionaries (see ElephantTusk), with Name,
+        EventName and ConflictName keys added.
+        """
+        conflicts = ElephantTusk(self.brain).conflicts()
+        if not conflicts:
+            return conflicts
+        events = dict([(r['id'], r['Name']) for r in self.query('events')])
+        names = {
+            'Room': dict([(r['id'], r['Name'])
+                          for r in self.query('rooms')]),
+            'Person': dict([(r['id'], '{0} {1}'.format(r['FirstName'],
+                                                       r['LastName']))
+                            for r in self.query('people')]),
+        }
+        for conflict in conflicts:
+            conflict['Name'] = names[conflict['Type']].get(conflict['Id'])
+            conflict['EventName'] = events.get(conflict['Event'])
+            conflict['ConflictName'] = events.get(conflict['Conflict'])
+        return conflicts
+
+    def build(self):
+        return self.data()
@@ -0,0 +1,34 @@
+from ElephantTrunk import ElephantReport
+from ElephantTusk import ElephantTusk
+
+
+class EquipmentShortfall(ElephantReport):
+    title = 'Equipment Shortfall'
+    depends = ('Event', 'Room', 'Site', 'Equipment', 'EquipmentAssign',
+               'EquipmentAdjust')
+    queries = {
+        'sites': {'tables': 'Site', 'fields': ['id', 'Name']},
+        'pieces': {'tables': 'Equipment', 'fields': ['id', 'Name']},
+    }
+
+    def data(self):
+        """
+        The equipment each site needs more of to cover its peak demand, with
+        the names of the sites and equipment.
+
+        Returns (list):
+        List of equipment demand dictionaries (see ElephantTusk), with
+        SiteName and PieceName keys added.
+        """
+        shortfalls = ElephantTusk(self.brain).shortfalls()
+        if not shortfalls:
+            return shortfalls
+        sites = dict([(r['id'], r['Name']) for r in self.query('sites')])
+        pieces = dict([(r['id'], r['Name']) for r in self.query('pieces')])
+        for shortfall in shortfalls:
+            shortfall['SiteName'] = sites.get(shortfall['Site'])
+            shortfall['PieceName'] = pieces.get(shortfall['Piece'])
+        return shortfalls
+
+    def build(self):
+        return self.data()
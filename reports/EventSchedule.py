@@ -0,0 +1,14 @@
+from ElephantTrunk import ElephantReport
+
+
+class EventSchedule(ElephantReport):
+    title = 'Event Schedule'
+    depends = ('Event',)
+    queries = {
+        'events': {'tables': 'Event',
+                   'fields': ['id', 'Name', 'Room', 'Start', 'End'],
+                   'order': ['Start', 'Room']},
+    }
+
+    def build(self):
+        return self.query('events')
@@ -0,0 +1,22 @@
+from ElephantTrunk import ElephantReport
+
+
+class StaffAssignments(ElephantReport):
+    title = 'Staff Assignments'
+    depends = ('StaffAssign', 'Event', 'People')
+
+    def rows(self):
+        """
+        Every staff assignment with its event and person, streamed straight
+        from the database so it doesn't matter how many there are.
+        """
+        return self.brain.get(
+            'StaffAssign',
+            ['Event.Start', 'Event.End', 'Event.Name AS Event',
+             'People.FirstName', 'People.LastName'],
+            joins=[('Event', 'StaffAssign.Event=Event.id'),
+                   ('People', 'StaffAssign.Person=People.id')],
+            order=['Event.Start', 'StaffAssign.id'], iterate=True)
+
+    def build(self):
+        return list(self.rows())
@@ -2,4 +2,8 @@ from ElephantTrunk import ElephantReport
 
 
 class UselessExample(ElephantReport):
-    title = 'Useless Example'
\ No newline at end of file
+    title = 'Useless Example'
+    depends = ()
+
+    def build(self):
+        return []